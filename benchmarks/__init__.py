@@ -0,0 +1,12 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class Result:
+    name: str
+    value: float
+    unit: str
+    higher_is_better: bool = True
+
+    def __str__(self):
+        return "%-40s %14.1f %s" % (self.name + ":", self.value, self.unit)
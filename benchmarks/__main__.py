@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Runs all benchmarks, no meter needed. Results can be stored as JSON and compared to an earlier run to
+# catch performance regressions: python -m benchmarks --json new.json --baseline old.json
+
+import argparse
+import dataclasses
+import json
+import sys
+from typing import List
+
+from benchmarks import Result, bench_crc, bench_decode, bench_latency, bench_output
+
+
+def _regressions(results: List[Result], baseline_path: str, tolerance: float) -> List[str]:
+    with open(baseline_path, "rt", encoding="utf-8") as f:
+        baseline = {entry["name"]: entry["value"] for entry in json.load(f)}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result.name)
+        if not previous:
+            continue
+        change = result.value / previous if result.higher_is_better else previous / result.value
+        if change < 1.0 - tolerance:
+            regressions.append("%s: %.1f %s, was %.1f" % (result.name, result.value, result.unit, previous))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Run all benchmarks")
+    parser.add_argument("--quick", action="store_true", help="Smaller runs, e.g. for CI")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.3,
+                        help="Allowed slowdown compared to the baseline (default: %(default)s)")
+    args = parser.parse_args()
+
+    scale = 10 if args.quick else 1
+    results = []
+    for result in (bench_decode.run(20000 // scale)
+                   + bench_decode.run(20000 // scale, use_crc=True)
+                   + bench_crc.run(20000 // scale)
+                   + bench_output.run(200000 // scale)
+                   + bench_latency.run(100 // scale)):
+        print(result, flush=True)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, "wt", encoding="utf-8") as f:
+            json.dump([dataclasses.asdict(result) for result in results], f, indent=2)
+    if args.baseline:
+        regressions = _regressions(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print("Regression: " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
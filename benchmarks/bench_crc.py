@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# What CRC verification adds to decoding a packet.
+# Run from the repository root: python -m benchmarks.bench_crc
+
+import argparse
+import time
+from typing import List
+
+import numpy as np
+
+from benchmarks import Result
+from benchmarks.bench_decode import simulated_packets
+from usb_meter import crc8
+from usb_meter.batch_decoder import PACKET_SIZE
+from usb_meter.simulation import SimulatedDevice
+from usb_meter.usb_meter import USBMeter
+
+
+def _seconds(use_crc: bool, packets, batch_size: int) -> float:
+    meter = USBMeter(SimulatedDevice(), None, use_crc=use_crc)
+    timestamps = [time.time_ns()] * batch_size
+    start = time.perf_counter()
+    for first in range(0, len(packets), batch_size):
+        batch = packets[first:first + batch_size]
+        meter.decode_packets(batch, timestamps[:len(batch)])
+    return time.perf_counter() - start
+
+
+def _checksum_seconds(packets, batch_size: int) -> float:
+    # The checksums alone, the difference of two decoding runs above is noisy
+    rows = packets.view(np.uint8).reshape(-1, PACKET_SIZE)
+    start = time.perf_counter()
+    for first in range(0, len(rows), batch_size):
+        crc8.packet_checksums(rows[first:first + batch_size])
+    return time.perf_counter() - start
+
+
+def run(packets: int = 20000, batch_size: int = 16) -> List[Result]:
+    data = simulated_packets(packets)
+    without_crc = _seconds(False, data, batch_size)
+    with_crc = _seconds(True, data, batch_size)
+    return [
+        Result("crc verification", (with_crc - without_crc) / packets * 1e9, "ns/packet", higher_is_better=False),
+        Result("crc checksums", _checksum_seconds(data, batch_size) / packets * 1e9, "ns/packet",
+               higher_is_better=False),
+        Result("decode with crc", packets / with_crc, "packets/s"),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CRC verification benchmark")
+    parser.add_argument("--packets", type=int, default=20000, help="Number of packets to verify")
+    parser.add_argument("--batch-size", type=int, default=16, help="Packets per decoded batch (default: %(default)s)")
+    args = parser.parse_args()
+    for result in run(args.packets, args.batch_size):
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# Packets per second of the decoder, one packet at a time and in batches, on simulated meter reports.
+# Run from the repository root: python -m benchmarks.bench_decode
+
+import argparse
+import datetime
+import time
+from typing import List
+
+import numpy as np
+
+from benchmarks import Result
+from usb_meter.simulation import SimulatedDevice, SimulationConfig, Waveform, generate_packets
+from usb_meter.usb_meter import USBMeter
+
+
+def simulated_packets(count: int) -> np.ndarray:
+    return generate_packets(SimulationConfig(waveform=Waveform.NOISE), 0, count)
+
+
+def _packets_per_second(decode, packets: np.ndarray, batch_size: int) -> float:
+    timestamps = time.time_ns() + np.arange(len(packets), dtype=np.int64) * 40_000_000
+    start = time.perf_counter()
+    for first in range(0, len(packets), batch_size):
+        decode(packets[first:first + batch_size], timestamps[first:first + batch_size])
+    return len(packets) / (time.perf_counter() - start)
+
+
+def run(packets: int = 20000, use_crc: bool = False) -> List[Result]:
+    data = simulated_packets(packets)
+    suffix = " (crc)" if use_crc else ""
+
+    meter = USBMeter(SimulatedDevice(), None, use_crc=use_crc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    scalar = _packets_per_second(lambda p, _t: meter.decode_packet(p[0].tobytes(), now), data, 1)
+    results = [Result("decode per packet" + suffix, scalar, "packets/s")]
+    for batch_size in (1, 16, 256):
+        meter = USBMeter(SimulatedDevice(), None, use_crc=use_crc)
+        rate = _packets_per_second(meter.decode_packets, data, batch_size)
+        results.append(Result("decode batches of %d%s" % (batch_size, suffix), rate, "packets/s"))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decoder benchmark")
+    parser.add_argument("--packets", type=int, default=20000, help="Number of packets to decode")
+    parser.add_argument("--crc", action="store_true", help="Verify CRCs while decoding")
+    args = parser.parse_args()
+    for result in run(args.packets, args.crc):
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Time from a packet leaving the (simulated) meter to its samples being written by the data logger, with
+# the whole acquisition pipeline running at the meter's real packet rate.
+# Run from the repository root: python -m benchmarks.bench_latency
+
+import argparse
+from pathlib import Path
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+
+from benchmarks import Result
+from file_data_logger import FlushPolicy, OutputType
+from usb_meter.batch_decoder import SAMPLES_PER_PACKET
+from usb_meter.data_logger import DataLogger
+from usb_meter.measurement import MeasurementBatch
+from usb_meter.simulation import SimulatedDevice, SimulationConfig
+from usb_meter.usb_meter import USBMeter
+
+
+class _LatencyLogger(DataLogger):
+    def __init__(self, data_logger: DataLogger, device: SimulatedDevice, meter: USBMeter, packets: int):
+        self._data_logger = data_logger
+        self._device = device
+        self._meter = meter
+        self._packets = packets
+        self._samples = 0
+        self.latencies: List[int] = []
+
+    def log(self, data: MeasurementBatch) -> None:
+        self._data_logger.log(data)
+        written = time.monotonic_ns()
+        first_packet = self._samples // SAMPLES_PER_PACKET
+        self._samples += len(data)
+        read_times = self._device.read_times
+        for packet in range(first_packet, self._samples // SAMPLES_PER_PACKET):
+            self.latencies.append(written - read_times[packet])
+        if len(self.latencies) >= self._packets:
+            self._meter.stop()
+
+
+def run(packets: int = 100, packet_rate: float = 25.0) -> List[Result]:
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for output_type in OutputType:
+            device = SimulatedDevice(SimulationConfig(packet_rate=packet_rate))
+            meter = USBMeter(device, None, use_crc=True)
+            meter.setup_device()
+            path = Path(directory) / ("output." + output_type.type)
+            # Write every batch right away, otherwise the flush interval dominates the latency
+            with output_type.clazz(path, flush_policy=FlushPolicy(lines=1, interval=0.0)) as data_logger:
+                latency_logger = _LatencyLogger(data_logger, device, meter, packets)
+                meter.run(latency_logger)
+            latencies = np.array(latency_logger.latencies) / 1e6
+            results.append(Result("latency %s median" % output_type.type, float(np.median(latencies)), "ms",
+                                  higher_is_better=False))
+            results.append(Result("latency %s 99th percentile" % output_type.type,
+                                  float(np.percentile(latencies, 99)), "ms", higher_is_better=False))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end latency benchmark")
+    parser.add_argument("--packets", type=int, default=100, help="Number of packets per output type")
+    parser.add_argument("--packet-rate", type=float, default=25.0, help="Packets per second (default: %(default)s)")
+    args = parser.parse_args()
+    for result in run(args.packets, args.packet_rate):
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# Samples per second every output type writes to a file.
+# Run from the repository root: python -m benchmarks.bench_output
+
+import argparse
+from pathlib import Path
+import tempfile
+from typing import List
+
+from benchmarks import Result
+from benchmarks.bench_text_output import lines_per_second, synthetic_batch
+from file_data_logger import OutputType
+
+
+def run(samples: int = 200000, batch_size: int = 4) -> List[Result]:
+    batch = synthetic_batch(samples)
+    batches = [batch[start:start + batch_size] for start in range(0, len(batch), batch_size)]
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for output_type in OutputType:
+            path = Path(directory) / ("output." + output_type.type)
+            with output_type.clazz(path) as data_logger:
+                rate = lines_per_second(data_logger.log, batches)
+            results.append(Result("output %s" % output_type.type, rate, "samples/s"))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Output type benchmark")
+    parser.add_argument("--samples", type=int, default=200000, help="Number of samples to write")
+    parser.add_argument("--batch-size", type=int, default=4, help="Samples per logged batch (4 = one packet)")
+    args = parser.parse_args()
+    for result in run(args.samples, args.batch_size):
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Lines per second of the text data loggers, compared to formatting one measurement at a time.
+# Run from the repository root: python -m benchmarks.bench_text_output
+
+import argparse
+import io
+import time
+
+import numpy as np
+
+from file_data_logger import StreamDataLogger, CSVDataLogger
+from usb_meter.measurement import MeasurementBatch
+
+
+def synthetic_batch(count: int, seed: int = 0) -> MeasurementBatch:
+    rng = np.random.default_rng(seed)
+    start = time.time_ns()
+    raw_current = rng.integers(0, 300000, count, dtype=np.uint32)
+    raw_voltage = rng.integers(490000, 510000, count, dtype=np.uint32)
+    voltage = raw_voltage / MeasurementBatch.VOLTAGE_SCALE
+    current = raw_current / MeasurementBatch.CURRENT_SCALE
+    return MeasurementBatch(
+        device=None,
+        timestamp=start + np.arange(count, dtype=np.int64) * 10_000_000,
+        raw_voltage=raw_voltage,
+        raw_current=raw_current,
+        raw_dp=rng.integers(0, 3300, count, dtype=np.uint16),
+        raw_dn=rng.integers(0, 3300, count, dtype=np.uint16),
+        temperature=25.0 + rng.random(count),
+        energy=np.cumsum(voltage * current * 0.01),
+        capacity=np.cumsum(current * 0.01),
+    )
+
+
+def per_sample_plain(batch: MeasurementBatch, stream) -> None:
+    # What StreamDataLogger did before batched formatting
+    for data in batch:
+        stream.write(
+            f"{data.timestamp.isoformat(timespec="milliseconds")} {data.voltage:7.5f} "
+            f"{data.current:7.5f} {data.dp:5.3f} "
+            f"{data.dn:5.3f} {data.temperature:6.3f} "
+            f"{data.energy:.6f} {data.capacity:.6f}"
+            "\n"
+        )
+
+
+def lines_per_second(log, batches) -> float:
+    count = sum(len(batch) for batch in batches)
+    start = time.perf_counter()
+    for batch in batches:
+        log(batch)
+    return count / (time.perf_counter() - start)
+
+
+def logger_lines_per_second(clazz, batches) -> float:
+    data_logger = clazz("-", False)
+    data_logger._stream = io.StringIO()  # pylint: disable=protected-access
+    with data_logger:
+        return lines_per_second(data_logger.log, batches)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Text output benchmark")
+    parser.add_argument("--samples", type=int, default=200000, help="Number of samples to format")
+    parser.add_argument("--batch-size", type=int, default=4, help="Samples per logged batch (4 = one packet)")
+    args = parser.parse_args()
+
+    batch = synthetic_batch(args.samples)
+    batches = [batch[start:start + args.batch_size] for start in range(0, len(batch), args.batch_size)]
+
+    stream = io.StringIO()
+    reference = lines_per_second(lambda b: per_sample_plain(b, stream), batches)
+    print("per sample plain:  %12.0f lines/s" % reference)
+    for name, clazz in (("plain", StreamDataLogger), ("csv", CSVDataLogger)):
+        rate = logger_lines_per_second(clazz, batches)
+        print("batched %-9s  %12.0f lines/s (%.1fx)" % (name + ":", rate, rate / reference))
+
+
+if __name__ == "__main__":
+    main()
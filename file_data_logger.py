@@ -1,90 +1,549 @@
 import sys
+import itertools
 from pathlib import Path
-from typing import Union, Type, List
+from typing import Callable, Dict, List, Optional, Union, Type
 import csv
+import logging
+import sqlite3
 from dataclasses import dataclass
 from enum import Enum
+import threading
+import time
 
+import numpy as np
+
+from usb_meter import binary_format
+from usb_meter.aggregation import SummaryLogger, WindowSummary
 from usb_meter.data_logger import DataLogger
-from usb_meter.measurement import ElectricalMeasurement
+from usb_meter.device import Device
+from usb_meter.measurement import MeasurementBatch, timestamp_to_datetime
+from usb_meter.metrics import REGISTRY
+from usb_meter.rotation import RotatingFile, RotationPolicy
+from usb_meter.time_index import IndexedStream, IndexPolicy
+from usb_meter.text_format import TextTable, to_fixed_point
+
+
+@dataclass
+class FlushPolicy:
+    # Samples are collected in memory and written once this many are pending or this many seconds passed
+    lines: int = 4096
+    interval: float = 1.0
+
+
+def _open_stream(path: Union[str, Path, None], rotation: Optional[RotationPolicy], header: Callable[[object], None],
+                 binary: bool = False, index: Optional[IndexPolicy] = None):
+    # Returns the stream and whether it needs to be closed. header writes the header of further segments.
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    if path is None or path == "-":
+        if rotation or index:
+            raise ValueError("rotation and index need an output file")
+        return (sys.stdout.buffer if binary else sys.stdout), False
+    if rotation:
+        return RotatingFile(path, rotation, binary=binary, header=header, index=index), True
+    if binary:
+        stream = Path(path).open(mode="wb")  # pylint: disable=consider-using-with
+    else:
+        stream = Path(path).open(mode="w", encoding="utf-8")  # pylint: disable=consider-using-with
+    return (IndexedStream(stream, path, index) if index else stream), True
+
+
+def _write_indexed(stream, data: MeasurementBatch, encode: Callable[[MeasurementBatch], Union[str, bytes]]) -> None:
+    # Writes data in blocks, so every index entry the stream asks for starts a block
+    previous = 0
+    for position in stream.boundaries(data.timestamp) + [len(data)]:
+        if position > previous:
+            stream.write(encode(data[previous:position]))
+        if position < len(data):
+            stream.mark(int(data.timestamp[position]))
+        previous = position
+
+
+class LoggerMetrics:
+    def __init__(self, data_logger: DataLogger, path: Union[str, Path, None]):
+        labels = {"logger": data_logger.__class__.__name__, "output": str(path or "-")}
+        self.samples_written = REGISTRY.counter("usb_meter_logger_samples_written_total", "Samples written",
+                                                **labels)
+        self.write_time = REGISTRY.histogram("usb_meter_logger_write_seconds",
+                                             "Time spent formatting and writing pending samples", **labels)
 
 
 class StreamDataLogger(DataLogger):
-    def __init__(self, path: Union[str, Path], latest_only: bool):
-        if path is None or path == "-":
-            self._needs_close = False
-            self._stream = sys.stdout
-        else:
-            p = Path(path)
-            self._needs_close = True
-            self._stream = p.open(mode="w", encoding="utf-8")  # pylint: disable=consider-using-with
-        self._latest_only = latest_only
+    # pylint: disable=too-many-instance-attributes
+    HEADER = "timestamp voltage_V current_A dp_V dn_V temp_C_ema energy_Ws capacity_As"
+    ROW_FORMAT = "%s.%03d+00:00 %7.5f %7.5f %5.3f %5.3f %6.3f %.6f %.6f"
+    SEPARATOR = " "
+    LINE_END = "\n"
+
+    def __init__(self, path: Union[str, Path], device_column: bool = False,
+                 flush_policy: Optional[FlushPolicy] = None, rotation: Optional[RotationPolicy] = None,
+                 index: Optional[IndexPolicy] = None):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self._device_column = device_column
+        self._stream, self._needs_close = _open_stream(path, rotation, self._write_header, index=index)
+        self._indexed = index is not None
+        self._device_names: Dict[int, str] = {}
+        self._flush_policy = flush_policy or FlushPolicy()
+        self._pending: List[MeasurementBatch] = []
+        self._pending_lines = 0
+        self._last_flush = time.monotonic()
+        self._prefix_cache = (None, b"")
+        self.metrics = LoggerMetrics(self, path)
 
     def __enter__(self):
-        self._init()
+        self._write_header(self._stream)
         return self
 
     def __exit__(self, _type, value, traceback):
+        self.flush()
         if self._needs_close:
             self._stream.close()
 
-    def _init(self) -> None:
-        self._stream.write("timestamp voltage_V current_A dp_V dn_V temp_C_ema energy_Ws capacity_As\n")
-
-    def _log_measurement(self, data: ElectricalMeasurement) -> None:
-        self._stream.write(
-            f"{data.timestamp.isoformat(timespec="milliseconds")} {data.voltage:7.5f} "
-            f"{data.current:7.5f} {data.dp:5.3f} "
-            f"{data.dn:5.3f} {data.temperature:6.3f} "
-            f"{data.energy:.6f} {data.capacity:.6f}"
-            "\n"
-        )
-
-    def log(self, data: List[ElectricalMeasurement]) -> None:
-        if self._latest_only:
-            self._log_measurement(data[-1])
-        else:
-            for measurement in data:
-                self._log_measurement(measurement)
+    def _write_header(self, stream) -> None:
+        device = " device" if self._device_column else ""
+        stream.write(f"{self.HEADER}{device}{self.LINE_END}")
+
+    def _device_name(self, device: Device) -> str:
+        # Looking up the serial number is a USB control transfer, only do it once per device
+        name = self._device_names.get(id(device))
+        if name is None:
+            name = self._device_names[id(device)] = device.serial_number
+        return name
+
+    def _timestamp_prefix(self, second: int) -> bytes:
+        # The isoformat() text up to the seconds only changes once per second
+        if self._prefix_cache[0] != second:
+            self._prefix_cache = (second, time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second)).encode("ascii"))
+        return self._prefix_cache[1]
+
+    def _add_timestamp(self, table: TextTable, timestamps: np.ndarray) -> None:
+        milliseconds = timestamps // 1_000_000
+        seconds, index = np.unique(milliseconds // 1000, return_inverse=True)
+        prefixes = np.array([self._timestamp_prefix(second) for second in seconds.tolist()])
+        table.add_strings(prefixes[index])
+        table.add_literal(".")
+        table.add_integer(milliseconds % 1000, 3, zero_pad=True)
+        table.add_literal("+00:00")
+
+    def _add_leading_fields(self, table: TextTable, data: MeasurementBatch) -> bool:
+        self._add_timestamp(table, data.timestamp)
+        return True
+
+    def _render(self, data: MeasurementBatch) -> Optional[str]:
+        # Vectorized formatting, None if some value could not be rendered identical to _format_rows
+        temperature = to_fixed_point(data.temperature, 3)
+        energy = to_fixed_point(data.energy, 6)
+        capacity = to_fixed_point(data.capacity, 6)
+        if temperature is None or energy is None or capacity is None:
+            return None
+        table = TextTable(len(data))
+        if not self._add_leading_fields(table, data):
+            return None
+        for scaled, decimals, width in ((data.raw_voltage, 5, 7), (data.raw_current, 5, 7), (data.raw_dp, 3, 5),
+                                        (data.raw_dn, 3, 5), (temperature, 3, 6), (energy, 6, 0), (capacity, 6, 0)):
+            table.add_literal(self.SEPARATOR)
+            table.add_fixed_point(scaled, decimals, width)
+        if self._device_column:
+            table.add_literal(self.SEPARATOR + self._device_name(data.device))
+        table.add_literal(self.LINE_END)
+        return table.render()
+
+    def _columns(self, data: MeasurementBatch) -> List[list]:
+        milliseconds = data.timestamp // 1_000_000
+        return [
+            [self._timestamp_prefix(second).decode("ascii") for second in (milliseconds // 1000).tolist()],
+            (milliseconds % 1000).tolist(),
+            data.voltage.tolist(),
+            data.current.tolist(),
+            data.dp.tolist(),
+            data.dn.tolist(),
+            data.temperature.tolist(),
+            data.energy.tolist(),
+            data.capacity.tolist(),
+        ]
+
+    def _format_rows(self, data: MeasurementBatch) -> str:
+        row_format = self.ROW_FORMAT
+        if self._device_column:
+            row_format += self.SEPARATOR + self._device_name(data.device).replace("%", "%%")
+        row_format += self.LINE_END
+        values = tuple(itertools.chain.from_iterable(zip(*self._columns(data))))
+        return (row_format * len(data)) % values
+
+    def _format_block(self, data: MeasurementBatch) -> str:
+        text = self._render(data)
+        return self._format_rows(data) if text is None else text
+
+    def _format(self, data: MeasurementBatch) -> str:
+        # An empty line before samples that follow a gap, which gnuplot treats as missing data
+        gaps = np.flatnonzero(data.gap)
+        if len(gaps) == 0:
+            return self._format_block(data)
+        bounds = [0] + gaps.tolist() + [len(data)]
+        return self.LINE_END.join(self._format_block(data[start:end]) if end > start else ""
+                                  for start, end in zip(bounds[:-1], bounds[1:]))
+
+    def flush(self) -> None:
+        if self._pending:
+            start_time = time.perf_counter_ns()
+            # Merged output from several meters interleaves devices, render each run of one device at once
+            texts = []
+            start = 0
+            for end in range(1, len(self._pending) + 1):
+                if end == len(self._pending) or self._pending[end].device is not self._pending[start].device:
+                    data = MeasurementBatch.concatenate(self._pending[start:end])
+                    if self._indexed:
+                        self._stream.write("".join(texts))
+                        texts.clear()
+                        _write_indexed(self._stream, data, self._format)
+                    else:
+                        texts.append(self._format(data))
+                    start = end
+            self._stream.write("".join(texts))
+            self.metrics.samples_written.inc(self._pending_lines)
+            self.metrics.write_time.observe((time.perf_counter_ns() - start_time) / 1e9)
+            self._pending.clear()
+            self._pending_lines = 0
+        self._stream.flush()
+        self._last_flush = time.monotonic()
+
+    def log(self, data: MeasurementBatch) -> None:
+        if len(data):
+            self._pending.append(data)
+            self._pending_lines += len(data)
+        if (self._pending_lines >= self._flush_policy.lines
+                or time.monotonic() - self._last_flush >= self._flush_policy.interval):
+            self.flush()
 
 
 class CSVDataLogger(StreamDataLogger):
     FIELD_NAMES = ["timestamp", "rel time", "voltage_V", "current_A", "dp_V", "dn_V", "temp_C_ema",
                    "energy_Ws", "capacity_As"]
+    # Same text csv.DictWriter produces for these fields: none of them ever needs quoting
+    ROW_FORMAT = "%s.%03d+00:00,%7.2f,%7.5f,%7.5f,%5.3f,%5.3f,%6.3f,%.6f,%.6f"
+    SEPARATOR = ","
+    LINE_END = "\r\n"
 
-    def __init__(self, path: Union[str, Path], latest_only: bool):
-        super().__init__(path, latest_only)
-        self._writer = csv.DictWriter(self._stream, fieldnames=self.FIELD_NAMES)
-        self._start_time = None
+    def __init__(self, path: Union[str, Path], device_column: bool = False,
+                 flush_policy: Optional[FlushPolicy] = None, rotation: Optional[RotationPolicy] = None,
+                 index: Optional[IndexPolicy] = None):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        super().__init__(path, device_column, flush_policy, rotation, index)
+        self._start_time: Optional[int] = None
 
-    def _init(self) -> None:
-        self._writer.writeheader()
+    def _write_header(self, stream) -> None:
+        field_names = self.FIELD_NAMES + ["device"] if self._device_column else self.FIELD_NAMES
+        csv.DictWriter(stream, fieldnames=field_names).writeheader()
 
-    def _log_measurement(self, data: ElectricalMeasurement) -> None:
+    def _relative_time(self, data: MeasurementBatch) -> np.ndarray:
+        microseconds = data.timestamp // 1000
         if self._start_time is None:
-            self._start_time = data.timestamp
-        rel_time = data.timestamp - self._start_time
-
-        entry = {
-            "timestamp": f"{data.timestamp.isoformat(timespec="milliseconds")}",
-            "rel time": f"{rel_time.total_seconds():7.2f}",
-            "voltage_V": f"{data.voltage:7.5f}",
-            "current_A": f"{data.current:7.5f}",
-            "dp_V": f"{data.dp:5.3f}",
-            "dn_V": f"{data.dn:5.3f}",
-            "temp_C_ema": f"{data.temperature:6.3f}",
-            "energy_Ws": f"{data.energy:.6f}",
-            "capacity_As": f"{data.capacity:.6f}",
-        }
-        self._writer.writerow(entry)
+            self._start_time = int(microseconds[0])
+        return (microseconds - self._start_time) / 10**6
+
+    def _add_leading_fields(self, table: TextTable, data: MeasurementBatch) -> bool:
+        relative_time = to_fixed_point(self._relative_time(data), 2)
+        if relative_time is None:
+            return False
+        self._add_timestamp(table, data.timestamp)
+        table.add_literal(self.SEPARATOR)
+        table.add_fixed_point(relative_time, 2, 7)
+        return True
+
+    def _columns(self, data: MeasurementBatch) -> List[list]:
+        columns = super()._columns(data)
+        columns.insert(2, self._relative_time(data).tolist())
+        return columns
+
+
+class BinaryDataLogger(DataLogger):
+    # pylint: disable=too-many-instance-attributes
+    # Fixed size records, see usb_meter.binary_format.BinaryLogReader for reading them back. Like the text loggers
+    # it writes once per flush, every write starts a chunk of records with an anchor.
+    def __init__(self, path: Union[str, Path], device_column: bool = False,
+                 flush_policy: Optional[FlushPolicy] = None, rotation: Optional[RotationPolicy] = None,
+                 index: Optional[IndexPolicy] = None):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        if device_column:
+            raise ValueError("binary output holds a single device, use '{serial}' in the output name")
+        self._stream, self._needs_close = _open_stream(path, rotation, self._write_header, binary=True, index=index)
+        self._indexed = index is not None
+        self._device: Optional[Device] = None
+        self._flush_policy = flush_policy or FlushPolicy()
+        self._pending: List[MeasurementBatch] = []
+        self._pending_records = 0
+        self._last_flush = time.monotonic()
+        self.metrics = LoggerMetrics(self, path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        self.flush()
+        if self._device is None:
+            self._stream.write(binary_format.encode_header(None))
+        if self._needs_close:
+            self._stream.close()
+        else:
+            self._stream.flush()
+
+    def _write_header(self, stream) -> None:
+        stream.write(binary_format.encode_header(self._device))
+
+    def flush(self) -> None:
+        if self._pending:
+            start_time = time.perf_counter_ns()
+            data = MeasurementBatch.concatenate(self._pending)
+            if self._indexed:
+                _write_indexed(self._stream, data, binary_format.encode_records)
+            else:
+                self._stream.write(binary_format.encode_records(data))
+            self.metrics.samples_written.inc(self._pending_records)
+            self.metrics.write_time.observe((time.perf_counter_ns() - start_time) / 1e9)
+            self._pending.clear()
+            self._pending_records = 0
+        self._stream.flush()
+        self._last_flush = time.monotonic()
+
+    def log(self, data: MeasurementBatch) -> None:
+        if self._device is None:
+            self._device = data.device
+            self._write_header(self._stream)
+        if len(data):
+            self._pending.append(data)
+            self._pending_records += len(data)
+        if (self._pending_records >= self._flush_policy.lines
+                or time.monotonic() - self._last_flush >= self._flush_policy.interval):
+            self.flush()
+
+
+class SQLiteDataLogger(DataLogger):
+    # pylint: disable=too-many-instance-attributes
+    # Samples in the units the meter sends them, keyed by device and timestamp (ns since epoch), and per second
+    # and per minute aggregates kept up to date with every commit. An existing database is appended to, samples
+    # it already holds (same device and timestamp) are skipped. Columns in V, A and W are in the *_values views.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS devices (
+            id INTEGER PRIMARY KEY, serial_number TEXT NOT NULL UNIQUE, vid INTEGER, pid INTEGER, model TEXT);
+        CREATE TABLE IF NOT EXISTS samples (
+            device INTEGER NOT NULL REFERENCES devices, timestamp INTEGER NOT NULL,
+            voltage INTEGER NOT NULL, current INTEGER NOT NULL, dp INTEGER NOT NULL, dn INTEGER NOT NULL,
+            temperature REAL, energy REAL, capacity REAL, gap INTEGER NOT NULL,
+            PRIMARY KEY (device, timestamp)) WITHOUT ROWID;
+        CREATE VIEW IF NOT EXISTS samples_values AS
+            SELECT serial_number AS device, timestamp, voltage / 100000.0 AS voltage_V,
+                current / 100000.0 AS current_A, dp / 1000.0 AS dp_V, dn / 1000.0 AS dn_V,
+                temperature AS temp_C_ema, energy AS energy_Ws, capacity AS capacity_As, gap
+            FROM samples JOIN devices ON devices.id = samples.device;
+    """
+    ROLLUP_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS {table} (
+            device INTEGER NOT NULL REFERENCES devices, start INTEGER NOT NULL, samples INTEGER NOT NULL,
+            voltage_min INTEGER, voltage_max INTEGER, voltage_sum INTEGER,
+            current_min INTEGER, current_max INTEGER, current_sum INTEGER, energy REAL,
+            PRIMARY KEY (device, start)) WITHOUT ROWID;
+        CREATE VIEW IF NOT EXISTS {table}_values AS
+            SELECT serial_number AS device, start, samples, voltage_min / 100000.0 AS voltage_min_V,
+                voltage_sum / 100000.0 / samples AS voltage_mean_V, voltage_max / 100000.0 AS voltage_max_V,
+                current_min / 100000.0 AS current_min_A, current_sum / 100000.0 / samples AS current_mean_A,
+                current_max / 100000.0 AS current_max_A, energy AS energy_Ws
+            FROM {table} JOIN devices ON devices.id = {table}.device;
+    """
+    ROLLUP_UPSERT = """
+        INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (device, start) DO UPDATE SET
+            samples = samples + excluded.samples,
+            voltage_min = min(voltage_min, excluded.voltage_min), voltage_max = max(voltage_max, excluded.voltage_max),
+            voltage_sum = voltage_sum + excluded.voltage_sum,
+            current_min = min(current_min, excluded.current_min), current_max = max(current_max, excluded.current_max),
+            current_sum = current_sum + excluded.current_sum, energy = energy + excluded.energy
+    """
+    ROLLUPS = {"rollup_1s": 1_000_000_000, "rollup_1min": 60_000_000_000}  # table: bucket size in ns
+
+    def __init__(self, path: Union[str, Path], device_column: bool = False,
+                 flush_policy: Optional[FlushPolicy] = None, rotation: Optional[RotationPolicy] = None,
+                 index: Optional[IndexPolicy] = None):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments,unused-argument
+        # Every row names its device, device_column makes no difference
+        if path is None or path == "-":
+            raise ValueError("sqlite output needs a file")
+        if rotation or index:
+            raise ValueError("sqlite output has no rotation or index")
+        # Meters may log from their own threads, the lock keeps them apart
+        self._connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        self._connection.executescript(self.SCHEMA + "".join(self.ROLLUP_SCHEMA.format(table=table)
+                                                             for table in self.ROLLUPS))
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._lock = threading.Lock()
+        self._device_ids: Dict[int, int] = {}
+        self._energy: Dict[int, float] = {}  # by device id, of the last sample written
+        self._flush_policy = flush_policy or FlushPolicy()
+        self._pending: Dict[int, List[MeasurementBatch]] = {}
+        self._pending_rows = 0
+        self._last_flush = time.monotonic()
+        self.metrics = LoggerMetrics(self, path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        self.flush()
+        self._connection.close()
+
+    def _device_id(self, device: Optional[Device]) -> int:
+        key = id(device)
+        if key not in self._device_ids:
+            # Batches without a device share one row with an empty serial number
+            info = device.device_info if device is not None else None
+            serial_number = str(device.serial_number or "") if device is not None else ""
+            self._connection.execute("INSERT OR IGNORE INTO devices (serial_number, vid, pid, model) "
+                                     "VALUES (?, ?, ?, ?)",
+                                     (serial_number, info.vid if info else None, info.pid if info else None,
+                                      info.model.name if info else None))
+            self._device_ids[key] = self._connection.execute("SELECT id FROM devices WHERE serial_number = ?",
+                                                             (serial_number,)).fetchone()[0]
+        return self._device_ids[key]
+
+    def log(self, data: MeasurementBatch) -> None:
+        with self._lock:
+            self._pending.setdefault(id(data.device), []).append(data)
+            self._pending_rows += len(data)
+            if (self._pending_rows >= self._flush_policy.lines
+                    or time.monotonic() - self._last_flush >= self._flush_policy.interval):
+                self._flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        # One transaction per flush, samples and aggregates are always consistent
+        self._last_flush = time.monotonic()
+        if not self._pending_rows:
+            return
+        start_time = time.perf_counter_ns()
+        batches = [MeasurementBatch.concatenate(pending) for pending in self._pending.values() if pending]
+        # Dropped whether or not the transaction succeeds, a failing batch must not fail every later flush
+        self._pending = {}
+        self._pending_rows = 0
+        energy = dict(self._energy)
+        written = 0
+        self._connection.execute("BEGIN")
+        try:
+            for data in batches:
+                device_id = self._device_id(data.device)
+                increments = data.energy_increments(energy.get(device_id))
+                energy[device_id] = float(data.energy[-1])
+                new = self._new_samples(device_id, data)
+                if not new.all():
+                    self._logger.warning("Skipped %d samples already in the database", len(new) - new.sum())
+                    data = data[new]
+                    increments = increments[new]
+                if len(data) == 0:
+                    continue
+                written += len(data)
+                self._connection.executemany(
+                    "INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    zip(itertools.repeat(device_id), data.timestamp.tolist(), data.raw_voltage.tolist(),
+                        data.raw_current.tolist(), data.raw_dp.tolist(), data.raw_dn.tolist(),
+                        data.temperature.tolist(), data.energy.tolist(), data.capacity.tolist(),
+                        data.gap.astype(np.int64).tolist()))
+                for table, bucket in self.ROLLUPS.items():
+                    self._connection.executemany(self.ROLLUP_UPSERT.format(table=table),
+                                                 self._rollup(device_id, data, increments, bucket))
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._energy = energy
+        self.metrics.samples_written.inc(written)
+        self.metrics.write_time.observe((time.perf_counter_ns() - start_time) / 1e9)
+
+    def _new_samples(self, device_id: int, data: MeasurementBatch) -> np.ndarray:
+        # Mask of the samples whose timestamp is neither in the database nor earlier in the batch
+        existing = [row[0] for row in self._connection.execute(
+            "SELECT timestamp FROM samples WHERE device = ? AND timestamp BETWEEN ? AND ?",
+            (device_id, int(data.timestamp.min()), int(data.timestamp.max())))]
+        new = ~np.isin(data.timestamp, existing)
+        _values, first = np.unique(data.timestamp, return_index=True)
+        if len(first) < len(data):
+            repeated = np.ones(len(data), dtype=bool)
+            repeated[first] = False
+            new &= ~repeated
+        return new
+
+    @staticmethod
+    def _rollup(device_id: int, data: MeasurementBatch, energy: np.ndarray, bucket: int):
+        # One row per run of samples in the same bucket, the upsert adds it to what the bucket already holds.
+        # energy: what every sample adds to the energy column
+        buckets = data.timestamp // bucket
+        starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+        voltage = data.raw_voltage.astype(np.int64)
+        current = data.raw_current.astype(np.int64)
+        return zip(itertools.repeat(device_id), (buckets[starts] * bucket).tolist(),
+                   np.diff(starts, append=len(data)).tolist(),
+                   np.minimum.reduceat(voltage, starts).tolist(), np.maximum.reduceat(voltage, starts).tolist(),
+                   np.add.reduceat(voltage, starts).tolist(),
+                   np.minimum.reduceat(current, starts).tolist(), np.maximum.reduceat(current, starts).tolist(),
+                   np.add.reduceat(current, starts).tolist(), np.add.reduceat(energy, starts).tolist())
+
+
+class StreamSummaryLogger(SummaryLogger):
+    HEADER = ("timestamp samples voltage_min_V voltage_mean_V voltage_max_V current_min_A current_mean_A "
+              "current_max_A energy_Ws temp_C_ema")
+    SEPARATOR = " "
+    LINE_END = "\n"
+
+    def __init__(self, path: Union[str, Path], device_column: bool = False,
+                 rotation: Optional[RotationPolicy] = None):
+        self._device_column = device_column
+        self._stream, self._needs_close = _open_stream(path, rotation, self._write_header)
+
+    def __enter__(self):
+        self._write_header(self._stream)
+        return self
+
+    def _write_header(self, stream) -> None:
+        header = self.HEADER.replace(" ", self.SEPARATOR)
+        device = self.SEPARATOR + "device" if self._device_column else ""
+        stream.write(f"{header}{device}{self.LINE_END}")
+
+    def __exit__(self, _type, value, traceback):
+        if self._needs_close:
+            self._stream.close()
+        else:
+            self._stream.flush()
+
+    def log_summary(self, summary: WindowSummary) -> None:
+        fields = [
+            timestamp_to_datetime(summary.start).isoformat(timespec="milliseconds"),
+            f"{summary.samples}",
+            f"{summary.voltage_min:7.5f}", f"{summary.voltage_mean:7.5f}", f"{summary.voltage_max:7.5f}",
+            f"{summary.current_min:7.5f}", f"{summary.current_mean:7.5f}", f"{summary.current_max:7.5f}",
+            f"{summary.energy:.6f}", f"{summary.temperature:6.3f}",
+        ]
+        if self._device_column:
+            fields.append(summary.device.serial_number)
+        # Summaries are few, make each one visible right away
+        self._stream.write(self.SEPARATOR.join(fields) + self.LINE_END)
+        self._stream.flush()
+
+
+class CSVSummaryLogger(StreamSummaryLogger):
+    SEPARATOR = ","
+    LINE_END = "\r\n"
 
 
 @dataclass
 class Input:
     type: str
     clazz: Type
+    summary_clazz: Optional[Type] = None
 
 
 class OutputType(Input, Enum):
-    PLAIN = "plain", StreamDataLogger
-    CSV = "csv", CSVDataLogger
+    PLAIN = "plain", StreamDataLogger, StreamSummaryLogger
+    CSV = "csv", CSVDataLogger, CSVSummaryLogger
+    BINARY = "binary", BinaryDataLogger
+    SQLITE = "sqlite", SQLiteDataLogger
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import contextlib
 import logging.config
 import sys
 import argparse
@@ -9,10 +10,26 @@ import datetime
 from ruamel.yaml import YAML
 from timelength import TimeLength, English, FailureFlags, ParserSettings
 
-from usb_meter.usb_meter import USBMeter
-from usb_meter.device import all_devices, devices_by_vid_pid, devices_by_serial_number
+from usb_meter.pacing import PacingPolicy
+from usb_meter.usb_meter import ReconnectPolicy, USBMeter
+from usb_meter.aggregation import WindowAggregator
+from usb_meter.capture import CaptureReader, CaptureWriter, replay
+from usb_meter.meter_group import MeterGroup
+from usb_meter.metrics import REGISTRY, MetricsServer
+from usb_meter.merging_data_logger import MergingDataLogger
+from usb_meter.ring_buffer import OverflowPolicy
+from usb_meter.rotation import Compression, RotationPolicy
+from usb_meter.sinks import FanOutDataLogger, SinkPolicy, TeeDataLogger
+from usb_meter.streaming_stats import StatisticsLogger, Threshold, merge_summaries, read_summary
+from usb_meter.time_index import IndexPolicy
+from usb_meter.measurement import datetime_to_timestamp, timestamp_to_datetime
+from usb_meter.trigger import CurrentTrigger
+from usb_meter.discovery import DeviceRegistry, DiscoveryCache
+from usb_meter.live_view import LiveViewLogger
+from usb_meter.fanout import DEFAULT_SOCKET, BatchPublisher, BatchSubscriber
 from stop_providers import FileStopProvider, TimeStopProvider
-from file_data_logger import OutputType
+from file_data_logger import FlushPolicy, OutputType
+from log_query import read_time_range, range_stats
 
 
 def time_length(string) -> TimeLength:
@@ -25,9 +42,31 @@ def time_length(string) -> TimeLength:
     return time_duration
 
 
+def byte_size(string) -> int:
+    # e.g. 500000, 64k, 100M, 2G
+    units = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30}
+    string = string.strip().lower().removesuffix("b")
+    if string and string[-1] in units:
+        return int(float(string[:-1]) * units[string[-1]])
+    return int(string)
+
+
+def timestamp(string) -> int:
+    # ISO 8601 (UTC unless a zone is given) or seconds since epoch, returns ns since epoch
+    try:
+        return int(float(string) * 1e9)
+    except ValueError:
+        pass
+    value = datetime.datetime.fromisoformat(string)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return datetime_to_timestamp(value)
+
+
 class Logger:
     def __init__(self):
         self._logger = logging.getLogger(self.__class__.__name__)
+        self._registry = None
 
     def _start_logging(self, args):
         log_file_name = args.logFile
@@ -49,66 +88,310 @@ class Logger:
                 del yaml_config['handlers']['file']
             logging.config.dictConfig(yaml_config)
 
-    def _device_list(self, _args):
-        devices = all_devices()
+    def _device_registry(self, args):
+        # Enumerated once per run
+        if self._registry is None:
+            cache = DiscoveryCache(args.device_cache) if args.device_cache else None
+            self._registry = DeviceRegistry(cache)
+            self._registry.refresh()
+        return self._registry
+
+    def _device_list(self, args):
+        registry = self._device_registry(args)
         self._logger.info("Available devices:")
-        for device in devices:
+        for device in registry.devices:
             sn = device.serial_number
             product = device.product_name
             manufacturer = device.manufacturer_name
             self._logger.info("- %x:%x %s %s (type: %s) SN: %s",
                               device.device_info.vid, device.device_info.pid, manufacturer,
                               product, device.device_info.model.name, sn)
+        registry.save()
 
     def _get_id_description(self, args):
-        if args.id:
-            return "vid:pid = %s" % args.id
-        if args.serial_number:
-            return "serial number = %X" % args.serial_number
-        raise RuntimeError("unknown id kind")
+        descriptions = ["vid:pid = %s" % device_id for device_id in args.id or []]
+        descriptions += ["serial number = %X" % serial_number for serial_number in args.serial_number or []]
+        if not descriptions:
+            raise RuntimeError("unknown id kind")
+        return ", ".join(descriptions)
 
     def _split_id(self, id_str):
         tokens = id_str.split(":")
         return int(tokens[0], 16), int(tokens[1], 16)
 
     def _devices_by_id(self, args):
-        if args.id:
-            vid, pid = self._split_id(args.id)
-            return devices_by_vid_pid(vid, pid)
-        if args.serial_number:
-            return devices_by_serial_number(args.serial_number)
-        return None
-
-    def _find_device(self, args):
-        devices = self._devices_by_id(args)
-        device = next(devices, None)
-        if not device:
+        registry = self._device_registry(args)
+        if getattr(args, "all", False):
+            yield from registry.devices
+            return
+        for device_id in args.id or []:
+            vid, pid = self._split_id(device_id)
+            yield from registry.by_vid_pid(vid, pid)
+        for serial_number in args.serial_number or []:
+            yield from registry.by_serial_number(serial_number)
+
+    def _find_devices(self, args):
+        select_all = getattr(args, "all", False)
+        if not (select_all or args.id or args.serial_number):
+            raise RuntimeError("No device selected, use --id or --serial-number")
+        devices = list(self._devices_by_id(args))
+        if not devices:
+            if select_all:
+                raise RuntimeError("No devices found")
             raise RuntimeError("No devices found with: %s" % self._get_id_description(args))
-        if next(devices, None):
-            raise RuntimeError("Too many devices found with: %s" % self._get_id_description(args))
-        return device
+        # A device can match several of the given ids
+        unique_devices = {(device.usb_device.bus, device.usb_device.address): device for device in devices}
+        return list(unique_devices.values())
 
     def _device_show(self, args):
-        device = self._find_device(args)
-        self._logger.info("Vendor ID:     %x", device.device_info.vid)
-        self._logger.info("Product ID:    %x", device.device_info.pid)
-        self._logger.info("Type:          %s", device.device_info.model.name)
-        self._logger.info("Serial number: %s", device.serial_number)
+        for device in self._find_devices(args):
+            self._logger.info("Vendor ID:     %x", device.device_info.vid)
+            self._logger.info("Product ID:    %x", device.device_info.pid)
+            self._logger.info("Type:          %s", device.device_info.model.name)
+            self._logger.info("Serial number: %s", device.serial_number)
 
-    def _log_data(self, args):
-        device = self._find_device(args)
+    def _stop_provider(self, args):
         if args.duration:
-            stop_provider = TimeStopProvider(datetime.timedelta(seconds=args.duration.result.seconds))
-        else:
-            stop_provider = FileStopProvider()
-        meter = USBMeter(device=device, stop_provider=stop_provider, use_crc=not args.no_crc, alpha=args.alpha)
+            return TimeStopProvider(datetime.timedelta(seconds=args.duration.result.seconds))
+        return FileStopProvider()
+
+    def _reconnect(self, args):
+        if not args.reconnect:
+            return None
+        timeout = args.reconnect_timeout.result.seconds
+        return ReconnectPolicy(stall_timeout=datetime.timedelta(seconds=args.stall_timeout.result.seconds),
+                               timeout=datetime.timedelta(seconds=timeout) if timeout else None)
+
+    def _pacing(self, args):
+        return PacingPolicy(adaptive=args.pacing == "adaptive",
+                            max_interval=datetime.timedelta(seconds=args.max_request_interval.result.seconds))
+
+    def _trigger(self, args):
+        # Every meter gets its own trigger, they keep per device state
+        if getattr(args, "trigger_start", None) is None:
+            return None
+        stop_current = args.trigger_start if args.trigger_stop is None else args.trigger_stop
+        return CurrentTrigger(args.trigger_start, stop_current,
+                              datetime.timedelta(seconds=args.trigger_hold.result.seconds),
+                              datetime.timedelta(seconds=args.pre_trigger.result.seconds),
+                              once=args.trigger_once)
+
+    def _metrics(self, args) -> contextlib.ExitStack:
+        stack = contextlib.ExitStack()
+        if getattr(args, "metrics_port", None) is not None:
+            stack.enter_context(MetricsServer(args.metrics_port))
+        if getattr(args, "metrics_file", None):
+            stack.callback(REGISTRY.write, args.metrics_file)
+        return stack
+
+    def _rotation(self, args):
+        if args.rotate_size is None and args.rotate_interval is None:
+            if args.compress != Compression.NONE.value or args.keep is not None:
+                raise RuntimeError("--compress and --keep need --rotate-size or --rotate-interval")
+            return None
+        interval = args.rotate_interval.result.seconds if args.rotate_interval else None
+        return RotationPolicy(max_bytes=args.rotate_size, interval=interval,
+                              compression=Compression(args.compress), max_segments=args.keep)
+
+    def _index(self, args):
+        if args.index_interval is None and args.index_records is None:
+            return None
+        interval = args.index_interval.result.seconds if args.index_interval else None
+        return IndexPolicy(interval=interval, records=args.index_records)
+
+    def _parse_output(self, args, output):
+        # [TYPE[@WINDOW][,buffer=BATCHES][,overflow=POLICY]:]PATH, what the prefix leaves out comes from --type,
+        # --window, --sink-buffer and --sink-overflow
+        sink = SinkPolicy(args.sink_buffer, OverflowPolicy(args.sink_overflow))
+        prefix, separator, path = output.partition(":")
+        type_spec, *options = prefix.split(",")
+        type_name, _, window = type_spec.partition("@")
+        if not separator or type_name.lower() not in [_type.type for _type in OutputType]:
+            return OutputType[args.type.upper()], args.window, output, sink
+        for option in options:
+            name, _, value = option.partition("=")
+            if name == "buffer" and value.isdigit():
+                sink.capacity = int(value)
+            elif name == "overflow" and value in [policy.value for policy in OverflowPolicy]:
+                sink.overflow = OverflowPolicy(value)
+            else:
+                raise RuntimeError("invalid option '%s' for output %s" % (option, path))
+        return OutputType[type_name.upper()], time_length(window) if window else None, path, sink
+
+    def _open_output(self, args, output, device_column=False):
+        output_type, window, path, _ = self._parse_output(args, output)
+        rotation = self._rotation(args)
+        index = self._index(args)
+        if window:
+            if not output_type.summary_clazz:
+                raise RuntimeError("--window is not supported for output type %s" % output_type.type)
+            if index:
+                raise RuntimeError("--window output has no index")
+            window = datetime.timedelta(seconds=window.result.seconds)
+            return WindowAggregator(output_type.summary_clazz(path, device_column=device_column, rotation=rotation),
+                                    window)
+        flush_policy = FlushPolicy(lines=args.flush_lines, interval=args.flush_interval)
+        return output_type.clazz(path, device_column=device_column, flush_policy=flush_policy,
+                                 rotation=rotation, index=index)
+
+    def _open_outputs(self, args, outputs, device_column=False):
+        # One data logger writing to all outputs, several ones are written by their own threads
+        if len(outputs) == 1:
+            return self._open_output(args, outputs[0], device_column)
+        return FanOutDataLogger([self._open_output(args, output, device_column) for output in outputs], outputs,
+                                [self._parse_output(args, output)[3] for output in outputs])
+
+    def _summary(self, args):
+        devices = merge_summaries([read_summary(path) for path in args.files], by_device=not args.merge_devices)
+        for device in devices:
+            print("device          %s" % device.serial_number)
+            print("samples         %d" % device.samples)
+            print("gaps            %d" % device.gaps)
+            if device.start is not None:
+                print("start           %s" % timestamp_to_datetime(device.start).isoformat(timespec="milliseconds"))
+                print("end             %s" % timestamp_to_datetime(device.end).isoformat(timespec="milliseconds"))
+            print("duration_s      %.3f" % device.duration)
+            print("energy_Ws       %.6f" % device.energy)
+            print("capacity_As     %.6f" % device.capacity)
+            for name, unit in (("voltage", "V"), ("current", "A"), ("power", "W")):
+                channel = device.channels[name]
+                values = [("min", channel.min), ("mean", channel.mean), ("std", channel.std), ("max", channel.max)]
+                values += [("p%g" % (100 * q), channel.quantile(q)) for q in (0.5, 0.9, 0.99, 0.999)]
+                for statistic, value in values:
+                    print("%-15s %.5f" % ("%s_%s_%s" % (name, statistic, unit), value))
+            for threshold, seconds in sorted(device.threshold_time.items()):
+                print("%-15s %.3f" % ("time_%s_s" % threshold, seconds))
+            print()
+
+    def _query(self, args):
+        ranges = [read_time_range(path, args.start, args.end) for path in args.files]
+        if len({data.log_format for data in ranges}) > 1:
+            raise RuntimeError("Cannot query files of different types at once")
+        if args.stats:
+            stats = range_stats(ranges)
+            if stats is None:
+                raise RuntimeError("No samples in the given time range")
+            print("samples         %d" % stats.samples)
+            print("start           %s" % timestamp_to_datetime(stats.start).isoformat(timespec="milliseconds"))
+            print("end             %s" % timestamp_to_datetime(stats.end).isoformat(timespec="milliseconds"))
+            print("energy_Ws       %.6f" % stats.energy)
+            print("capacity_As     %.6f" % stats.capacity)
+            print("voltage_mean_V  %.5f" % stats.voltage_mean)
+            print("voltage_min_V   %.5f" % stats.voltage_min)
+            print("voltage_max_V   %.5f" % stats.voltage_max)
+            print("current_mean_A  %.5f" % stats.current_mean)
+            print("current_max_A   %.5f" % stats.current_max)
+            print("power_max_W     %.5f" % stats.power_max)
+            return
+        with contextlib.ExitStack() as stack:
+            if args.output == "-":
+                stream = sys.stdout.buffer
+            else:
+                stream = stack.enter_context(Path(args.output).open("wb"))
+            stream.write(ranges[0].header)
+            for data in ranges:
+                stream.write(data.rows)
+            stream.flush()
+
+    def _capture(self, args):
+        devices = self._find_devices(args)
+        if len(devices) > 1:
+            raise RuntimeError("Too many devices found with: %s" % self._get_id_description(args))
+        meter = USBMeter(device=devices[0], stop_provider=self._stop_provider(args),
+                         buffer_size=args.buffer_size, overflow_policy=OverflowPolicy(args.overflow),
+                         reconnect=self._reconnect(args), pacing=self._pacing(args))
         meter.setup_device()
         meter.print_device_info()
-        output_type = OutputType[args.type.upper()]
-        with output_type.clazz(args.output, args.latest_only) as data_logger:
-            meter.run(data_logger)
+        with CaptureWriter(args.output, devices[0]) as capture_writer:
+            meter.capture(capture_writer)
 
-    def main(self):
+    def _replay(self, args):
+        reader = CaptureReader(args.capture)
+        self._logger.info("Replaying %d packets from %s (SN: %s)", len(reader), args.capture,
+                          reader.device.serial_number)
+        meter = USBMeter(device=reader.device, stop_provider=None, use_crc=not args.no_crc, alpha=args.alpha,
+                         trigger=self._trigger(args), latest_only=args.latest_only)
+        self._with_outputs(args, [reader.device],
+                           lambda data_loggers: replay(reader, meter, data_loggers[0], args.realtime))
+
+    def _open_meters(self, args):
+        devices = self._find_devices(args)
+        stop_provider = self._stop_provider(args)
+        meters = []
+        for device in devices:
+            meter = USBMeter(device=device, stop_provider=stop_provider, use_crc=not args.no_crc, alpha=args.alpha,
+                             buffer_size=args.buffer_size, overflow_policy=OverflowPolicy(args.overflow),
+                             trigger=self._trigger(args), reconnect=self._reconnect(args),
+                             pacing=self._pacing(args), latest_only=args.latest_only)
+            meter.setup_device()
+            meter.print_device_info()
+            meters.append(meter)
+        return meters
+
+    def _with_outputs(self, args, devices, run):
+        # Calls run with one data logger per device: a single output, one per device ({serial}) or merged.
+        # With --summary and --live, the statistics and live view are fed as well.
+        outputs = args.output or ["-"]
+        with contextlib.ExitStack() as stack:
+            if args.summary:
+                run = self._tapped(run, stack.enter_context(StatisticsLogger(
+                    args.summary, args.summary_interval.result.seconds, args.threshold or [])))
+            if args.live:
+                span = datetime.timedelta(seconds=args.live_span.result.seconds) if args.live_span else None
+                run = self._tapped(run, stack.enter_context(LiveViewLogger(
+                    args.live, args.live_interval.result.seconds, span, args.live_points)))
+            self._run_outputs(args, outputs, devices, run)
+
+    @staticmethod
+    def _tapped(run, tap):
+        # run, with every batch also logged to tap
+        return lambda data_loggers: run([TeeDataLogger([data_logger, tap]) for data_logger in data_loggers])
+
+    def _run_outputs(self, args, outputs, devices, run):
+        if any("{serial}" in output for output in outputs):
+            with contextlib.ExitStack() as stack:
+                run([stack.enter_context(self._open_outputs(args, [output.replace("{serial}", device.serial_number)
+                                                                   for output in outputs]))
+                     for device in devices])
+        elif len(devices) == 1:
+            with self._open_outputs(args, outputs) as data_logger:
+                run([data_logger])
+        else:
+            with self._open_outputs(args, outputs, device_column=True) as data_logger:
+                merger = MergingDataLogger(data_logger, len(devices))
+                try:
+                    run([merger] * len(devices))
+                finally:
+                    merger.flush()
+
+    def _log_data(self, args):
+        meters = self._open_meters(args)
+
+        def run(data_loggers):
+            if len(meters) == 1:
+                meters[0].run(data_loggers[0])
+            else:
+                MeterGroup(meters, data_loggers).run()
+        self._with_outputs(args, [meter.device for meter in meters], run)
+
+    def _serve(self, args):
+        meters = self._open_meters(args)
+        history = datetime.timedelta(seconds=args.history.result.seconds)
+        with BatchPublisher(args.socket, [meter.device for meter in meters], history=history) as publisher:
+            self._logger.info("Serving %d meter(s) on %s", len(meters), args.socket)
+            MeterGroup(meters, [publisher] * len(meters)).run()
+
+    def _subscribe(self, args):
+        with BatchSubscriber(args.socket) as subscriber:
+            self._logger.info("Subscribed to %s: %s", args.socket,
+                              ", ".join(device.serial_number for device in subscriber.devices))
+            try:
+                self._with_outputs(args, subscriber.devices, subscriber.run)
+            except KeyboardInterrupt:
+                self._logger.info("Keyboard interrupt received -> stopping...")
+
+    def _create_parser(self):
+        # pylint: disable=too-many-locals,too-many-statements
         parser = argparse.ArgumentParser(prog="um120_logger")
         default = ' (default: %(default)s)'
         parser.add_argument('-v', '--verbose', action='count', default=1, help="set the verbosity level" + default)
@@ -116,36 +399,201 @@ class Logger:
         subparsers = parser.add_subparsers(required=True, dest="subcommand", title='subcommands',
                                            description='valid subcommands', help='sub-command help')
 
-        id_parser = argparse.ArgumentParser(add_help=False)
-        id_group = id_parser.add_mutually_exclusive_group(required=True)
-        id_group.add_argument('--id', help="Device vendorid:productid")
-        id_group.add_argument('--serial-number', type=lambda x: int(x, 16), help="Device serial number")
-
-        parser_log = subparsers.add_parser('log', parents=[id_parser], help="log power data")
-        parser_log.add_argument("--no-crc", action="store_true", help="Disable CRC checks")
-        parser_log.add_argument("--alpha", type=float, default=0.9, help="Temperature EMA factor")
-        parser_log.add_argument("-o", "--output", default="-", help="Output file, or '-' for stdout (default).")
-        parser_log.add_argument('-t', '--type',
-                            choices=[_type.type.lower() for _type in OutputType],
-                            default=OutputType.CSV.name.lower(), help="Select output file type" + default)
-        parser_log.add_argument("--latest-only", action="store_true", help="Only log the latest measurement per batch")
-        parser_log.add_argument("--duration", type=time_length, default="10s",
-                                help="Log duration (0 for infinite)" + default)
+        discovery_parser = argparse.ArgumentParser(add_help=False)
+        discovery_parser.add_argument("--device-cache", metavar="FILE",
+                                      help="Remember serial numbers of connected meters in this file, so they are "
+                                           "found without asking every meter")
+
+        id_parser = argparse.ArgumentParser(add_help=False, parents=[discovery_parser])
+        id_group = id_parser.add_argument_group("device selection")
+        id_group.add_argument('--id', action="append", help="Device vendorid:productid (can be repeated)")
+        id_group.add_argument('--serial-number', type=lambda x: int(x, 16), action="append",
+                              help="Device serial number (can be repeated)")
+
+        acquisition_parser = argparse.ArgumentParser(add_help=False)
+        acquisition_parser.add_argument("--buffer-size", type=int, default=4096,
+                                        help="Number of USB packets buffered between reader and output" + default)
+        acquisition_parser.add_argument("--overflow", choices=[policy.value for policy in OverflowPolicy],
+                                        default=OverflowPolicy.BLOCK.value,
+                                        help="What to do when the packet buffer is full" + default)
+        acquisition_parser.add_argument("--duration", type=time_length, default="10s",
+                                        help="Log duration (0 for infinite)" + default)
+        acquisition_parser.add_argument("--pacing", choices=["adaptive", "fixed"], default="adaptive",
+                                        help="Send requests for more data at the interval known for the model "
+                                             "(fixed) or as rarely as the meter allows (adaptive)" + default)
+        acquisition_parser.add_argument("--max-request-interval", type=time_length, default="1s",
+                                        help="Longest time between two requests with adaptive pacing" + default)
+        reconnect_group = acquisition_parser.add_argument_group("reconnect")
+        reconnect_group.add_argument("--reconnect", action="store_true",
+                                     help="Find the meter again by its serial number after a USB error or stall, "
+                                          "instead of exiting")
+        reconnect_group.add_argument("--stall-timeout", type=time_length, default="1s",
+                                     help="With --reconnect, time without data after which the meter counts as "
+                                          "stalled" + default)
+        reconnect_group.add_argument("--reconnect-timeout", type=time_length, default="0s",
+                                     help="Give up when the meter did not come back within this time (0 for "
+                                          "never)" + default)
+
+        decoding_parser = argparse.ArgumentParser(add_help=False)
+        decoding_parser.add_argument("--no-crc", action="store_true", help="Disable CRC checks")
+        decoding_parser.add_argument("--alpha", type=float, default=0.9, help="Temperature EMA factor")
+        decoding_parser.add_argument("--latest-only", action="store_true",
+                                     help="Only log the latest measurement per report")
+
+        output_parser = argparse.ArgumentParser(add_help=False)
+        output_parser.add_argument('-t', '--type',
+                                   choices=[_type.type.lower() for _type in OutputType],
+                                   default=OutputType.CSV.name.lower(), help="Select output file type" + default)
+        output_parser.add_argument("--window", type=time_length,
+                                   help="Instead of every sample, output min/mean/max voltage and current, energy and "
+                                        "temperature per time window (e.g. 1s, 1min)")
+        output_parser.add_argument("--flush-lines", type=int, default=FlushPolicy.lines,
+                                   help="Write the output once this many samples are pending" + default)
+        output_parser.add_argument("--flush-interval", type=float, default=FlushPolicy.interval,
+                                   help="Write the output at least every this many seconds" + default)
+        sink_group = output_parser.add_argument_group("multiple outputs")
+        sink_group.add_argument("--sink-buffer", type=int, default=1024, metavar="BATCHES",
+                                help="With several outputs, batches queued per output before --sink-overflow "
+                                     "applies, 'buffer=' in an output prefix sets it for one output" + default)
+        sink_group.add_argument("--sink-overflow", choices=[policy.value for policy in OverflowPolicy],
+                                default=OverflowPolicy.BLOCK.value,
+                                help="What to do when an output falls behind: wait for it (block), which holds up the "
+                                     "others once its queue is full, or drop data for it. 'overflow=' in an output "
+                                     "prefix sets it for one output" + default)
+        statistics_group = output_parser.add_argument_group("statistics")
+        statistics_group.add_argument("--summary", metavar="FILE",
+                                      help="Keep min/mean/max/std, percentiles and energy per device and write them to "
+                                           "FILE (JSON, see 'summary') periodically and on exit")
+        statistics_group.add_argument("--summary-interval", type=time_length, default="60s",
+                                      help="How often to write the summary" + default)
+        statistics_group.add_argument("--threshold", type=Threshold.parse, action="append",
+                                      help="Also sum up the time a condition held, e.g. current>0.5 or voltage<4.75 "
+                                           "(can be repeated)")
+        live_group = output_parser.add_argument_group("live view")
+        live_group.add_argument("--live", metavar="FILE",
+                                help="Keep min/mean/max voltage and current of the run at a few resolutions in "
+                                     "memory and rewrite FILE with at most --live-points lines per device "
+                                     "periodically, for live plotting")
+        live_group.add_argument("--live-span", type=time_length, metavar="DURATION",
+                                help="Only show the last DURATION (e.g. 10min) instead of the whole run")
+        live_group.add_argument("--live-points", type=int, default=1000,
+                                help="Lines per device, the resolution of the plot" + default)
+        live_group.add_argument("--live-interval", type=time_length, default="1s",
+                                help="How often to rewrite the live view file" + default)
+        rotation_group = output_parser.add_argument_group("rotation")
+        rotation_group.add_argument("--rotate-size", type=byte_size, metavar="SIZE",
+                                    help="Start a new output file once it reaches this size (e.g. 100M)")
+        rotation_group.add_argument("--rotate-interval", type=time_length, metavar="DURATION",
+                                    help="Start a new output file after this time (e.g. 1h)")
+        rotation_group.add_argument("--compress", choices=[compression.value for compression in Compression],
+                                    default=Compression.NONE.value,
+                                    help="Compress finished output files in the background" + default)
+        rotation_group.add_argument("--keep", type=int, metavar="COUNT",
+                                    help="Delete the oldest output files, keeping this many besides the current one")
+        index_group = output_parser.add_argument_group("index")
+        index_group.add_argument("--index-interval", type=time_length, metavar="DURATION",
+                                 help="Write a sidecar index (<output>.idx) with an entry every DURATION (e.g. 10s), "
+                                      "for fast 'query' of time ranges")
+        index_group.add_argument("--index-records", type=int, metavar="COUNT",
+                                 help="Write a sidecar index with an entry every COUNT samples")
+
+        decode_parser = argparse.ArgumentParser(add_help=False, parents=[decoding_parser, output_parser])
+        trigger_group = decode_parser.add_argument_group("trigger")
+        trigger_group.add_argument("--trigger-start", type=float, metavar="AMPERE",
+                                   help="Only output data once the current rises above this value")
+        trigger_group.add_argument("--trigger-stop", type=float, metavar="AMPERE",
+                                   help="Stop output when the current stays below this value for --trigger-hold "
+                                        "(default: --trigger-start)")
+        trigger_group.add_argument("--trigger-hold", type=time_length, default="0s",
+                                   help="How long the current has to stay below --trigger-stop" + default)
+        trigger_group.add_argument("--pre-trigger", type=time_length, default="0s",
+                                   help="Also output the data of this period before the trigger started" + default)
+        trigger_group.add_argument("--trigger-once", action="store_true",
+                                   help="Exit when the trigger stops instead of waiting for the next start")
+
+        metrics_parser = argparse.ArgumentParser(add_help=False)
+        metrics_group = metrics_parser.add_argument_group("metrics")
+        metrics_group.add_argument("--metrics-port", type=int,
+                                   help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+        metrics_group.add_argument("--metrics-file", help="Write the metrics to this file on exit")
+
+        parser_log = subparsers.add_parser('log', parents=[id_parser, acquisition_parser, decode_parser,
+                                                           metrics_parser],
+                                           help="log power data")
+        parser_log.add_argument("--all", action="store_true", help="Log all connected devices")
+        parser_log.add_argument("-o", "--output", action="append", metavar="[TYPE[@WINDOW][,OPTION=VALUE]:]PATH",
+                                help="Output file, or '-' for stdout (default). With several devices the output is "
+                                     "merged in time order, unless the name contains '{serial}' to get one file "
+                                     "per device. Can be repeated, a prefix like 'csv:' or 'csv@1min:' overrides "
+                                     "--type and --window for this output, 'csv,buffer=4096,overflow=drop-oldest:' "
+                                     "also --sink-buffer and --sink-overflow.")
         parser_log.set_defaults(func=self._log_data)
 
+        parser_serve = subparsers.add_parser('serve', parents=[id_parser, acquisition_parser, decoding_parser,
+                                                               metrics_parser],
+                                             help="keep meters open and share their data with 'subscribe' processes")
+        parser_serve.add_argument("--all", action="store_true", help="Serve all connected devices")
+        parser_serve.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix domain socket to serve on" + default)
+        parser_serve.add_argument("--history", type=time_length, default="60s",
+                                  help="Data sent to a new subscriber before the live data" + default)
+        parser_serve.set_defaults(func=self._serve, duration="0s")
+
+        parser_subscribe = subparsers.add_parser('subscribe', parents=[output_parser, metrics_parser],
+                                                 help="log the data of a running 'serve'")
+        parser_subscribe.add_argument("--socket", default=DEFAULT_SOCKET,
+                                      help="Socket of the 'serve' process" + default)
+        parser_subscribe.add_argument("-o", "--output", action="append", metavar="[TYPE[@WINDOW][,OPTION=VALUE]:]PATH",
+                                      help="Output file, or '-' for stdout (default), can be repeated like with 'log'")
+        parser_subscribe.set_defaults(func=self._subscribe)
+
+        parser_capture = subparsers.add_parser('capture', parents=[id_parser, acquisition_parser, metrics_parser],
+                                               help="record raw USB packets for a later replay")
+        parser_capture.add_argument("-o", "--output", required=True, help="Capture file")
+        parser_capture.set_defaults(func=self._capture)
+
+        parser_replay = subparsers.add_parser('replay', parents=[decode_parser, metrics_parser],
+                                              help="decode a capture file")
+        parser_replay.add_argument("capture", help="Capture file")
+        parser_replay.add_argument("-o", "--output", action="append", metavar="[TYPE[@WINDOW][,OPTION=VALUE]:]PATH",
+                                   help="Output file, or '-' for stdout (default), can be repeated like with 'log'")
+        parser_replay.add_argument("--realtime", action="store_true",
+                                   help="Replay at the original speed instead of as fast as possible")
+        parser_replay.set_defaults(func=self._replay)
+
+        parser_query = subparsers.add_parser('query', help="read a time range from logged files")
+        parser_query.add_argument("files", nargs="+",
+                                  help="Log files (plain, csv or binary, also rotated and compressed segments)")
+        parser_query.add_argument("--start", type=timestamp,
+                                  help="First time to include, ISO 8601 (UTC if no zone is given) or epoch seconds")
+        parser_query.add_argument("--end", type=timestamp, help="Time to stop at (exclusive)")
+        parser_query.add_argument("--stats", action="store_true",
+                                  help="Print energy, capacity and voltage / current statistics of the range instead "
+                                       "of the samples")
+        parser_query.add_argument("-o", "--output", default="-", help="Output file, or '-' for stdout (default).")
+        parser_query.set_defaults(func=self._query)
+
+        parser_summary = subparsers.add_parser('summary', help="print and merge statistics written with --summary")
+        parser_summary.add_argument("files", nargs="+", help="Summary files, e.g. of several runs")
+        parser_summary.add_argument("--merge-devices", action="store_true",
+                                    help="Add up all devices instead of showing each serial number on its own")
+        parser_summary.set_defaults(func=self._summary)
+
         parser_device = subparsers.add_parser('device', help="device commands")
         device_subparsers = parser_device.add_subparsers(required=True, dest="subcommand", title='subcommands',
                                                          description='valid subcommands', help='sub-command help')
-        parser_device_list = device_subparsers.add_parser('list', help="List devices")
+        parser_device_list = device_subparsers.add_parser('list', parents=[discovery_parser], help="List devices")
         parser_device_list.set_defaults(func=self._device_list)
         parser_device_show = device_subparsers.add_parser('show', parents=[id_parser], help="Show device details")
         parser_device_show.set_defaults(func=self._device_show)
+        return parser
 
-        args = parser.parse_args()
+    def main(self):
+        args = self._create_parser().parse_args()
 
         self._start_logging(args)
         try:
-            args.func(args)
+            with self._metrics(args):
+                args.func(args)
             return 0
         except Exception as e:  # pylint: disable=broad-exception-caught
             self._logger.exception("Error: %s", e)
@@ -0,0 +1,139 @@
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from typing import Optional, Sequence, Union
+
+import numpy as np
+
+from usb_meter import binary_format
+from usb_meter.measurement import MeasurementBatch
+from usb_meter.streaming_stats import sample_intervals
+from usb_meter.time_index import read_range
+
+# Reads a time range back from the files written by file_data_logger. With a sidecar index (--index-interval)
+# only the blocks around the range are read and decompressed, otherwise the whole file.
+
+
+class LogFormat(Enum):
+    PLAIN = "plain"
+    CSV = "csv"
+    BINARY = "binary"
+
+
+@dataclass
+class RangeData:
+    # pylint: disable=too-many-instance-attributes
+    log_format: LogFormat
+    header: bytes
+    rows: bytes             # the samples in the range, in the format of the file
+    timestamp: np.ndarray   # int64, ns since epoch
+    voltage: np.ndarray
+    current: np.ndarray
+    energy: np.ndarray
+    capacity: np.ndarray
+    gap: np.ndarray         # bool, samples were lost right before this one
+
+
+@dataclass
+class RangeStats:
+    # pylint: disable=too-many-instance-attributes
+    samples: int
+    start: int      # ns since epoch
+    end: int
+    energy: float   # Ws
+    capacity: float  # As
+    voltage_mean: float
+    voltage_min: float
+    voltage_max: float
+    current_mean: float
+    current_max: float
+    power_max: float
+
+
+def _detect_format(data: bytes) -> LogFormat:
+    if data.startswith(binary_format.MAGIC):
+        return LogFormat.BINARY
+    first_line = data.split(b"\n", 1)[0]
+    return LogFormat.CSV if b"," in first_line else LogFormat.PLAIN
+
+
+def _read_binary(header: bytes, data: bytes, start: Optional[int], end: Optional[int]) -> RangeData:
+    if not header:
+        header, data = data[:binary_format.HEADER_SIZE], data[binary_format.HEADER_SIZE:]
+    # Index entries and segments start with an anchor, the range is encoded again from its first sample
+    columns = binary_format.decode_records(data)
+    first = 0 if start is None else int(np.searchsorted(columns["timestamp"], start))
+    last = len(columns["timestamp"]) if end is None else int(np.searchsorted(columns["timestamp"], end))
+    records = MeasurementBatch(None, **{name: column[first:last] for name, column in columns.items()})
+    return RangeData(LogFormat.BINARY, header, binary_format.encode_records(records), records.timestamp,
+                     records.raw_voltage / MeasurementBatch.VOLTAGE_SCALE,
+                     records.raw_current / MeasurementBatch.CURRENT_SCALE,
+                     records.energy, records.capacity, records.gap)
+
+
+def _read_text(log_format: LogFormat, header: bytes, data: bytes, start: Optional[int],
+               end: Optional[int]) -> RangeData:
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    lines = data.split(b"\n")
+    if not header:
+        header = lines[0] + b"\n"
+    # Only sample lines start with the year, skip the header and a partial line at the end. An empty line
+    # marks a gap before the next sample.
+    gap = [index > 0 and not lines[index - 1].strip() for index, line in enumerate(lines)
+           if line[:1].isdigit() and len(line) > 29]
+    lines = [line for line in lines if line[:1].isdigit() and len(line) > 29]
+    timestamps = np.array([line[:23] for line in lines], dtype="S23").astype("datetime64[ms]").astype(np.int64)
+    timestamps *= 1_000_000
+    selected = np.ones(len(lines), dtype=bool)
+    if start is not None:
+        selected &= timestamps >= start
+    if end is not None:
+        selected &= timestamps < end
+    lines = [line for line, keep in zip(lines, selected.tolist()) if keep]
+    separator, first_column = (b",", 2) if log_format == LogFormat.CSV else (b" ", 1)
+    fields = [line.split(separator) for line in lines]
+    columns = [np.array([row[first_column + offset] for row in fields], dtype=np.float64) for offset in (0, 1, 5, 6)]
+    rows = b"".join(line + b"\n" for line in lines)
+    return RangeData(log_format, header, rows, timestamps[selected], *columns, np.array(gap, dtype=bool)[selected])
+
+
+def read_time_range(path: Union[str, Path], start: Optional[int] = None, end: Optional[int] = None) -> RangeData:
+    # Samples from start (inclusive) to end (exclusive), ns since epoch, None for no limit
+    header, data = read_range(path, start, end)
+    log_format = _detect_format(header or data)
+    if log_format == LogFormat.BINARY:
+        return _read_binary(header, data, start, end)
+    return _read_text(log_format, header, data, start, end)
+
+
+def range_stats(ranges: Sequence[RangeData]) -> Optional[RangeStats]:
+    ranges = [data for data in ranges if len(data.timestamp)]
+    if len(ranges) == 0:
+        return None
+    energy = 0.0
+    capacity = 0.0
+    for data in ranges:
+        # Like the --summary statistics: differences of the energy and capacity columns, every file and segment
+        # starts afresh
+        intervals, starts = sample_intervals(data.timestamp, data.gap, data.energy)
+        energy += float(np.where(starts, data.voltage * data.current * intervals,
+                                 np.diff(data.energy, prepend=data.energy[0])).sum())
+        capacity += float(np.where(starts, data.current * intervals,
+                                   np.diff(data.capacity, prepend=data.capacity[0])).sum())
+    timestamps = np.concatenate([data.timestamp for data in ranges])
+    voltage = np.concatenate([data.voltage for data in ranges])
+    current = np.concatenate([data.current for data in ranges])
+    power = voltage * current
+    return RangeStats(
+        samples=len(timestamps),
+        start=int(timestamps.min()),
+        end=int(timestamps.max()),
+        energy=energy,
+        capacity=capacity,
+        voltage_mean=float(voltage.mean()),
+        voltage_min=float(voltage.min()),
+        voltage_max=float(voltage.max()),
+        current_mean=float(current.mean()),
+        current_max=float(current.max()),
+        power_max=float(power.max()),
+    )
@@ -1,10 +1,10 @@
-from .measurement import ElectricalMeasurement
+from .measurement import ElectricalMeasurement, MeasurementBatch
 from .stop_provider import StopProvider
 from .data_logger import DataLogger
 from .device import all_devices, devices_by_vid_pid, devices_by_serial_number
 from .usb_meter import USBMeter
 
 __all__ = [
-        "ElectricalMeasurement", "StopProvider", "DataLogger", "USBMeter",
+        "ElectricalMeasurement", "MeasurementBatch", "StopProvider", "DataLogger", "USBMeter",
         "all_devices", "devices_by_vid_pid", "devices_by_serial_number",
         ]
@@ -0,0 +1,132 @@
+from dataclasses import dataclass
+import datetime
+from typing import Dict, Optional
+
+import numpy as np
+
+from .data_logger import DataLogger
+from .device import Device
+from .measurement import MeasurementBatch
+
+# pylint: disable=too-many-instance-attributes
+
+
+@dataclass
+class WindowSummary:
+    device: Device
+    start: int                 # window start, ns since epoch (UTC)
+    duration: int              # ns
+    samples: int
+    voltage_min: float
+    voltage_max: float
+    voltage_mean: float
+    current_min: float
+    current_max: float
+    current_mean: float
+    energy: float              # Ws integrated over the window
+    temperature: float         # last EMA filtered temperature
+
+
+class SummaryLogger:
+    def log_summary(self, summary: WindowSummary) -> None:
+        pass
+
+
+class _Window:
+    # Running aggregates of one window, constant size no matter how many samples it covers
+    def __init__(self, index: int):
+        self.index = index
+        self.samples = 0
+        self.voltage_sum = 0.0
+        self.voltage_min = np.inf
+        self.voltage_max = -np.inf
+        self.current_sum = 0.0
+        self.current_min = np.inf
+        self.current_max = -np.inf
+        self.energy = 0.0
+        self.temperature = np.nan
+
+    def add(self, data: MeasurementBatch, energy_increments: np.ndarray) -> None:
+        voltage = data.voltage
+        current = data.current
+        self.samples += len(data)
+        self.voltage_sum += float(voltage.sum())
+        self.voltage_min = min(self.voltage_min, float(voltage.min()))
+        self.voltage_max = max(self.voltage_max, float(voltage.max()))
+        self.current_sum += float(current.sum())
+        self.current_min = min(self.current_min, float(current.min()))
+        self.current_max = max(self.current_max, float(current.max()))
+        self.energy += float(energy_increments.sum())
+        self.temperature = float(data.temperature[-1])
+
+    def summary(self, device: Device, duration: int) -> WindowSummary:
+        return WindowSummary(
+            device=device,
+            start=self.index * duration,
+            duration=duration,
+            samples=self.samples,
+            voltage_min=self.voltage_min,
+            voltage_max=self.voltage_max,
+            voltage_mean=self.voltage_sum / self.samples,
+            current_min=self.current_min,
+            current_max=self.current_max,
+            current_mean=self.current_sum / self.samples,
+            energy=self.energy,
+            temperature=self.temperature,
+        )
+
+
+class WindowAggregator(DataLogger):
+    # Reduces the sample stream to one WindowSummary per device and window. Windows are aligned to multiples
+    # of their duration since the epoch, e.g. 1 minute windows start on full minutes.
+    def __init__(self, summary_logger: SummaryLogger, window: datetime.timedelta):
+        if window <= datetime.timedelta():
+            raise ValueError("window must be positive")
+        self._summary_logger = summary_logger
+        self._duration = window // datetime.timedelta(microseconds=1) * 1000
+        self._windows: Dict[int, _Window] = {}
+        self._devices: Dict[int, Device] = {}
+        self._energy: Dict[int, float] = {}  # energy column of the last sample per device
+
+    def __enter__(self):
+        self._summary_logger.__enter__()
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        self.flush()
+        return self._summary_logger.__exit__(_type, value, traceback)
+
+    def log(self, data: MeasurementBatch) -> None:
+        if len(data) == 0:
+            return
+        key = id(data.device)
+        self._devices[key] = data.device
+        # The energy column already integrates over the actual sample intervals, gaps included
+        energy_increments = data.energy_increments(self._energy.get(key))
+        self._energy[key] = float(data.energy[-1])
+        indices = data.timestamp // self._duration
+        # Usually a batch falls into a single window, otherwise handle it in runs of the same window
+        starts = np.flatnonzero(np.diff(indices, prepend=indices[0] - 1))
+        ends = np.append(starts[1:], len(indices))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            self._add(key, int(indices[start]), data[start:end], energy_increments[start:end])
+
+    def _add(self, key: int, index: int, data: MeasurementBatch, energy_increments: np.ndarray) -> None:
+        window: Optional[_Window] = self._windows.get(key)
+        if window is not None and index < window.index:
+            # Host timestamps may jitter backwards across a window boundary, count such samples to the open window
+            index = window.index
+        if window is not None and window.index != index:
+            self._emit(key, window)
+            window = None
+        if window is None:
+            window = self._windows[key] = _Window(index)
+        window.add(data, energy_increments)
+
+    def _emit(self, key: int, window: _Window) -> None:
+        self._summary_logger.log_summary(window.summary(self._devices[key], self._duration))
+
+    def flush(self) -> None:
+        for key, window in self._windows.items():
+            self._emit(key, window)
+        self._windows.clear()
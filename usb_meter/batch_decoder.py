@@ -0,0 +1,82 @@
+import itertools
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+PACKET_SIZE = 64
+SAMPLES_PER_PACKET = 4
+SAMPLE_INTERVAL_NS = 10_000_000
+DATA_PACKET_TYPE = 0x04
+
+# One 15 byte sample as sent by the meter (little endian, unaligned)
+RAW_SAMPLE_DTYPE = np.dtype([
+    ("voltage", "<u4"),
+    ("current", "<u4"),
+    ("dp", "<u2"),
+    ("dn", "<u2"),
+    ("unknown", "u1"),
+    ("temperature", "<u2"),
+])
+
+# One 64 byte HID report
+PACKET_DTYPE = np.dtype([
+    ("vendor", "u1"),
+    ("type", "u1"),
+    ("samples", RAW_SAMPLE_DTYPE, (SAMPLES_PER_PACKET,)),
+    ("reserved", "u1"),
+    ("crc", "u1"),
+])
+
+assert RAW_SAMPLE_DTYPE.itemsize == 15
+assert PACKET_DTYPE.itemsize == PACKET_SIZE
+
+
+def as_packets(data) -> np.ndarray:
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if buffer.size % PACKET_SIZE:
+        raise ValueError("buffer size %d is not a multiple of %d" % (buffer.size, PACKET_SIZE))
+    return buffer.view(PACKET_DTYPE)
+
+
+def running_sum(start: float, increments: np.ndarray) -> np.ndarray:
+    # np.cumsum accumulates sequentially, so this is bit identical to "total += increment" in a loop
+    return np.cumsum(np.concatenate(([start], increments)))[1:]
+
+
+def exponential_moving_average(start: Optional[float], values: np.ndarray, alpha: float) -> np.ndarray:
+    if values.size == 0:
+        return values.astype(np.float64)
+    # The recurrence is evaluated one value after the other, the lambda runs in Python for every sample. Any
+    # reordering (block or prefix scan forms) rounds differently from the scalar decoder and depends on how
+    # the samples are split into batches, so the results are kept identical instead.
+    weighted = (values * (1.0 - alpha)).tolist()
+    if start is None:
+        start = float(values[0])
+        weighted = weighted[1:]
+    ema = itertools.accumulate(weighted, lambda previous, value: value + previous * alpha, initial=start)
+    return np.fromiter(ema, dtype=np.float64, count=len(weighted) + 1)[-values.size:]
+
+
+def decode_samples(packets: np.ndarray, timestamps: np.ndarray, intervals: np.ndarray, energy: float,
+                   capacity: float, temp_ema: Optional[float],
+                   alpha: float) -> Tuple[Dict[str, np.ndarray], float, float, Optional[float]]:
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    # timestamps and intervals (seconds each sample stands for) are per sample, see timestamping.SampleClock
+    raw = packets["samples"].reshape(-1)
+    voltage = raw["voltage"] / 100000
+    current = raw["current"] / 100000
+    columns = {
+        "timestamp": timestamps,
+        "raw_voltage": np.ascontiguousarray(raw["voltage"]),
+        "raw_current": np.ascontiguousarray(raw["current"]),
+        "raw_dp": np.ascontiguousarray(raw["dp"]),
+        "raw_dn": np.ascontiguousarray(raw["dn"]),
+        "temperature": exponential_moving_average(temp_ema, raw["temperature"] / 10.0, alpha),
+        "energy": running_sum(energy, voltage * current * intervals),
+        "capacity": running_sum(capacity, current * intervals),
+    }
+    if raw.size:
+        energy = float(columns["energy"][-1])
+        capacity = float(columns["capacity"][-1])
+        temp_ema = float(columns["temperature"][-1])
+    return columns, energy, capacity, temp_ema
@@ -0,0 +1,167 @@
+from pathlib import Path
+import struct
+from typing import Dict, Optional, Union
+
+import numpy as np
+
+from .capture import CapturedDevice
+from .device import Device, find_device_info
+from .measurement import MeasurementBatch
+
+# Binary log layout: a 64 byte header followed by 28 byte little endian records, in chunks that each start with
+# an anchor. An anchor has the size of a record and a marker where a record has its time delta. It holds the
+# timestamp, energy and capacity of the first record of the chunk, the records after it hold the time since the
+# previous record (ns) and their energy and capacity increments (10 nWs and 10 nAs, rounded from the anchor so
+# the values stay within 5 nWs and 5 nAs) as int32. Every write (one per flush, index block or fanout frame)
+# starts a chunk, so time ranges cut out at index entries and rotated segments decode on their own. A sample
+# after a gap starts a chunk with a GAP_ANCHOR, one whose increments do not fit into int32 with an ANCHOR.
+MAGIC = b"UMBIN\0"
+SCHEMA_VERSION = 2
+_HEADER = struct.Struct("<6sHHHH16s32s2x")
+RECORD_DTYPE = np.dtype([
+    ("time_delta", "<i4"),        # ns since the previous record, or a marker
+    ("raw_voltage", "<u4"),       # 10 uV
+    ("raw_current", "<u4"),       # 10 uA
+    ("raw_dp", "<u2"),            # mV
+    ("raw_dn", "<u2"),            # mV
+    ("temperature", "<f4"),       # EMA filtered
+    ("energy_delta", "<i4"),      # 10 nWs
+    ("capacity_delta", "<i4"),    # 10 nAs
+])
+ANCHOR_DTYPE = np.dtype([
+    ("marker", "<i4"),
+    ("timestamp", "<i8"),     # ns since epoch (UTC)
+    ("energy", "<f8"),        # Ws
+    ("capacity", "<f8"),      # As
+])
+ANCHOR = -2 ** 31
+GAP_ANCHOR = ANCHOR + 1
+DELTA_SCALE = 1e8
+
+HEADER_SIZE = _HEADER.size
+# Largest increment that still fits after rounding
+_MAX_DELTA = 2 ** 31 - 2
+
+assert HEADER_SIZE == 64
+assert RECORD_DTYPE.itemsize == ANCHOR_DTYPE.itemsize == 28
+
+
+def encode_header(device: Optional[Device]) -> bytes:
+    if device is None:
+        return _HEADER.pack(MAGIC, SCHEMA_VERSION, RECORD_DTYPE.itemsize, 0, 0, b"", b"")
+    info = device.device_info
+    return _HEADER.pack(MAGIC, SCHEMA_VERSION, RECORD_DTYPE.itemsize, info.vid, info.pid, info.model.name.encode(),
+                        str(device.serial_number or "").encode())
+
+
+def encode_records(batch: MeasurementBatch) -> bytes:
+    # One chunk, or more where samples need an anchor of their own
+    count = len(batch)
+    if count == 0:
+        return b""
+    time_deltas = np.diff(batch.timestamp, prepend=batch.timestamp[0])
+    anchored = batch.gap | (time_deltas > _MAX_DELTA) | (time_deltas <= GAP_ANCHOR)
+    anchored[0] = True
+    for column in (batch.energy, batch.capacity):
+        anchored |= np.abs(np.diff(column, prepend=column[0]) * DELTA_SCALE) >= _MAX_DELTA
+    starts = np.flatnonzero(anchored)
+    chunk = np.cumsum(anchored) - 1
+    first = starts[chunk]
+
+    records = np.empty(count, dtype=RECORD_DTYPE)
+    records["time_delta"] = np.where(anchored, 0, time_deltas)
+    for name in ("raw_voltage", "raw_current", "raw_dp", "raw_dn", "temperature"):
+        records[name] = getattr(batch, name)
+    for name in ("energy", "capacity"):
+        # Rounded from the anchor, not from the previous sample, so the rounding errors do not add up
+        column = getattr(batch, name)
+        steps = np.rint((column - column[first]) * DELTA_SCALE).astype(np.int64)
+        records[name + "_delta"] = np.where(anchored, 0, np.diff(steps, prepend=0))
+    anchors = np.empty(len(starts), dtype=ANCHOR_DTYPE)
+    anchors["marker"] = np.where(batch.gap[starts], GAP_ANCHOR, ANCHOR)
+    anchors["timestamp"] = batch.timestamp[starts]
+    anchors["energy"] = batch.energy[starts]
+    anchors["capacity"] = batch.capacity[starts]
+
+    units = np.empty(count + len(starts), dtype=RECORD_DTYPE)
+    units[np.arange(count) + chunk + 1] = records
+    units.view(ANCHOR_DTYPE)[starts + np.arange(len(starts))] = anchors
+    return units.tobytes()
+
+
+def decode_records(data) -> Dict[str, np.ndarray]:
+    # The MeasurementBatch columns of encoded records, data has to start with an anchor
+    units = np.frombuffer(data, dtype=RECORD_DTYPE, count=len(data) // RECORD_DTYPE.itemsize)
+    anchored = units["time_delta"] <= GAP_ANCHOR
+    if len(units) and not anchored[0]:
+        raise ValueError("binary records do not start with an anchor")
+    positions = np.flatnonzero(anchored)
+    anchors = units.view(ANCHOR_DTYPE)[positions]
+    records = units[~anchored]
+    # Index of the first record of each chunk, and the chunk of each record
+    starts = positions - np.arange(len(positions))
+    chunk = np.cumsum(anchored)[~anchored] - 1
+    first = starts[chunk]
+
+    columns = {name: records[name] for name in ("raw_voltage", "raw_current", "raw_dp", "raw_dn")}
+    columns["temperature"] = records["temperature"].astype(np.float64)
+    # Sums of integers are exact, the cumulative sum can be taken over all chunks at once
+    steps = np.cumsum(records["time_delta"], dtype=np.int64)
+    columns["timestamp"] = anchors["timestamp"][chunk] + steps - steps[first]
+    for name in ("energy", "capacity"):
+        steps = np.cumsum(records[name + "_delta"], dtype=np.int64)
+        columns[name] = anchors[name][chunk] + (steps - steps[first]) / DELTA_SCALE
+    columns["gap"] = np.zeros(len(records), dtype=bool)
+    gaps = starts[anchors["marker"] == GAP_ANCHOR]
+    columns["gap"][gaps[gaps < len(records)]] = True
+    return columns
+
+
+class BinaryLogReader:
+    def __init__(self, path: Union[str, Path]):
+        self._path = Path(path)
+        with self._path.open(mode="rb") as f:
+            header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError("%s: not a binary log" % self._path)
+        magic, version, record_size, vid, pid, _model, serial_number = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("%s: not a binary log" % self._path)
+        if version != SCHEMA_VERSION or record_size != RECORD_DTYPE.itemsize:
+            raise ValueError("%s: unsupported schema version %d" % (self._path, version))
+        device_info = find_device_info(vid, pid)
+        self.device = CapturedDevice(device_info, serial_number.rstrip(b"\0").decode()) if device_info else None
+
+        count = (self._path.stat().st_size - _HEADER.size) // RECORD_DTYPE.itemsize
+        data = b""
+        if count:
+            data = np.memmap(self._path, dtype=np.uint8, mode="r", offset=_HEADER.size,
+                             shape=(count * RECORD_DTYPE.itemsize,))
+        self._batch = MeasurementBatch(self.device, **decode_records(data))
+
+    def __len__(self) -> int:
+        return len(self._batch)
+
+    def __getattr__(self, name: str) -> np.ndarray:
+        if name in MeasurementBatch.COLUMN_DTYPES:
+            return getattr(self._batch, name)
+        raise AttributeError(name)
+
+    @property
+    def voltage(self) -> np.ndarray:
+        return self._batch.raw_voltage / MeasurementBatch.VOLTAGE_SCALE
+
+    @property
+    def current(self) -> np.ndarray:
+        return self._batch.raw_current / MeasurementBatch.CURRENT_SCALE
+
+    @property
+    def dp(self) -> np.ndarray:
+        return self._batch.raw_dp / MeasurementBatch.DATA_LINE_SCALE
+
+    @property
+    def dn(self) -> np.ndarray:
+        return self._batch.raw_dn / MeasurementBatch.DATA_LINE_SCALE
+
+    def batch(self, start: int = 0, stop: Optional[int] = None) -> MeasurementBatch:
+        return self._batch[start:stop]
@@ -0,0 +1,110 @@
+from pathlib import Path
+import struct
+import time
+from typing import Iterator, Optional, Tuple, Union
+
+import numpy as np
+
+from .batch_decoder import PACKET_SIZE
+from .device import Device, DeviceInfo, find_device_info
+
+# Capture file layout: a fixed size header followed by fixed size records, each holding the host receive
+# time (ns since epoch) and the raw 64 byte report exactly as read from the meter.
+MAGIC = b"UMCAP\0"
+VERSION = 1
+_HEADER = struct.Struct("<6sHHH16s32s4x")
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<i8"),
+    ("data", "u1", (PACKET_SIZE,)),
+])
+
+
+class CapturedDevice(Device):
+    # Stand-in for the meter a capture was recorded from, there is no USB device behind it
+    def __init__(self, device_info: DeviceInfo, serial_number: str):
+        super().__init__(device_info, None)
+        self._serial_number = serial_number
+
+    @property
+    def serial_number(self):
+        return self._serial_number
+
+    @property
+    def product_name(self):
+        return self._device_info.model.name
+
+    @property
+    def manufacturer_name(self):
+        return None
+
+
+class CaptureWriter:
+    def __init__(self, path: Union[str, Path], device: Device):
+        self._path = Path(path)
+        self._device = device
+        self._stream = None
+
+    def __enter__(self):
+        self._stream = self._path.open(mode="wb")  # pylint: disable=consider-using-with
+        info = self._device.device_info
+        self._stream.write(_HEADER.pack(MAGIC, VERSION, info.vid, info.pid, info.model.name.encode(),
+                                        str(self._device.serial_number or "").encode()))
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        self._stream.close()
+
+    def write(self, packets: np.ndarray, timestamps: np.ndarray) -> None:
+        records = np.empty(len(timestamps), dtype=RECORD_DTYPE)
+        records["timestamp"] = timestamps
+        records["data"] = packets
+        self._stream.write(records.tobytes())
+
+
+class CaptureReader:
+    def __init__(self, path: Union[str, Path]):
+        self._path = Path(path)
+        with self._path.open(mode="rb") as f:
+            header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError("%s: not a capture file" % self._path)
+        magic, version, vid, pid, _model, serial_number = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("%s: not a capture file" % self._path)
+        if version != VERSION:
+            raise ValueError("%s: unsupported capture version %d" % (self._path, version))
+        device_info = find_device_info(vid, pid)
+        if device_info is None:
+            raise ValueError("%s: unknown device %x:%x" % (self._path, vid, pid))
+        self.device = CapturedDevice(device_info, serial_number.rstrip(b"\0").decode())
+        size = self._path.stat().st_size - _HEADER.size
+        count = size // RECORD_DTYPE.itemsize
+        self._records: Optional[np.ndarray] = None
+        if count:
+            self._records = np.memmap(self._path, dtype=RECORD_DTYPE, mode="r", offset=_HEADER.size, shape=(count,))
+
+    def __len__(self) -> int:
+        return 0 if self._records is None else len(self._records)
+
+    def chunks(self, size: int = 4096) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        for start in range(0, len(self), size):
+            records = self._records[start:start + size]
+            yield np.ascontiguousarray(records["data"]), np.asarray(records["timestamp"])
+
+
+def replay(reader: CaptureReader, meter, data_logger, realtime: bool = False) -> None:
+    # Feeds a capture through the meter's decoder, either as fast as possible or paced like the recording
+    if not realtime:
+        for packets, timestamps in reader.chunks():
+            meter.log_packets(data_logger, packets, timestamps)
+        return
+
+    start = time.monotonic_ns()
+    first_timestamp = None
+    for packets, timestamps in reader.chunks(1):
+        if first_timestamp is None:
+            first_timestamp = int(timestamps[0])
+        delay = (int(timestamps[0]) - first_timestamp) - (time.monotonic_ns() - start)
+        if delay > 0:
+            time.sleep(delay / 1e9)
+        meter.log_packets(data_logger, packets, timestamps)
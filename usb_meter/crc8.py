@@ -0,0 +1,55 @@
+import numpy as np
+
+# CRC-8 over bytes 1..62 of a report, the result is stored in the last byte
+POLYNOMIAL = 0x39
+INIT_VALUE = 0x42
+# Where both ways took about 4 us per packet, see "crc checksums" of benchmarks.bench_crc at different batch sizes
+VECTORIZE_MIN_PACKETS = 32
+
+
+def _create_table() -> bytes:
+    table = bytearray(256)
+    for index in range(256):
+        value = index
+        for _ in range(8):
+            value = ((value << 1) ^ POLYNOMIAL if value & 0x80 else value << 1) & 0xff
+        table[index] = value
+    return bytes(table)
+
+
+TABLE = _create_table()
+_TABLE_ARRAY = np.frombuffer(TABLE, dtype=np.uint8)
+
+
+def checksum(data) -> int:
+    # data: anything supporting the buffer protocol (bytes, memoryview, array, NumPy array), it is not copied
+    value = INIT_VALUE
+    for byte in memoryview(data).cast("B"):
+        value = TABLE[value ^ byte]
+    return value
+
+
+def packet_checksum(packet) -> int:
+    return checksum(memoryview(packet).cast("B")[1:-1])
+
+
+def verify_packet(packet) -> bool:
+    view = memoryview(packet).cast("B")
+    return checksum(view[1:-1]) == view[-1]
+
+
+def packet_checksums(packets: np.ndarray) -> np.ndarray:
+    # packets: (N, 64) uint8. Larger batches are calculated all at once, one table lookup per byte position,
+    # below that the fixed cost of the 62 NumPy operations is higher than looping over the packets.
+    if len(packets) < VECTORIZE_MIN_PACKETS:
+        return np.array([packet_checksum(packet) for packet in packets], dtype=np.uint8)
+    columns = np.ascontiguousarray(packets[:, 1:-1].T)
+    values = np.full(len(packets), INIT_VALUE, dtype=np.uint8)
+    for column in columns:
+        values = _TABLE_ARRAY.take(values ^ column)
+    return values
+
+
+def verify_packets(packets: np.ndarray) -> np.ndarray:
+    # Mask of the packets whose checksum is correct
+    return packet_checksums(packets) == packets[:, -1]
@@ -1,8 +1,6 @@
-from typing import List
-
-from .measurement import ElectricalMeasurement
+from .measurement import MeasurementBatch
 
 
 class DataLogger:
-    def log(self, data: List[ElectricalMeasurement]) -> None:
+    def log(self, data: MeasurementBatch) -> None:
         pass
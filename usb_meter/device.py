@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 from enum import Enum, auto
 import datetime
-from typing import Union
+from typing import Dict, Optional, Union
 from typing import Generator
 
 import usb.core
@@ -23,9 +23,14 @@ class DeviceInfo:
 
 
 class Device:
-    def __init__(self, device_info, usb_device):
+    def __init__(self, device_info, usb_device, serial_number: Optional[str] = None):
         self._device_info = device_info
         self._usb_device = usb_device
+        # Reading a string descriptor is a control transfer, each one is only read once.
+        # serial_number can be passed in if it is already known, e.g. from a DiscoveryCache.
+        self._strings: Dict[str, Optional[str]] = {}
+        if serial_number is not None:
+            self._strings["iSerialNumber"] = serial_number
 
     @property
     def device_info(self):
@@ -35,20 +40,26 @@ class Device:
     def usb_device(self):
         return self._usb_device
 
+    def reattach(self, usb_device) -> None:
+        # The same meter under a new USB device, after it was reconnected
+        self._usb_device = usb_device
+
+    def _get_string(self, descriptor: str) -> Optional[str]:
+        if descriptor not in self._strings:
+            self._strings[descriptor] = usb.util.get_string(self._usb_device, getattr(self._usb_device, descriptor))
+        return self._strings[descriptor]
+
     @property
     def serial_number(self):
-        sn = usb.util.get_string(self._usb_device, self._usb_device.iSerialNumber)
-        return sn
+        return self._get_string("iSerialNumber")
 
     @property
     def product_name(self):
-        sn = usb.util.get_string(self._usb_device, self._usb_device.iProduct)
-        return sn
+        return self._get_string("iProduct")
 
     @property
     def manufacturer_name(self):
-        sn = usb.util.get_string(self._usb_device, self._usb_device.iManufacturer)
-        return sn
+        return self._get_string("iManufacturer")
 
 
 _DEVICE_MAP = {
@@ -66,19 +77,30 @@ _DEVICE_MAP = {
 }
 
 
+def find_meters():
+    # USB devices of the known models. Only the device descriptors are compared, which the OS has cached, so
+    # this does not talk to any device. The bus is enumerated once, not once per model.
+    return usb.core.find(find_all=True, custom_match=lambda usb_device: _find_device_info(usb_device) is not None)
+
+
 def all_devices() -> Generator[Device, None, None]:
-    for (vid, pid), info in _DEVICE_MAP.items():
-        devices = usb.core.find(find_all=True, idVendor=vid, idProduct=pid)
-        for device in devices:
-            yield Device(info, device)
+    for usb_device in find_meters():
+        yield Device(_find_device_info(usb_device), usb_device)
+
+
+def find_device_info(vid: int, pid: int) -> Union[DeviceInfo, None]:
+    return _DEVICE_MAP.get((vid, pid))
+
+
+def device_info_by_model(model: DeviceModel) -> DeviceInfo:
+    for info in _DEVICE_MAP.values():
+        if info.model == model:
+            return info
+    raise ValueError("unknown model %s" % model)
 
 
 def _find_device_info(usb_device) -> Union[DeviceInfo, None]:
-    for (vid, pid), info in _DEVICE_MAP.items():
-        if usb_device.idVendor == vid:
-            if usb_device.idProduct == pid:
-                return info
-    return None
+    return _DEVICE_MAP.get((usb_device.idVendor, usb_device.idProduct))
 
 
 def devices_by_vid_pid(vid: int, pid: int) -> Generator[Device, None, None]:
@@ -88,24 +110,18 @@ def devices_by_vid_pid(vid: int, pid: int) -> Generator[Device, None, None]:
             yield Device(device_info, usb_device)
 
 
-def devices_by_serial_number(serial_number: Union[int, str]) -> Generator[Device, None, None]:
+def has_serial_number(device: Device, serial_number: Union[int, str]) -> bool:
     if isinstance(serial_number, str):
-        serial_number_int = int(serial_number, 16)
-    else:
-        serial_number_int = serial_number
-
-    def has_serial_number(dev):
-        try:
-            sn_str = usb.util.get_string(dev, dev.iSerialNumber)
-            if sn_str:
-                sn = int(sn_str, 16)
-                if serial_number_int == sn:
-                    return True
-        except ValueError:
-            pass
+        serial_number = int(serial_number, 16)
+    try:
+        sn_str = device.serial_number
+        return bool(sn_str) and int(sn_str, 16) == serial_number
+    except ValueError:
         return False
 
-    for usb_device in usb.core.find(find_all=True, custom_match=has_serial_number):
-        device_info = _find_device_info(usb_device)
-        if device_info:
-            yield Device(device_info, usb_device)
+
+def devices_by_serial_number(serial_number: Union[int, str]) -> Generator[Device, None, None]:
+    # Only meters are asked for their serial number, not every device on the bus
+    for device in all_devices():
+        if has_serial_number(device, serial_number):
+            yield device
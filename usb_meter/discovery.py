@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from .device import Device, find_device_info, find_meters, has_serial_number
+
+# Finding a meter by serial number needs a control transfer per meter. DiscoveryCache keeps the serial
+# numbers in a file between runs, keyed by where the device sits on the bus. The OS gives a device a new
+# address whenever it is (re)connected, so an entry only matches the same device as long as it stays plugged
+# in. DeviceRegistry keeps the Device objects (and their cached strings) of meters that stay connected and
+# reports which ones came and went since the last refresh().
+
+
+def topology_key(usb_device) -> str:
+    ports = ".".join(str(port) for port in (usb_device.port_numbers or ()))
+    return "%d-%s@%d %04x:%04x" % (usb_device.bus, ports, usb_device.address, usb_device.idVendor,
+                                   usb_device.idProduct)
+
+
+class DiscoveryCache:
+    def __init__(self, path: Union[str, Path]):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._path = Path(path)
+        self._serial_numbers: Dict[str, str] = {}
+        self._changed = False
+        try:
+            with self._path.open("rt", encoding="utf-8") as f:
+                self._serial_numbers = dict(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError) as e:
+            self._logger.warning("Ignoring invalid device cache %s: %s", self._path, e)
+
+    def serial_number(self, usb_device) -> Optional[str]:
+        return self._serial_numbers.get(topology_key(usb_device))
+
+    def store(self, usb_device, serial_number: str) -> None:
+        key = topology_key(usb_device)
+        if self._serial_numbers.get(key) != serial_number:
+            self._serial_numbers[key] = serial_number
+            self._changed = True
+
+    def prune(self, usb_devices) -> None:
+        # Forget devices that are gone, their address will not come back
+        present = {topology_key(usb_device) for usb_device in usb_devices}
+        for key in [key for key in self._serial_numbers if key not in present]:
+            del self._serial_numbers[key]
+            self._changed = True
+
+    def save(self) -> None:
+        if not self._changed:
+            return
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self._path.with_name(self._path.name + ".tmp")
+        with temporary.open("wt", encoding="utf-8") as f:
+            json.dump(self._serial_numbers, f, indent=1, sort_keys=True)
+        os.replace(temporary, self._path)
+        self._changed = False
+
+
+class DeviceRegistry:
+    def __init__(self, cache: Optional[DiscoveryCache] = None):
+        self._cache = cache
+        self._devices: Dict[str, Device] = {}
+
+    @property
+    def devices(self) -> List[Device]:
+        # As of the last refresh()
+        return list(self._devices.values())
+
+    def refresh(self) -> Tuple[List[Device], List[Device]]:
+        # Enumerates the meters again, returns the ones that were connected and disconnected since the last call
+        usb_devices = {topology_key(usb_device): usb_device for usb_device in find_meters()}
+        removed = [device for key, device in self._devices.items() if key not in usb_devices]
+        added = []
+        for key, usb_device in usb_devices.items():
+            if key not in self._devices:
+                serial_number = self._cache.serial_number(usb_device) if self._cache else None
+                self._devices[key] = Device(find_device_info(usb_device.idVendor, usb_device.idProduct), usb_device,
+                                            serial_number=serial_number)
+                added.append(self._devices[key])
+        for key in [key for key in self._devices if key not in usb_devices]:
+            del self._devices[key]
+        if self._cache:
+            self._cache.prune(usb_devices.values())
+        return added, removed
+
+    def by_vid_pid(self, vid: int, pid: int) -> List[Device]:
+        return [device for device in self._devices.values()
+                if (device.device_info.vid, device.device_info.pid) == (vid, pid)]
+
+    def by_serial_number(self, serial_number: Union[int, str]) -> List[Device]:
+        devices = [device for device in self._devices.values() if has_serial_number(device, serial_number)]
+        self.save()
+        return devices
+
+    def save(self) -> None:
+        # Stores the serial numbers of all current meters in the cache, if there is one
+        if self._cache:
+            for device in self._devices.values():
+                if device.serial_number:
+                    self._cache.store(device.usb_device, device.serial_number)
+            self._cache.save()
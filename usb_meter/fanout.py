@@ -0,0 +1,249 @@
+from collections import deque
+import datetime
+import logging
+import os
+from pathlib import Path
+import queue
+import socket
+import stat
+import struct
+import threading
+from typing import Deque, List, Optional, Sequence, Tuple, Union
+
+from . import binary_format
+from .capture import CapturedDevice
+from .data_logger import DataLogger
+from .device import Device, find_device_info
+from .measurement import MeasurementBatch
+from .metrics import REGISTRY, MetricsRegistry
+
+# Shares the decoded samples of a running logger with other local processes. BatchPublisher is a DataLogger
+# that serves a Unix domain socket: every batch is encoded once and sent to all connected subscribers, a new
+# subscriber first gets the batches of the last few seconds. Each subscriber has its own sender thread, one that
+# falls too far behind is disconnected instead of slowing down the meters.
+#
+# Stream layout: a hello message listing the devices, then one frame per batch, all little endian. A frame holds
+# the index of the device in the hello message, the size in bytes and the samples as one chunk of binary log
+# records (see binary_format), which carry the gaps.
+MAGIC = b"UMFAN\0"
+VERSION = 2
+_HELLO = struct.Struct("<6sHH")
+_DEVICE = struct.Struct("<HH32s")
+_FRAME = struct.Struct("<HI")
+DEFAULT_SOCKET = "/tmp/um120_logger.sock"
+
+
+def encode_frame(device_index: int, batch: MeasurementBatch) -> bytes:
+    records = binary_format.encode_records(batch)
+    return _FRAME.pack(device_index, len(records)) + records
+
+
+class _Subscriber:
+    def __init__(self, connection: socket.socket, name: str):
+        self.name = name
+        self._connection = connection
+        self._queue: "queue.Queue[Optional[bytes]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._send, name="Subscriber %s" % name, daemon=True)
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def connected(self) -> bool:
+        return self._thread.is_alive()
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def put(self, data: bytes) -> None:
+        self._queue.put(data)
+
+    def _send(self) -> None:
+        try:
+            while (data := self._queue.get()) is not None:
+                self._connection.sendall(data)
+        except OSError:
+            pass  # The subscriber went away
+        finally:
+            self._connection.close()
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        # Sends what is queued, then disconnects
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def disconnect(self) -> None:
+        # Makes a blocked send fail right away
+        try:
+            self._connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._queue.put(None)
+
+
+class BatchPublisher(DataLogger):
+    # pylint: disable=too-many-instance-attributes
+    ACCEPT_TIMEOUT = 0.5
+
+    def __init__(self, path: Union[str, Path], devices: Sequence[Device],
+                 history: datetime.timedelta = datetime.timedelta(seconds=60), max_pending: int = 1024,
+                 registry: MetricsRegistry = REGISTRY):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        # max_pending: frames a subscriber may fall behind before it is disconnected
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._path = Path(path)
+        self._device_indices = {id(device): index for index, device in enumerate(devices)}
+        self._hello = _HELLO.pack(MAGIC, VERSION, len(devices)) + b"".join(
+            _DEVICE.pack(device.device_info.vid, device.device_info.pid, str(device.serial_number or "").encode())
+            for device in devices)
+        self._history_ns = history // datetime.timedelta(microseconds=1) * 1000
+        self._history: Deque[Tuple[int, bytes]] = deque()
+        self._max_pending = max_pending
+        self._lock = threading.Lock()
+        self._subscribers: List[_Subscriber] = []
+        self._socket: Optional[socket.socket] = None
+        self._stop = threading.Event()
+        self._accept_thread: Optional[threading.Thread] = None
+        self._connections = 0
+        registry.gauge_function("usb_meter_subscribers", "Processes connected to the publisher socket",
+                                lambda: len(self._subscribers), socket=str(self._path))
+        self._dropped = registry.counter("usb_meter_subscribers_dropped_total",
+                                         "Subscribers disconnected because they fell behind", socket=str(self._path))
+
+    def __enter__(self):
+        self._remove_stale_socket()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(str(self._path))
+        self._socket.listen()
+        self._socket.settimeout(self.ACCEPT_TIMEOUT)
+        self._accept_thread = threading.Thread(target=self._accept_loop, name="BatchPublisher", daemon=True)
+        self._accept_thread.start()
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        self._stop.set()
+        self._accept_thread.join()
+        self._socket.close()
+        self._path.unlink(missing_ok=True)
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, []
+        for subscriber in subscribers:
+            subscriber.close(timeout=5.0)
+
+    def _remove_stale_socket(self) -> None:
+        # Left behind by a publisher that did not exit cleanly
+        try:
+            if not stat.S_ISSOCK(os.stat(self._path).st_mode):
+                raise RuntimeError("%s exists and is not a socket" % self._path)
+        except FileNotFoundError:
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(str(self._path))
+            except ConnectionRefusedError:
+                self._path.unlink()
+                return
+        raise RuntimeError("%s is in use by another publisher" % self._path)
+
+    def _accept_loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                connection, _address = self._socket.accept()
+            except socket.timeout:
+                continue
+            except OSError as e:
+                self._logger.error("Accepting subscribers failed: %s", e)
+                return
+            connection.setblocking(True)
+            self._connections += 1
+            subscriber = _Subscriber(connection, "#%d" % self._connections)
+            with self._lock:
+                # Under the lock, so no batch is missed or sent twice
+                subscriber.put(self._hello + b"".join(frame for _timestamp, frame in self._history))
+                self._subscribers.append(subscriber)
+            subscriber.start()
+            self._logger.info("Subscriber %s connected, %d connected", subscriber.name, len(self._subscribers))
+
+    def log(self, data: MeasurementBatch) -> None:
+        if len(data) == 0:
+            return
+        frame = encode_frame(self._device_indices[id(data.device)], data)
+        latest = int(data.timestamp[-1])
+        with self._lock:
+            self._history.append((latest, frame))
+            while self._history and self._history[0][0] < latest - self._history_ns:
+                self._history.popleft()
+            for subscriber in list(self._subscribers):
+                if not subscriber.connected:
+                    self._subscribers.remove(subscriber)
+                    self._logger.info("Subscriber %s disconnected", subscriber.name)
+                elif subscriber.pending >= self._max_pending:
+                    self._subscribers.remove(subscriber)
+                    subscriber.disconnect()
+                    self._dropped.inc()
+                    self._logger.warning("Subscriber %s fell %d batches behind, disconnected", subscriber.name,
+                                         subscriber.pending)
+                else:
+                    subscriber.put(frame)
+
+
+class BatchSubscriber:
+    # Reads the batches a BatchPublisher serves: "with BatchSubscriber(path) as subscriber: for batch in
+    # subscriber: ...". The batches of devices[i] all share the same Device object.
+    def __init__(self, path: Union[str, Path] = DEFAULT_SOCKET):
+        self._path = Path(path)
+        self._socket: Optional[socket.socket] = None
+        self._stream = None
+        self.devices: List[Device] = []
+
+    def __enter__(self):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(str(self._path))
+        except OSError as e:
+            self._socket.close()
+            raise RuntimeError("Cannot connect to %s: %s" % (self._path, e)) from e
+        self._stream = self._socket.makefile("rb")
+        magic, version, count = _HELLO.unpack(self._read_hello(_HELLO.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s: unsupported publisher" % self._path)
+        for _index in range(count):
+            vid, pid, serial_number = _DEVICE.unpack(self._read_hello(_DEVICE.size))
+            device_info = find_device_info(vid, pid)
+            if device_info is None:
+                raise ValueError("%s: unknown device %04x:%04x" % (self._path, vid, pid))
+            self.devices.append(CapturedDevice(device_info, serial_number.rstrip(b"\0").decode()))
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        self._stream.close()
+        self._socket.close()
+
+    def _read_hello(self, size: int) -> bytes:
+        data = self._read(size)
+        if data is None:
+            raise ValueError("%s: incomplete hello message" % self._path)
+        return data
+
+    def _read(self, size: int) -> Optional[bytes]:
+        data = self._stream.read(size)
+        # A partial frame means the publisher went away while sending
+        return data if len(data) == size else None
+
+    def __iter__(self):
+        # Ends when the publisher exits
+        while (header := self._read(_FRAME.size)) is not None:
+            device_index, size = _FRAME.unpack(header)
+            data = self._read(size)
+            if data is None:
+                return
+            yield MeasurementBatch(self.devices[device_index], **binary_format.decode_records(data))
+
+    def run(self, data_loggers: Sequence[DataLogger]) -> None:
+        # Logs the batches of devices[i] to data_loggers[i] until the publisher exits
+        if len(data_loggers) != len(self.devices):
+            raise ValueError("every device needs a data logger")
+        data_loggers = {id(device): data_logger for device, data_logger in zip(self.devices, data_loggers)}
+        for batch in self:
+            data_loggers[id(batch.device)].log(batch)
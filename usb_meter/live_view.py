@@ -0,0 +1,178 @@
+import datetime
+import os
+from collections import deque
+from pathlib import Path
+import threading
+import time
+from typing import Deque, Dict, List, Optional, TextIO, Tuple, Union
+
+import numpy as np
+
+from .data_logger import DataLogger
+from .measurement import MeasurementBatch
+
+# A live plot of a long run should not re-read the whole log on every refresh. LiveHistory keeps a few levels
+# of min/mean/max buckets per device, each level a ring of at most `points` buckets that are `factor` times
+# longer than those of the level below. A refresh takes the finest level that still covers the span to plot, so
+# it never writes more than `points` lines, no matter how long the run has been going. Plotting min and max of
+# every bucket keeps the peaks visible that plain decimation would lose.
+
+HEADER = "# timestamp samples voltage_min_V voltage_mean_V voltage_max_V current_min_A current_mean_A current_max_A"
+
+
+class _Bucket:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, index: int):
+        self.index = index
+        self.samples = 0
+        self.gap = False
+        self.voltage_min = np.inf
+        self.voltage_max = -np.inf
+        self.voltage_sum = 0.0
+        self.current_min = np.inf
+        self.current_max = -np.inf
+        self.current_sum = 0.0
+
+    def add(self, samples: int, gap: bool, voltage: Tuple[float, float, float],
+            current: Tuple[float, float, float]) -> None:
+        # voltage and current: min, max and sum of the samples
+        self.samples += samples
+        self.gap = self.gap or gap
+        self.voltage_min = min(self.voltage_min, voltage[0])
+        self.voltage_max = max(self.voltage_max, voltage[1])
+        self.voltage_sum += voltage[2]
+        self.current_min = min(self.current_min, current[0])
+        self.current_max = max(self.current_max, current[1])
+        self.current_sum += current[2]
+
+
+def _reduce(values: np.ndarray, starts: np.ndarray):
+    return zip(np.minimum.reduceat(values, starts).tolist(), np.maximum.reduceat(values, starts).tolist(),
+               np.add.reduceat(values, starts).tolist())
+
+
+class _Level:
+    def __init__(self, duration: int, points: int):
+        self.duration = duration  # ns per bucket
+        self.buckets: Deque[_Bucket] = deque(maxlen=points)
+        self.dropped = False      # the oldest buckets are gone
+
+    def add(self, data: MeasurementBatch, voltage: np.ndarray, current: np.ndarray, whole: tuple) -> None:
+        # Usually a batch falls into a single bucket and whole (its reduction) is all that is needed, otherwise
+        # reduce it in runs of the same bucket
+        first = int(data.timestamp[0]) // self.duration
+        if first == int(data.timestamp[-1]) // self.duration:
+            self._add(first, *whole)
+            return
+        indices = data.timestamp // self.duration
+        starts = np.flatnonzero(np.diff(indices, prepend=indices[0] - 1))
+        runs = zip(indices[starts].tolist(), np.diff(starts, append=len(indices)).tolist(),
+                   np.logical_or.reduceat(data.gap, starts).tolist(), _reduce(voltage, starts),
+                   _reduce(current, starts))
+        for run in runs:
+            self._add(*run)
+
+    def _add(self, index: int, samples: int, gap: bool, voltage: Tuple[float, float, float],
+             current: Tuple[float, float, float]) -> None:
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        if not self.buckets or index > self.buckets[-1].index:
+            self.dropped = self.dropped or len(self.buckets) == self.buckets.maxlen
+            self.buckets.append(_Bucket(index))
+        # Host timestamps may jitter backwards across a boundary, such samples count to the open bucket
+        self.buckets[-1].add(samples, gap, voltage, current)
+
+    def covers(self, start: int) -> bool:
+        return not self.dropped or self.buckets[0].index * self.duration <= start
+
+
+class LiveHistory:
+    # The history of one device
+    # The defaults keep 100 s at 0.1 s resolution, up to 190 days at 4.6 h
+    def __init__(self, points: int = 1000, factor: int = 4, levels: int = 8,
+                 resolution: datetime.timedelta = datetime.timedelta(milliseconds=100)):
+        if points <= 0 or factor < 2 or levels <= 0:
+            raise ValueError("invalid live history size")
+        resolution = resolution // datetime.timedelta(microseconds=1) * 1000
+        self._levels = [_Level(resolution * factor ** level, points) for level in range(levels)]
+        self.start: Optional[int] = None
+        self.end: Optional[int] = None
+
+    def add(self, data: MeasurementBatch) -> None:
+        if len(data) == 0:
+            return
+        self.start = int(data.timestamp[0]) if self.start is None else self.start
+        self.end = int(data.timestamp[-1])
+        voltage = data.voltage
+        current = data.current
+        whole = (len(data), bool(data.gap.any()),
+                 (float(voltage.min()), float(voltage.max()), float(voltage.sum())),
+                 (float(current.min()), float(current.max()), float(current.sum())))
+        for level in self._levels:
+            level.add(data, voltage, current, whole)
+
+    def buckets(self, span: Optional[int] = None) -> Tuple[int, List[_Bucket]]:
+        # The bucket duration and buckets of the finest level covering the last span ns (or the whole run),
+        # oldest first
+        if self.end is None:
+            return self._levels[0].duration, []
+        start = self.start if span is None else max(self.start, self.end - span)
+        level = next((level for level in self._levels if level.covers(start)), self._levels[-1])
+        return level.duration, [bucket for bucket in level.buckets if (bucket.index + 1) * level.duration > start]
+
+    def write(self, f: TextIO, span: Optional[int] = None) -> None:
+        duration, buckets = self.buckets(span)
+        previous = None
+        for bucket in buckets:
+            # An empty line breaks the plotted line where no data or lost data is
+            if previous is not None and (bucket.index != previous + 1 or bucket.gap):
+                f.write("\n")
+            previous = bucket.index
+            f.write("%.3f %d %.5f %.5f %.5f %.5f %.5f %.5f\n" % (
+                bucket.index * duration / 1e9, bucket.samples,
+                bucket.voltage_min, bucket.voltage_sum / bucket.samples, bucket.voltage_max,
+                bucket.current_min, bucket.current_sum / bucket.samples, bucket.current_max))
+
+
+class LiveViewLogger(DataLogger):
+    # pylint: disable=too-many-instance-attributes
+    # Rewrites path every interval seconds (and on exit) with the history of every device, replacing the file
+    # atomically so a plotting program never reads half of it. Devices are separated by two empty lines (a
+    # gnuplot data block). Thread safe, meters logging from their own threads can share one.
+    def __init__(self, path: Union[str, Path], interval: float = 1.0, span: Optional[datetime.timedelta] = None,
+                 points: int = 1000):
+        self._path = Path(path)
+        self._interval = interval
+        self._span = None if span is None else span // datetime.timedelta(microseconds=1) * 1000
+        self._points = points
+        self._histories: Dict[int, LiveHistory] = {}
+        self._serial_numbers: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._last_write = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        with self._lock:
+            self._write()
+
+    def log(self, data: MeasurementBatch) -> None:
+        with self._lock:
+            key = id(data.device)
+            if key not in self._histories:
+                self._histories[key] = LiveHistory(self._points)
+                self._serial_numbers[key] = str(data.device.serial_number)
+            self._histories[key].add(data)
+            if time.monotonic() - self._last_write >= self._interval:
+                self._write()
+                self._last_write = time.monotonic()
+
+    def _write(self) -> None:
+        temporary = self._path.with_name(self._path.name + ".tmp")
+        with temporary.open("wt", encoding="utf-8") as f:
+            for number, (key, history) in enumerate(self._histories.items()):
+                if number:
+                    f.write("\n\n")
+                f.write("# device %s\n%s\n" % (self._serial_numbers[key], HEADER))
+                history.write(f, self._span)
+        os.replace(temporary, self._path)
@@ -1,10 +1,16 @@
 from dataclasses import dataclass
 import datetime
+from typing import Iterator, Optional, Sequence, Union
 
+import numpy as np
+
+from .batch_decoder import SAMPLE_INTERVAL_NS
 from .device import Device
 
 # pylint: disable=too-many-instance-attributes
 
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
 
 @dataclass
 class ElectricalMeasurement:
@@ -17,3 +23,112 @@ class ElectricalMeasurement:
     temperature: float
     energy: float
     capacity: float
+
+
+def timestamp_to_datetime(timestamp_ns: int) -> datetime.datetime:
+    return _EPOCH + datetime.timedelta(microseconds=int(timestamp_ns) // 1000)
+
+
+def datetime_to_timestamp(timestamp: datetime.datetime) -> int:
+    return (timestamp - _EPOCH) // datetime.timedelta(microseconds=1) * 1000
+
+
+@dataclass
+class MeasurementBatch:
+    # Struct of arrays, one entry per sample. Voltage, current and D+/D- are kept in the units the meter
+    # sends them (45 bytes per sample in total), the float values are computed on access.
+    VOLTAGE_SCALE = 100000
+    CURRENT_SCALE = 100000
+    DATA_LINE_SCALE = 1000
+
+    device: Device
+    timestamp: np.ndarray      # int64, ns since epoch (UTC)
+    raw_voltage: np.ndarray    # uint32, 10 uV
+    raw_current: np.ndarray    # uint32, 10 uA
+    raw_dp: np.ndarray         # uint16, mV
+    raw_dn: np.ndarray         # uint16, mV
+    temperature: np.ndarray    # float64, EMA filtered
+    energy: np.ndarray         # float64, Ws
+    capacity: np.ndarray       # float64, As
+    gap: Optional[np.ndarray] = None  # bool, samples were lost right before this one
+
+    COLUMN_DTYPES = {
+        "timestamp": np.int64,
+        "raw_voltage": np.uint32,
+        "raw_current": np.uint32,
+        "raw_dp": np.uint16,
+        "raw_dn": np.uint16,
+        "temperature": np.float64,
+        "energy": np.float64,
+        "capacity": np.float64,
+        "gap": np.bool_,
+    }
+
+    def __post_init__(self):
+        if self.gap is None:
+            self.gap = np.zeros(len(self.timestamp), dtype=bool)
+
+    @classmethod
+    def empty(cls, device: Device) -> "MeasurementBatch":
+        return cls(device, **{name: np.empty(0, dtype) for name, dtype in cls.COLUMN_DTYPES.items()})
+
+    @classmethod
+    def concatenate(cls, batches: Sequence["MeasurementBatch"]) -> "MeasurementBatch":
+        if len(batches) == 1:
+            return batches[0]
+        columns = {name: np.concatenate([getattr(batch, name) for batch in batches]) for name in cls.COLUMN_DTYPES}
+        return cls(batches[0].device, **columns)
+
+    @property
+    def voltage(self) -> np.ndarray:
+        return self.raw_voltage / self.VOLTAGE_SCALE
+
+    @property
+    def current(self) -> np.ndarray:
+        return self.raw_current / self.CURRENT_SCALE
+
+    @property
+    def dp(self) -> np.ndarray:
+        return self.raw_dp / self.DATA_LINE_SCALE
+
+    @property
+    def dn(self) -> np.ndarray:
+        return self.raw_dn / self.DATA_LINE_SCALE
+
+    def energy_increments(self, previous: Optional[float] = None) -> np.ndarray:
+        # Ws each sample adds to the energy column. previous is the energy before the first sample, without it
+        # the first sample stands for one nominal sample interval.
+        if len(self) == 0:
+            return np.empty(0)
+        if previous is None:
+            previous = float(self.energy[0]) - float(self.voltage[0] * self.current[0]) * SAMPLE_INTERVAL_NS / 1e9
+        return np.diff(self.energy, prepend=previous)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.COLUMN_DTYPES)
+
+    def __len__(self) -> int:
+        return len(self.timestamp)
+
+    def __getitem__(self, index: Union[int, slice, np.ndarray]) -> Union[ElectricalMeasurement, "MeasurementBatch"]:
+        if isinstance(index, (int, np.integer)):
+            return self.row(int(index))
+        return MeasurementBatch(self.device, **{name: getattr(self, name)[index] for name in self.COLUMN_DTYPES})
+
+    def __iter__(self) -> Iterator[ElectricalMeasurement]:
+        for index in range(len(self)):
+            yield self.row(index)
+
+    def row(self, index: int) -> ElectricalMeasurement:
+        return ElectricalMeasurement(
+            device=self.device,
+            timestamp=timestamp_to_datetime(self.timestamp[index]),
+            voltage=int(self.raw_voltage[index]) / self.VOLTAGE_SCALE,
+            current=int(self.raw_current[index]) / self.CURRENT_SCALE,
+            dp=int(self.raw_dp[index]) / self.DATA_LINE_SCALE,
+            dn=int(self.raw_dn[index]) / self.DATA_LINE_SCALE,
+            temperature=float(self.temperature[index]),
+            energy=float(self.energy[index]),
+            capacity=float(self.capacity[index]),
+        )
@@ -0,0 +1,70 @@
+import datetime
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from .data_logger import DataLogger
+from .measurement import MeasurementBatch
+
+
+class MergingDataLogger(DataLogger):
+    # Collects batches from several meters (logging from their own threads) and forwards them to a single
+    # data logger in timestamp order. Samples are held back until every source has moved past them, or for at
+    # most max_delay, so a stalled meter does not hold up the others.
+    def __init__(self, data_logger: DataLogger, source_count: int,
+                 max_delay: datetime.timedelta = datetime.timedelta(seconds=1)):
+        self._data_logger = data_logger
+        self._source_count = source_count
+        self._max_delay_ns = max_delay // datetime.timedelta(microseconds=1) * 1000
+        self._lock = threading.Lock()
+        self._pending: Dict[int, List[MeasurementBatch]] = {}
+        self._latest: Dict[int, int] = {}
+
+    def log(self, data: MeasurementBatch) -> None:
+        if len(data) == 0:
+            return
+        key = id(data.device)
+        with self._lock:
+            self._pending.setdefault(key, []).append(data)
+            self._latest[key] = int(data.timestamp[-1])
+            self._emit(self._watermark())
+
+    def flush(self) -> None:
+        with self._lock:
+            self._emit(None)
+
+    def _watermark(self) -> int:
+        overdue = time.time_ns() - self._max_delay_ns
+        if len(self._latest) < self._source_count:
+            return overdue
+        return max(min(self._latest.values()), overdue)
+
+    def _emit(self, watermark) -> None:
+        ready = []
+        for key, batches in self._pending.items():
+            if not batches:
+                continue
+            batch = MeasurementBatch.concatenate(batches)
+            end = len(batch) if watermark is None else int(np.searchsorted(batch.timestamp, watermark, "right"))
+            if end:
+                ready.append(batch[:end])
+            self._pending[key] = [batch[end:]] if end < len(batch) else []
+        if not ready:
+            return
+        if len(ready) == 1:
+            self._data_logger.log(ready[0])
+            return
+
+        timestamps = np.concatenate([batch.timestamp for batch in ready])
+        sources = np.concatenate([np.full(len(batch), index) for index, batch in enumerate(ready)])
+        rows = np.concatenate([np.arange(len(batch)) for batch in ready])
+        order = np.argsort(timestamps, kind="stable")
+        sources = sources[order]
+        rows = rows[order]
+        # Forward consecutive samples of the same device as one batch
+        starts = np.flatnonzero(np.diff(sources, prepend=-1))
+        ends = np.append(starts[1:], len(sources))
+        for start, end in zip(starts, ends):
+            self._data_logger.log(ready[sources[start]][rows[start:end]])
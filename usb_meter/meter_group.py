@@ -0,0 +1,50 @@
+import logging
+import threading
+from typing import List, Sequence
+
+from .data_logger import DataLogger
+from .usb_meter import USBMeter
+
+
+class MeterGroup:
+    # Runs several meters concurrently, each with its own read loop and data logger
+    def __init__(self, meters: Sequence[USBMeter], data_loggers: Sequence[DataLogger]):
+        if len(meters) != len(data_loggers):
+            raise ValueError("every meter needs a data logger")
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._meters = list(meters)
+        self._data_loggers = list(data_loggers)
+        self._errors: List[BaseException] = []
+
+    def _run_meter(self, meter: USBMeter, data_logger: DataLogger) -> None:
+        try:
+            meter.run(data_logger)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self._logger.error("Meter %s failed: %s", meter.device.serial_number, e)
+            self._errors.append(e)
+
+    def stop(self) -> None:
+        for meter in self._meters:
+            meter.stop()
+
+    def run(self) -> None:
+        threads = [threading.Thread(target=self._run_meter, args=(meter, data_logger),
+                                    name="USBMeter %d" % index, daemon=True)
+                   for index, (meter, data_logger) in enumerate(zip(self._meters, self._data_loggers))]
+        for thread in threads:
+            thread.start()
+        try:
+            self._join(threads)
+        except KeyboardInterrupt:
+            self._logger.info("Keyboard interrupt received -> stopping...")
+            self.stop()
+            self._join(threads)
+
+        if self._errors:
+            raise self._errors[0]
+
+    @staticmethod
+    def _join(threads: Sequence[threading.Thread]) -> None:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
@@ -0,0 +1,199 @@
+import bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+from pathlib import Path
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+# Counters and histograms cheap enough to stay enabled, rendered in the Prometheus text format. Metrics are
+# registered once (e.g. per meter) and then only updated on the hot path; values that other objects already
+# count are read by a function at render time instead.
+
+_Labels = Tuple[Tuple[str, str], ...]
+
+
+class Counter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0
+
+    def inc(self, amount: Union[int, float] = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> Union[int, float]:
+        return self._value
+
+
+class Histogram:
+    # Upper bounds in seconds, from 100us to 10s
+    DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                       2.5, 5.0, 10.0)
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self._lock = threading.Lock()
+        self._bounds = list(buckets)
+        self._bucket_array = np.array(buckets, dtype=np.float64)
+        self._counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self._sum = 0.0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def observe_many(self, values: np.ndarray) -> None:
+        counts = np.bincount(np.searchsorted(self._bucket_array, values), minlength=len(self._counts))
+        total = float(np.sum(values))
+        with self._lock:
+            for index in np.flatnonzero(counts).tolist():
+                self._counts[index] += int(counts[index])
+            self._sum += total
+
+    def snapshot(self) -> Tuple[List[Tuple[float, int]], float, int]:
+        # Cumulative (upper bound, count) pairs, sum and count
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = np.cumsum(counts).tolist()
+        return list(zip(self._bounds + [float("inf")], cumulative)), total, cumulative[-1]
+
+
+class _FunctionValue:
+    def __init__(self, function: Callable[[], Union[int, float]]):
+        self._function = function
+
+    @property
+    def value(self) -> Union[int, float]:
+        return self._function()
+
+
+class _Family:
+    def __init__(self, name: str, kind: str, help_text: str):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.metrics: Dict[_Labels, object] = {}
+
+
+def _format_labels(labels: _Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    if extra:
+        labels = labels + (extra,)
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join("%s=\"%s\"" % (name, value) for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: Union[int, float]) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families: Dict[str, _Family] = {}
+
+    def _get(self, name: str, kind: str, help_text: str, labels: Dict[str, str], factory: Callable[[], object],
+             replace: bool = False):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = _Family(name, kind, help_text)
+            elif family.kind != kind:
+                raise ValueError("metric %s is a %s" % (name, family.kind))
+            metric = family.metrics.get(key)
+            if metric is None or replace:
+                metric = family.metrics[key] = factory()
+            return metric
+
+    def counter(self, name: str, help_text: str, **labels: str) -> Counter:
+        return self._get(name, "counter", help_text, labels, Counter)
+
+    def counter_function(self, name: str, help_text: str, function: Callable[[], Union[int, float]],
+                         **labels: str) -> None:
+        # For totals that are counted elsewhere anyway, the function is called at render time
+        self._get(name, "counter", help_text, labels, lambda: _FunctionValue(function), replace=True)
+
+    def gauge_function(self, name: str, help_text: str, function: Callable[[], Union[int, float]],
+                       **labels: str) -> None:
+        self._get(name, "gauge", help_text, labels, lambda: _FunctionValue(function), replace=True)
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = Histogram.DEFAULT_BUCKETS,
+                  **labels: str) -> Histogram:
+        return self._get(name, "histogram", help_text, labels, lambda: Histogram(buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            families = [(family, list(family.metrics.items())) for family in self._families.values()]
+        lines = []
+        for family, metrics in families:
+            lines.append("# HELP %s %s" % (family.name, family.help_text))
+            lines.append("# TYPE %s %s" % (family.name, family.kind))
+            for labels, metric in metrics:
+                if isinstance(metric, Histogram):
+                    buckets, total, count = metric.snapshot()
+                    for bound, cumulative in buckets:
+                        bucket_labels = _format_labels(labels, ("le", _format_value(bound)))
+                        lines.append("%s_bucket%s %d" % (family.name, bucket_labels, cumulative))
+                    lines.append("%s_sum%s %s" % (family.name, _format_labels(labels), _format_value(total)))
+                    lines.append("%s_count%s %d" % (family.name, _format_labels(labels), count))
+                else:
+                    lines.append("%s%s %s" % (family.name, _format_labels(labels), _format_value(metric.value)))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Union[str, Path]) -> None:
+        Path(path).write_text(self.render(), encoding="utf-8")
+
+
+# Shared by everything in the process
+REGISTRY = MetricsRegistry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", self.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class MetricsServer:
+    # Serves the registry on http://<host>:<port>/metrics from a background thread
+    def __init__(self, port: int, host: str = "127.0.0.1", registry: MetricsRegistry = REGISTRY):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        self._server.daemon_threads = True
+        self._server.registry = registry
+        self._thread = threading.Thread(target=self._server.serve_forever, name="Metrics server", daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def __enter__(self):
+        self._thread.start()
+        self._logger.info("Serving metrics on http://%s:%d/metrics", *self._server.server_address[:2])
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,125 @@
+from dataclasses import dataclass
+import datetime
+from typing import Optional
+
+from .batch_decoder import SAMPLE_INTERVAL_NS, SAMPLES_PER_PACKET
+
+# The meter only keeps sending reports while the host requests them, how often it needs a request differs
+# between models. RequestPacer starts with the interval known to work for the model and, when adaptive, doubles
+# it as long as reports keep arriving at the full rate. A stall (no report for a few report periods) is answered
+# with a request right away and caps the interval at half the one that stalled. The meter buffers the reports
+# it could not send meanwhile and sends them in a burst, so a probe that stalls costs latency, not samples.
+# Intervals shorter than a report period (FNB48, C1) can not bring more reports than arrive: there a request
+# goes out with a report once the interval has passed, and without reports once per stall period.
+
+PACKET_PERIOD_NS = SAMPLE_INTERVAL_NS * SAMPLES_PER_PACKET
+EXPECTED_RATE = 1e9 / SAMPLE_INTERVAL_NS  # samples per second
+
+
+@dataclass
+class PacingPolicy:
+    adaptive: bool = True
+    max_interval: datetime.timedelta = datetime.timedelta(seconds=1)
+    # No report for this many report periods is a stall
+    stall_periods: int = 3
+    # Time at full rate before the interval is doubled, at least two intervals are waited in any case
+    probe_time: datetime.timedelta = datetime.timedelta(seconds=1)
+
+
+def _ns(duration: datetime.timedelta) -> int:
+    return duration // datetime.timedelta(microseconds=1) * 1000
+
+
+class RequestPacer:
+    # pylint: disable=too-many-instance-attributes
+    # All times are time.monotonic_ns(), only used on the reader thread (the counters may be read anywhere)
+    def __init__(self, refresh_rate: datetime.timedelta, policy: Optional[PacingPolicy] = None):
+        self._policy = policy or PacingPolicy()
+        # The interval known to work for the model is the floor. Even where it is shorter than a report period
+        # (FNB48, C1), whether a longer one keeps these meters going is not known, only adaptive pacing tries.
+        self._min_interval = _ns(refresh_rate)
+        self._max_interval = self._min_interval
+        if self._policy.adaptive:
+            self._max_interval = max(_ns(self._policy.max_interval), self._min_interval)
+        self._stall = self._policy.stall_periods * PACKET_PERIOD_NS
+        self.interval = self._min_interval
+        self.requests = 0
+        self.stalls = 0
+        self.packets = 0
+        self._elapsed = 0             # of earlier runs, from start() to the last report
+        self._start: Optional[int] = None
+        self.last_packet = 0
+        self._last_request = 0
+        self._stalled = False
+        self._probe_start = 0
+        self._probe_packets = 0
+
+    @property
+    def achieved_rate(self) -> float:
+        # Samples per second received while streaming
+        elapsed = self._elapsed + (self.last_packet - self._start if self._start is not None else 0)
+        return self.packets * SAMPLES_PER_PACKET * 1e9 / elapsed if elapsed > 0 else 0.0
+
+    def start(self, now: int) -> None:
+        # The meter was just initialized, which requests reports as well
+        if self._start is not None:
+            self._elapsed += self.last_packet - self._start
+        self._start = now
+        self.last_packet = now
+        self._last_request = now
+        self._stalled = False
+        self._restart_probe(now)
+
+    def _restart_probe(self, now: int) -> None:
+        self._probe_start = now
+        self._probe_packets = 0
+
+    def read_timeout(self, now: int, max_timeout_ms: int) -> int:
+        # ms to wait for the next report before the next request (or stall check) is due
+        if self.interval >= PACKET_PERIOD_NS or self.last_packet > self._last_request:
+            deadline = self._last_request + self.interval
+        else:
+            # Nothing to request before the next report
+            deadline = self._last_request + self._stall
+        if self._policy.adaptive:
+            deadline = min(deadline, (self._last_request if self._stalled else self.last_packet) + self._stall)
+        return min(max(-(-(deadline - now) // 1_000_000), 1), max_timeout_ms)
+
+    def packet_received(self, now: int) -> None:
+        self.packets += 1
+        self.last_packet = now
+        self._stalled = False
+        self._probe_packets += 1
+        probe_time = now - self._probe_start
+        if self.interval < self._max_interval and probe_time >= max(_ns(self._policy.probe_time), 2 * self.interval):
+            # Grow only if no report was missing
+            if self._probe_packets * PACKET_PERIOD_NS >= probe_time - PACKET_PERIOD_NS:
+                self.interval = min(2 * self.interval, self._max_interval)
+            self._restart_probe(now)
+
+    def request_due(self, now: int) -> bool:
+        if self.interval < PACKET_PERIOD_NS:
+            # At most one request per report
+            if self.last_packet > self._last_request and now >= self._last_request + self.interval:
+                return True
+            if not self._policy.adaptive:
+                return now - self._last_request >= self._stall
+        elif now >= self._last_request + self.interval - min(PACKET_PERIOD_NS, self.interval // 2):
+            # Requests that are due within the next report period go out with this wakeup, but never more than
+            # twice per interval
+            return True
+        if not self._policy.adaptive or now - self.last_packet < self._stall:
+            return False
+        if not self._stalled:
+            self._stalled = True
+            self.stalls += 1
+            self._max_interval = max(self.interval // 2, self._min_interval)
+            self.interval = self._max_interval
+            self._restart_probe(now)
+            return True
+        # Until reports come back, request every stall period
+        return now - self._last_request >= self._stall
+
+    def requested(self, now: int) -> None:
+        self.requests += 1
+        self._last_request = now
@@ -0,0 +1,111 @@
+from enum import Enum
+import threading
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+
+class OverflowPolicy(Enum):
+    BLOCK = "block"
+    DROP_OLDEST = "drop-oldest"
+    DROP_NEWEST = "drop-newest"
+
+
+class PacketRingBuffer:
+    # pylint: disable=too-many-instance-attributes
+    # Preallocated single producer / single consumer buffer for raw reports and their receive timestamps
+    def __init__(self, capacity: int, policy: OverflowPolicy = OverflowPolicy.BLOCK, packet_size: int = 64):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self._packets = np.zeros((capacity, packet_size), dtype=np.uint8)
+        self._timestamps = np.zeros(capacity, dtype=np.int64)
+        self._policy = policy
+        self._head = 0
+        self._count = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._listener: Optional[Callable[[], None]] = None
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self._timestamps)
+
+    @property
+    def policy(self) -> OverflowPolicy:
+        return self._policy
+
+    @property
+    def dropped(self) -> int:
+        return self.dropped_oldest + self.dropped_newest
+
+    def __len__(self) -> int:
+        with self._condition:
+            return self._count
+
+    def set_listener(self, listener: Optional[Callable[[], None]]) -> None:
+        # Called from the producer thread after every put and on close, e.g. to wake up an event loop.
+        # Must not block.
+        with self._condition:
+            self._listener = listener
+
+    def put(self, packet, timestamp: int) -> bool:
+        with self._condition:
+            if self._count == self.capacity:
+                if self._policy == OverflowPolicy.DROP_NEWEST:
+                    self.dropped_newest += 1
+                    return False
+                if self._policy == OverflowPolicy.DROP_OLDEST:
+                    self._head = (self._head + 1) % self.capacity
+                    self._count -= 1
+                    self.dropped_oldest += 1
+                else:
+                    while self._count == self.capacity and not self._closed:
+                        self._condition.wait()
+            if self._closed:
+                return False
+            tail = (self._head + self._count) % self.capacity
+            self._packets[tail, :len(packet)] = np.frombuffer(packet, dtype=np.uint8)
+            self._timestamps[tail] = timestamp
+            self._count += 1
+            self._condition.notify_all()
+            if self._listener:
+                self._listener()
+            return True
+
+    def get(self, max_count: Optional[int] = None,
+            timeout: Optional[float] = None) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        # Returns copies of up to max_count packets in arrival order, empty arrays on timeout, None once the
+        # buffer is closed and everything was consumed
+        with self._condition:
+            if not self._count and not self._closed:
+                self._condition.wait(timeout)
+            if not self._count:
+                if self._closed:
+                    return None
+                return self._packets[:0].copy(), self._timestamps[:0].copy()
+
+            count = self._count if max_count is None else min(max_count, self._count)
+            indices = (self._head + np.arange(count)) % self.capacity
+            if indices[-1] >= indices[0]:
+                indices = slice(indices[0], indices[-1] + 1)
+            packets = self._packets[indices].copy()
+            timestamps = self._timestamps[indices].copy()
+            self._head = (self._head + count) % self.capacity
+            self._count -= count
+            self._condition.notify_all()
+            return packets, timestamps
+
+    def reset(self) -> None:
+        with self._condition:
+            self._head = 0
+            self._count = 0
+            self._closed = False
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            if self._listener:
+                self._listener()
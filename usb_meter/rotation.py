@@ -0,0 +1,209 @@
+from dataclasses import dataclass
+from enum import Enum
+import gzip
+import logging
+import os
+from pathlib import Path
+import queue
+import shutil
+import threading
+import time
+from typing import Callable, List, Optional, Union
+
+import numpy as np
+
+from .time_index import IndexPolicy, IndexedStream, compress_blocks, index_path, read_index, write_index
+
+# Output files that are split into segments by size or age. The segment being written is a plain file that is
+# flushed like any other output, so a crash loses at most the unflushed samples. Finished segments are
+# compressed and old ones deleted on a background thread, the writer only closes one file and opens the next.
+
+
+class Compression(Enum):
+    NONE = "none"
+    GZIP = "gzip"
+    ZSTD = "zstd"
+
+    @property
+    def suffix(self) -> str:
+        return {Compression.NONE: "", Compression.GZIP: ".gz", Compression.ZSTD: ".zst"}[self]
+
+
+@dataclass
+class RotationPolicy:
+    # Start a new segment once the current one holds max_bytes or is interval seconds old, None disables either.
+    # With max_segments, the oldest finished segments are deleted, keeping that many besides the current one.
+    max_bytes: Optional[int] = None
+    interval: Optional[float] = None
+    compression: Compression = Compression.NONE
+    max_segments: Optional[int] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes is not None or self.interval is not None
+
+
+def _compressor(compression: Compression) -> Callable[[bytes], bytes]:
+    if compression == Compression.GZIP:
+        return gzip.compress
+    try:
+        import zstandard  # pylint: disable=import-outside-toplevel
+    except ImportError as e:
+        raise RuntimeError("zstd compression needs the zstandard package") from e
+    return zstandard.ZstdCompressor().compress
+
+
+def _compress_file(source: Path, compression: Compression) -> Path:
+    target = source.with_name(source.name + compression.suffix)
+    temporary = target.with_name(target.name + ".tmp")
+    compress = _compressor(compression)
+    entries = read_index(source)
+    with source.open("rb") as f_in, temporary.open("wb") as f_out:
+        if entries is not None and len(entries):
+            # Independently compressed blocks, so the index still allows seeking
+            entries = compress_blocks(f_in, f_out, entries, compress)
+        elif compression == Compression.GZIP:
+            with gzip.GzipFile(fileobj=f_out, mode="wb") as f_gzip:
+                shutil.copyfileobj(f_in, f_gzip, 1 << 20)
+        else:
+            while chunk := f_in.read(1 << 20):
+                f_out.write(compress(chunk))
+    # Only remove the original once the compressed file is complete
+    os.replace(temporary, target)
+    if entries is not None:
+        write_index(target, entries)
+        index_path(source).unlink()
+    source.unlink()
+    return target
+
+
+class SegmentArchiver:
+    # Compresses finished segments and enforces max_segments, one at a time on a daemon thread
+    def __init__(self, policy: RotationPolicy):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._policy = policy
+        self._queue: "queue.Queue[Optional[Path]]" = queue.Queue()
+        self._segments: List[Path] = []
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, segment: Path) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="Segment archiver", daemon=True)
+            self._thread.start()
+        self._queue.put(segment)
+
+    def close(self) -> None:
+        # Waits until everything queued is done
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while (segment := self._queue.get()) is not None:
+            try:
+                if self._policy.compression != Compression.NONE:
+                    segment = _compress_file(segment, self._policy.compression)
+                self._segments.append(segment)
+                self._remove_old()
+            except (OSError, RuntimeError) as e:
+                self._logger.error("Archiving %s failed: %s", segment, e)
+
+    def _remove_old(self) -> None:
+        if self._policy.max_segments is None:
+            return
+        while len(self._segments) > self._policy.max_segments:
+            oldest = self._segments.pop(0)
+            self._logger.info("Deleting old segment %s", oldest)
+            oldest.unlink(missing_ok=True)
+            index_path(oldest).unlink(missing_ok=True)
+
+
+class RotatingFile:
+    # pylint: disable=too-many-instance-attributes
+    # File-like object for the data loggers. Segments are named after the output path and their start time,
+    # e.g. run.csv -> run-20240101T120000.csv. A rotation only happens between two write() calls, which the
+    # loggers make with whole lines or records, and header() is written to the start of every further segment.
+    # With an index, each segment gets its own and rotations happen in boundaries(), before a block is written.
+    def __init__(self, path: Union[str, Path], policy: RotationPolicy, binary: bool = False,
+                 header: Optional[Callable[[object], None]] = None, index: Optional[IndexPolicy] = None):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        if not policy.enabled:
+            raise ValueError("rotation needs a size or an interval")
+        self._path = Path(path)
+        self._policy = policy
+        self._binary = binary
+        self.header = header
+        self._index = index
+        self._archiver = SegmentArchiver(policy)
+        self._file = None
+        self._segment: Optional[Path] = None
+        self._size = 0
+        self._opened = 0.0
+        self._open_segment()
+
+    @property
+    def segment(self) -> Optional[Path]:
+        # The file currently written
+        return self._segment
+
+    def _segment_path(self) -> Path:
+        name = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+        candidate = self._path.with_name("%s-%s%s" % (self._path.stem, name, self._path.suffix))
+        number = 1
+        while candidate.exists() or candidate.with_name(candidate.name + self._policy.compression.suffix).exists():
+            number += 1
+            # "_" sorts after the suffix dot, so the names sort in time order
+            candidate = self._path.with_name("%s-%s_%03d%s" % (self._path.stem, name, number, self._path.suffix))
+        return candidate
+
+    def _open_segment(self) -> None:
+        self._segment = self._segment_path()
+        if self._binary:
+            self._file = self._segment.open("wb")  # pylint: disable=consider-using-with
+        else:
+            self._file = self._segment.open("w", encoding="utf-8")  # pylint: disable=consider-using-with
+        if self._index:
+            self._file = IndexedStream(self._file, self._segment, self._index)
+        self._size = 0
+        self._opened = time.monotonic()
+
+    def _rotation_due(self) -> bool:
+        if self._size == 0:
+            return False
+        if self._policy.max_bytes is not None and self._size >= self._policy.max_bytes:
+            return True
+        return self._policy.interval is not None and time.monotonic() - self._opened >= self._policy.interval
+
+    def _rotate(self) -> None:
+        self._file.close()
+        self._archiver.add(self._segment)
+        self._open_segment()
+        if self.header:
+            self.header(self._file)
+
+    def boundaries(self, timestamps: np.ndarray) -> List[int]:
+        if self._rotation_due():
+            self._rotate()
+        return self._file.boundaries(timestamps)
+
+    def mark(self, timestamp: int) -> None:
+        self._file.mark(timestamp)
+
+    def write(self, data: Union[str, bytes]) -> int:
+        if not self._index and self._rotation_due():
+            self._rotate()
+        self._file.write(data)
+        # Output is ASCII, characters are bytes
+        self._size += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._archiver.add(self._segment)
+            self._archiver.close()
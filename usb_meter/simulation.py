@@ -0,0 +1,235 @@
+from array import array
+from dataclasses import dataclass
+import datetime
+from enum import Enum
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+import usb.core
+
+from . import batch_decoder, crc8
+from .device import Device, DeviceModel, device_info_by_model
+
+# A meter without hardware: SimulatedDevice looks like a Device to USBMeter, its endpoints produce valid,
+# CRC protected 0x04 data reports. Used by the benchmarks, which have to run without hardware.
+
+
+class Waveform(Enum):
+    CONSTANT = "constant"
+    SINE = "sine"
+    SQUARE = "square"
+    SAWTOOTH = "sawtooth"
+    NOISE = "noise"
+
+
+@dataclass
+class SimulationConfig:
+    # pylint: disable=too-many-instance-attributes
+    voltage: float = 5.0                  # V
+    current: float = 0.5                  # A, mean value
+    amplitude: float = 0.25               # A, current swing of the waveform
+    waveform: Waveform = Waveform.SINE
+    period: datetime.timedelta = datetime.timedelta(seconds=1)
+    temperature: float = 25.0             # C
+    packet_rate: Optional[float] = 25.0   # reports per second (4 samples each), None for as fast as possible
+    packet_count: Optional[int] = None    # stop sending after this many reports
+    # Like the real meter, reports only keep coming while the host requests them
+    keepalive: datetime.timedelta = datetime.timedelta(seconds=1)
+    seed: int = 0
+
+
+def _waveform(waveform: Waveform, phase: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    # Values in -1..1 for phases in 0..1
+    if waveform == Waveform.CONSTANT:
+        return np.zeros(len(phase))
+    if waveform == Waveform.SINE:
+        return np.sin(2 * np.pi * phase)
+    if waveform == Waveform.SQUARE:
+        return np.where(phase < 0.5, 1.0, -1.0)
+    if waveform == Waveform.SAWTOOTH:
+        return 2 * phase - 1
+    return rng.uniform(-1.0, 1.0, len(phase))
+
+
+def generate_packets(config: SimulationConfig, first_packet: int, count: int,
+                     rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    # count consecutive data reports, starting with report number first_packet, as (count, 64) bytes
+    rng = rng or np.random.default_rng(config.seed)
+    sample = first_packet * batch_decoder.SAMPLES_PER_PACKET + np.arange(count * batch_decoder.SAMPLES_PER_PACKET)
+    period = config.period / datetime.timedelta(microseconds=1) * 1000
+    phase = (sample * batch_decoder.SAMPLE_INTERVAL_NS % period) / period
+    current = np.maximum(config.current + config.amplitude * _waveform(config.waveform, phase, rng), 0.0)
+
+    packets = np.zeros(count, dtype=batch_decoder.PACKET_DTYPE)
+    packets["vendor"] = 0xaa
+    packets["type"] = batch_decoder.DATA_PACKET_TYPE
+    samples = packets["samples"]
+    samples["voltage"] = round(config.voltage * 100000)
+    samples["current"] = np.rint(current * 100000).reshape(count, -1)
+    samples["temperature"] = round(config.temperature * 10)
+    raw = packets.view(np.uint8).reshape(count, batch_decoder.PACKET_SIZE)
+    raw[:, -1] = crc8.packet_checksums(raw)
+    return raw
+
+
+class _Endpoint:
+    def __init__(self, address: int):
+        self.bEndpointAddress = address  # pylint: disable=invalid-name
+
+
+class _InEndpoint(_Endpoint):
+    # pylint: disable=too-many-instance-attributes
+    CHUNK = 1024
+
+    def __init__(self, address: int, device: "_SimulatedUSBDevice"):
+        super().__init__(address)
+        self._device = device
+        self._config = device.config
+        self._rng = np.random.default_rng(self._config.seed)
+        self._chunk = np.empty((0, batch_decoder.PACKET_SIZE), dtype=np.uint8)
+        self._chunk_start = 0
+        self._sent = 0
+        self._start: Optional[int] = None
+        self.read_times: List[int] = []  # time.monotonic_ns() each report was returned
+
+    def _next_packet(self) -> bytes:
+        index = self._sent - self._chunk_start
+        if index >= len(self._chunk):
+            self._chunk_start = self._sent
+            self._chunk = generate_packets(self._config, self._sent, self.CHUNK, self._rng)
+            index = 0
+        return self._chunk[index].tobytes()
+
+    def _due(self) -> Optional[int]:
+        # monotonic_ns() when the next report is available, None if there will be none
+        config = self._config
+        if config.packet_count is not None and self._sent >= config.packet_count:
+            return None
+        if not self._device.streaming():
+            return None
+        if config.packet_rate is None:
+            return 0
+        if self._start is None:
+            self._start = time.monotonic_ns()
+        return self._start + round(self._sent * 1e9 / config.packet_rate)
+
+    def read(self, size: int, timeout: Optional[int] = None) -> array:
+        due = self._due()
+        now = time.monotonic_ns()
+        deadline = now + (timeout or 0) * 1_000_000
+        if due is None or due > deadline:
+            if timeout:
+                time.sleep(max(0, (deadline - now) / 1e9))
+            raise usb.core.USBTimeoutError("Operation timed out")
+        if due > now:
+            time.sleep((due - now) / 1e9)
+        data = self._next_packet()[:size]
+        self._sent += 1
+        self.read_times.append(time.monotonic_ns())
+        return array("B", data)
+
+
+class _OutEndpoint(_Endpoint):
+    def __init__(self, address: int, device: "_SimulatedUSBDevice"):
+        super().__init__(address)
+        self._device = device
+
+    def write(self, data, timeout: Optional[int] = None) -> int:  # pylint: disable=unused-argument
+        if len(data) != batch_decoder.PACKET_SIZE or data[0] != 0xaa:
+            raise usb.core.USBError("Unexpected report")
+        self._device.poll()
+        return len(data)
+
+
+class _Interface:
+    # pylint: disable=invalid-name
+    def __init__(self, endpoints):
+        self.bInterfaceNumber = 0
+        self.bInterfaceClass = 0x03  # HID
+        self._endpoints = endpoints
+
+    def __iter__(self):
+        return iter(self._endpoints)
+
+
+class _Configuration:
+    def __init__(self, interface: _Interface):
+        self.bConfigurationValue = 1  # pylint: disable=invalid-name
+        self._interface = interface
+
+    def __iter__(self):
+        return iter([self._interface])
+
+    def __getitem__(self, key):
+        if key != (self._interface.bInterfaceNumber, 0):
+            raise KeyError(key)
+        return self._interface
+
+
+class _Context:
+    # What usb.util.dispose_resources calls
+    def dispose(self, device, close_handle: bool = True) -> None:
+        pass
+
+
+class _SimulatedUSBDevice:
+    # The subset of usb.core.Device USBMeter uses
+    def __init__(self, config: SimulationConfig):
+        self.config = config
+        self._ctx = _Context()
+        self._lock = threading.Lock()
+        self._last_poll: Optional[int] = None
+        self.ep_in = _InEndpoint(0x81, self)
+        self.ep_out = _OutEndpoint(0x01, self)
+        self._configuration = _Configuration(_Interface([self.ep_out, self.ep_in]))
+
+    def __iter__(self):
+        return iter([self._configuration])
+
+    def poll(self) -> None:
+        with self._lock:
+            self._last_poll = time.monotonic_ns()
+
+    def streaming(self) -> bool:
+        with self._lock:
+            last_poll = self._last_poll
+        keepalive = self.config.keepalive / datetime.timedelta(microseconds=1) * 1000
+        return last_poll is not None and time.monotonic_ns() - last_poll < keepalive
+
+    def reset(self) -> None:
+        with self._lock:
+            self._last_poll = None
+
+    def get_active_configuration(self) -> _Configuration:
+        return self._configuration
+
+    def is_kernel_driver_active(self, _interface: int) -> bool:
+        return False
+
+    def detach_kernel_driver(self, _interface: int) -> None:
+        pass
+
+
+class SimulatedDevice(Device):
+    def __init__(self, config: Optional[SimulationConfig] = None, model: DeviceModel = DeviceModel.FNB48,
+                 serial_number: str = "5117AB1E"):
+        super().__init__(device_info_by_model(model), _SimulatedUSBDevice(config or SimulationConfig()))
+        self._serial_number = serial_number
+
+    @property
+    def serial_number(self):
+        return self._serial_number
+
+    @property
+    def product_name(self):
+        return "Simulated %s" % self._device_info.model.name
+
+    @property
+    def manufacturer_name(self):
+        return None
+
+    @property
+    def read_times(self) -> List[int]:
+        return self._usb_device.ep_in.read_times
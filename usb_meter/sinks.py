@@ -0,0 +1,151 @@
+from collections import deque
+import contextlib
+from dataclasses import dataclass
+import logging
+import threading
+from typing import Deque, List, Optional, Sequence
+
+from .data_logger import DataLogger
+from .measurement import MeasurementBatch
+from .metrics import REGISTRY, MetricsRegistry
+from .ring_buffer import OverflowPolicy
+
+# Writes the decoded stream to several outputs at once. Every output gets its own SinkWorker: a thread with a
+# queue of batches in front of the data logger, so a slow output only fills its own queue. What happens when the
+# queue is full is up to the OverflowPolicy, like for the packet buffer. An output that fails stops receiving
+# data, the others carry on and the error is raised when the outputs are closed.
+
+
+@dataclass
+class SinkPolicy:
+    capacity: int = 1024  # batches queued for the output
+    overflow: OverflowPolicy = OverflowPolicy.BLOCK
+
+
+class SinkWorker(DataLogger):
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, data_logger: DataLogger, name: str, capacity: int = 1024,
+                 policy: OverflowPolicy = OverflowPolicy.BLOCK, registry: MetricsRegistry = REGISTRY):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._data_logger = data_logger
+        self._name = name
+        self._capacity = capacity
+        self._policy = policy
+        self._queue: Deque[MeasurementBatch] = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="SinkWorker %s" % name, daemon=True)
+        self.dropped_batches = 0
+        self.dropped_samples = 0
+        registry.gauge_function("usb_meter_sink_queued_batches", "Batches waiting to be written to an output",
+                                lambda: len(self._queue), output=name)
+        registry.counter_function("usb_meter_sink_dropped_samples_total",
+                                  "Samples not written because the output queue was full",
+                                  lambda: self.dropped_samples, output=name)
+
+    @property
+    def error(self) -> Optional[BaseException]:
+        return self._error
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        # Writes what is queued and stops the thread
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        if self.dropped_batches:
+            self._logger.warning("Output %s was too slow: dropped %d batches (%d samples)", self._name,
+                                 self.dropped_batches, self.dropped_samples)
+
+    def log(self, data: MeasurementBatch) -> None:
+        with self._condition:
+            while len(self._queue) >= self._capacity and self._error is None:
+                if self._policy == OverflowPolicy.DROP_NEWEST:
+                    self._drop(data)
+                    return
+                if self._policy == OverflowPolicy.DROP_OLDEST:
+                    self._drop(self._queue.popleft())
+                    break
+                self._condition.wait()
+            if self._error is not None or self._closed:
+                return
+            self._queue.append(data)
+            self._condition.notify_all()
+
+    def _drop(self, data: MeasurementBatch) -> None:
+        self.dropped_batches += 1
+        self.dropped_samples += len(data)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                batches = list(self._queue)
+                self._queue.clear()
+                self._condition.notify_all()
+            try:
+                for batch in batches:
+                    self._data_logger.log(batch)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                self._logger.error("Output %s failed, no more data is written to it: %s", self._name, e)
+                with self._condition:
+                    self._error = e
+                    self._queue.clear()
+                    self._condition.notify_all()
+                return
+
+
+class TeeDataLogger(DataLogger):
+    # Logs every batch to several data loggers in turn, on the calling thread
+    def __init__(self, data_loggers: Sequence[DataLogger]):
+        self._data_loggers = list(data_loggers)
+
+    def log(self, data: MeasurementBatch) -> None:
+        for data_logger in self._data_loggers:
+            data_logger.log(data)
+
+
+class FanOutDataLogger(DataLogger):
+    # Logs every batch to all data loggers, each through its own SinkWorker. Used as context manager, it also
+    # enters and exits the data loggers.
+    def __init__(self, data_loggers: Sequence[DataLogger], names: Sequence[str],
+                 policies: Optional[Sequence[SinkPolicy]] = None):
+        # policies: one per data logger, by default SinkPolicy()
+        policies = policies or [SinkPolicy()] * len(data_loggers)
+        if len(data_loggers) != len(names) or len(data_loggers) != len(policies):
+            raise ValueError("every data logger needs a name and a policy")
+        self._data_loggers = list(data_loggers)
+        self._workers: List[SinkWorker] = [SinkWorker(data_logger, name, policy.capacity, policy.overflow)
+                                           for data_logger, name, policy in zip(data_loggers, names, policies)]
+        self._stack = contextlib.ExitStack()
+
+    def __enter__(self):
+        with contextlib.ExitStack() as stack:
+            for data_logger in self._data_loggers:
+                stack.enter_context(data_logger)
+            self._stack = stack.pop_all()
+        for worker in self._workers:
+            worker.start()
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        with self._stack:
+            for worker in self._workers:
+                worker.close()
+        errors = [worker.error for worker in self._workers if worker.error is not None]
+        if errors and _type is None:
+            raise errors[0]
+
+    def log(self, data: MeasurementBatch) -> None:
+        for worker in self._workers:
+            worker.log(data)
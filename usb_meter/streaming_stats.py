@@ -0,0 +1,318 @@
+from dataclasses import dataclass, field
+import json
+import logging
+import math
+import os
+from pathlib import Path
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from .batch_decoder import SAMPLE_INTERVAL_NS, SAMPLES_PER_PACKET
+from .data_logger import DataLogger
+from .measurement import MeasurementBatch
+
+# Statistics of a whole run, updated with every batch in constant memory: count, min, max, mean and variance
+# per channel, percentiles from a QuantileSketch and the time spent above / below thresholds. Everything is
+# mergeable, so the summaries of several runs or devices add up to the summary of all their samples.
+
+VERSION = 1
+CHANNELS = ("voltage", "current", "power")
+_THRESHOLD = re.compile(r"^(%s)([<>])([-+0-9.eE]+)$" % "|".join(CHANNELS))
+# Samples further apart than this do not follow each other, even without a gap flag (a stall, or batches of
+# separate runs). Like the stall detection of pacing.PacingPolicy.
+SEGMENT_GAP_NS = 3 * SAMPLES_PER_PACKET * SAMPLE_INTERVAL_NS
+
+
+def sample_intervals(timestamp: np.ndarray, gap: np.ndarray, energy: np.ndarray,
+                     previous: Optional[Tuple[int, float]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    # Seconds every sample stands for and the mask of samples that start a segment: the first one, one after a
+    # gap, after more than SEGMENT_GAP_NS or where the energy column starts over. Those stand for one nominal
+    # sample interval, nothing is integrated across the gap before them. previous: timestamp and energy of
+    # the sample before the first one.
+    before_time, before_energy = previous if previous is not None else (timestamp[0], energy[0])
+    differences = np.diff(timestamp, prepend=before_time)
+    starts = gap | (differences <= 0) | (differences > SEGMENT_GAP_NS) | (np.diff(energy, prepend=before_energy) < 0)
+    return np.where(starts, SAMPLE_INTERVAL_NS, differences) / 1e9, starts
+
+
+class QuantileSketch:
+    # pylint: disable=too-many-instance-attributes
+    # Histogram with logarithmically growing buckets (as in DDSketch): every quantile is within
+    # relative_accuracy of a sample value, sketches with the same parameters merge by adding their counts.
+    # Values below min_value (also negative ones) count as zero, values above max_value as max_value.
+    def __init__(self, relative_accuracy: float = 0.01, min_value: float = 1e-6, max_value: float = 1e6):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._offset = math.ceil(math.log(min_value) / self._log_gamma)
+        self._counts = np.zeros(math.ceil(math.log(max_value) / self._log_gamma) - self._offset + 1, dtype=np.int64)
+        self.zero_count = 0
+
+    @property
+    def count(self) -> int:
+        return self.zero_count + int(self._counts.sum())
+
+    def add(self, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64)
+        small = values < self.min_value
+        self.zero_count += int(np.count_nonzero(small))
+        keys = np.ceil(np.log(np.minimum(values[~small], self.max_value)) / self._log_gamma).astype(np.int64)
+        self._counts += np.bincount(keys - self._offset, minlength=len(self._counts))
+
+    def _check_compatible(self, other: "QuantileSketch") -> None:
+        if (self.relative_accuracy, self.min_value, self.max_value) != \
+                (other.relative_accuracy, other.min_value, other.max_value):
+            raise ValueError("cannot merge sketches with different parameters")
+
+    def merge(self, other: "QuantileSketch") -> None:
+        self._check_compatible(other)
+        self.zero_count += other.zero_count
+        self._counts += other._counts  # pylint: disable=protected-access
+
+    def quantile(self, q: float) -> float:
+        total = self.count
+        if total == 0:
+            return math.nan
+        rank = q * (total - 1)
+        if rank < self.zero_count:
+            return 0.0
+        index = int(np.searchsorted(np.cumsum(self._counts), rank - self.zero_count, side="right"))
+        return 2 * self._gamma ** (index + self._offset) / (self._gamma + 1)
+
+    def to_dict(self) -> dict:
+        keys = np.flatnonzero(self._counts)
+        return {"relative_accuracy": self.relative_accuracy, "min_value": self.min_value,
+                "max_value": self.max_value, "zero_count": self.zero_count,
+                "keys": (keys + self._offset).tolist(), "counts": self._counts[keys].tolist()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "QuantileSketch":
+        sketch = cls(data["relative_accuracy"], data["min_value"], data["max_value"])
+        sketch.zero_count = data["zero_count"]
+        sketch._counts[np.asarray(data["keys"], dtype=np.int64) - sketch._offset] = data["counts"]
+        return sketch
+
+
+class ChannelStatistics:
+    def __init__(self):
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.mean = 0.0
+        self._m2 = 0.0  # sum of squared deviations from the mean
+        self.sketch = QuantileSketch()
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self._m2 / self.count) if self.count else math.nan
+
+    def quantile(self, q: float) -> float:
+        # The sketch only knows the bucket, the exact extremes are known
+        return min(max(self.sketch.quantile(q), self.min), self.max) if self.count else math.nan
+
+    def add(self, values: np.ndarray) -> None:
+        if len(values) == 0:
+            return
+        mean = float(values.mean())
+        self._combine(len(values), mean, float(np.square(values - mean).sum()))
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.sketch.add(values)
+
+    def _combine(self, count: int, mean: float, m2: float) -> None:
+        # Chan et al., pairwise update of mean and variance
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self._m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+    def merge(self, other: "ChannelStatistics") -> None:
+        if other.count == 0:
+            return
+        self._combine(other.count, other.mean, other._m2)  # pylint: disable=protected-access
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+
+    def to_dict(self) -> dict:
+        return {"count": self.count, "min": self.min, "max": self.max, "mean": self.mean, "m2": self._m2,
+                "sketch": self.sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ChannelStatistics":
+        statistics = cls()
+        statistics.count = data["count"]
+        statistics.min = data["min"]
+        statistics.max = data["max"]
+        statistics.mean = data["mean"]
+        statistics._m2 = data["m2"]
+        statistics.sketch = QuantileSketch.from_dict(data["sketch"])
+        return statistics
+
+
+@dataclass
+class Threshold:
+    channel: str
+    above: bool
+    value: float
+
+    @classmethod
+    def parse(cls, string: str) -> "Threshold":
+        # e.g. current>0.5, voltage<4.75
+        match = _THRESHOLD.match(string.replace(" ", ""))
+        if not match:
+            raise ValueError("invalid threshold %r, expected e.g. current>0.5" % string)
+        return cls(match.group(1), match.group(2) == ">", float(match.group(3)))
+
+    def __str__(self) -> str:
+        return "%s%s%g" % (self.channel, ">" if self.above else "<", self.value)
+
+
+@dataclass
+class DeviceStatistics:
+    # pylint: disable=too-many-instance-attributes
+    serial_number: str
+    samples: int = 0
+    gaps: int = 0
+    start: Optional[int] = None  # ns since epoch
+    end: Optional[int] = None
+    duration: float = 0.0        # s, without the gaps between segments, see sample_intervals
+    energy: float = 0.0          # Ws
+    capacity: float = 0.0        # As
+    channels: Dict[str, ChannelStatistics] = field(default_factory=lambda: {name: ChannelStatistics()
+                                                                           for name in CHANNELS})
+    threshold_time: Dict[str, float] = field(default_factory=dict)  # s, by str(Threshold)
+    # Energy and capacity column of the last sample added, not saved
+    last_columns: Optional[Tuple[float, float]] = field(default=None, repr=False)
+
+    def add(self, data: MeasurementBatch, thresholds: Sequence[Threshold]) -> None:
+        if len(data) == 0:
+            return
+        intervals, starts = sample_intervals(data.timestamp, data.gap, data.energy,
+                                             (self.end, self.last_columns[0]) if self.last_columns else None)
+        energy_before, capacity_before = self.last_columns or (float(data.energy[0]), float(data.capacity[0]))
+        values = {"voltage": data.voltage, "current": data.current}
+        values["power"] = values["voltage"] * values["current"]
+        # The energy and capacity columns integrate over the actual sample intervals, segments start afresh
+        energy = np.where(starts, values["power"] * intervals, data.energy_increments(energy_before))
+        capacity = np.where(starts, values["current"] * intervals, np.diff(data.capacity, prepend=capacity_before))
+        self.samples += len(data)
+        self.gaps += int(np.count_nonzero(data.gap))
+        self.start = int(data.timestamp[0]) if self.start is None else self.start
+        self.end = int(data.timestamp[-1])
+        self.last_columns = (float(data.energy[-1]), float(data.capacity[-1]))
+        self.duration += float(intervals.sum())
+        self.energy += float(energy.sum())
+        self.capacity += float(capacity.sum())
+        for name, channel in self.channels.items():
+            channel.add(values[name])
+        for threshold in thresholds:
+            selected = values[threshold.channel] > threshold.value if threshold.above else \
+                values[threshold.channel] < threshold.value
+            key = str(threshold)
+            self.threshold_time[key] = self.threshold_time.get(key, 0.0) + float(intervals[selected].sum())
+
+    def merge(self, other: "DeviceStatistics") -> None:
+        self.samples += other.samples
+        self.gaps += other.gaps
+        starts = [start for start in (self.start, other.start) if start is not None]
+        ends = [end for end in (self.end, other.end) if end is not None]
+        self.start = min(starts) if starts else None
+        self.end = max(ends) if ends else None
+        self.duration += other.duration
+        self.energy += other.energy
+        self.capacity += other.capacity
+        for name, channel in self.channels.items():
+            channel.merge(other.channels[name])
+        for key, seconds in other.threshold_time.items():
+            self.threshold_time[key] = self.threshold_time.get(key, 0.0) + seconds
+
+    def to_dict(self) -> dict:
+        return {"serial_number": self.serial_number, "samples": self.samples, "gaps": self.gaps,
+                "start": self.start, "end": self.end, "duration": self.duration, "energy": self.energy,
+                "capacity": self.capacity,
+                "channels": {name: channel.to_dict() for name, channel in self.channels.items()},
+                "threshold_time": self.threshold_time}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DeviceStatistics":
+        columns = dict(data)
+        columns["channels"] = {name: ChannelStatistics.from_dict(channel)
+                               for name, channel in data["channels"].items()}
+        columns["threshold_time"] = dict(data["threshold_time"])
+        return cls(**columns)
+
+
+def write_summary(path: Union[str, Path], devices: Sequence[DeviceStatistics]) -> None:
+    path = Path(path)
+    temporary = path.with_name(path.name + ".tmp")
+    with temporary.open("wt", encoding="utf-8") as f:
+        json.dump({"version": VERSION, "devices": [device.to_dict() for device in devices]}, f)
+    os.replace(temporary, path)
+
+
+def read_summary(path: Union[str, Path]) -> List[DeviceStatistics]:
+    with Path(path).open("rt", encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("version") != VERSION:
+        raise ValueError("%s: unsupported summary version %s" % (path, data.get("version")))
+    return [DeviceStatistics.from_dict(device) for device in data["devices"]]
+
+
+def merge_summaries(summaries: Sequence[Sequence[DeviceStatistics]], by_device: bool = True) \
+        -> List[DeviceStatistics]:
+    # Adds up the statistics of the same serial number, or of all devices into one named "all"
+    merged: Dict[str, DeviceStatistics] = {}
+    for summary in summaries:
+        for device in summary:
+            key = device.serial_number if by_device else "all"
+            merged.setdefault(key, DeviceStatistics(key)).merge(device)
+    return list(merged.values())
+
+
+class StatisticsLogger(DataLogger):
+    # Keeps the statistics of every device it sees and writes them to path every interval seconds and on exit.
+    # Thread safe, meters logging from their own threads can share one.
+    def __init__(self, path: Union[str, Path], interval: float = 60.0, thresholds: Sequence[Threshold] = ()):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._path = path
+        self._interval = interval
+        self._thresholds = list(thresholds)
+        self._devices: Dict[int, DeviceStatistics] = {}
+        self._lock = threading.Lock()
+        self._last_write = time.monotonic()
+
+    @property
+    def devices(self) -> List[DeviceStatistics]:
+        return list(self._devices.values())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        with self._lock:
+            write_summary(self._path, self.devices)
+        for device in self.devices:
+            current = device.channels["current"]
+            self._logger.info("%s: %d samples, %.3f Wh, %.3f Ah, current mean %.5f A, p99 %.5f A, max %.5f A",
+                              device.serial_number, device.samples, device.energy / 3600, device.capacity / 3600,
+                              current.mean, current.quantile(0.99), current.max)
+
+    def log(self, data: MeasurementBatch) -> None:
+        with self._lock:
+            key = id(data.device)
+            if key not in self._devices:
+                self._devices[key] = DeviceStatistics(str(data.device.serial_number))
+            self._devices[key].add(data, self._thresholds)
+            if time.monotonic() - self._last_write >= self._interval:
+                write_summary(self._path, self.devices)
+                self._last_write = time.monotonic()
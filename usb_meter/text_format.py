@@ -0,0 +1,93 @@
+from typing import List, Optional
+
+import numpy as np
+
+# Renders whole columns of numbers into text with NumPy instead of formatting every value in Python.
+# Every field is built as a (rows, width) character matrix plus a mask of the characters that are actually
+# used, so fields of varying length can be joined into lines without any per row work. The result is the
+# same text "%.<n>f" formatting produces.
+
+_DIGITS = np.frombuffer(b"0123456789", dtype=np.uint8)
+_SPACE = ord(" ")
+
+
+def to_fixed_point(values: np.ndarray, decimals: int) -> Optional[np.ndarray]:
+    # Returns the values scaled by 10**decimals and rounded exactly like "%.<decimals>f" would round them, or
+    # None for values this representation can not handle (negative including -0.0, not finite or too large)
+    values = np.asarray(values, dtype=np.float64)
+    scaled = values * 10.0 ** decimals
+    if scaled.size == 0:
+        return scaled.astype(np.int64)
+    if not np.all(np.isfinite(scaled)) or np.any(np.signbit(scaled)) or scaled.max() >= 2.0 ** 52:
+        return None
+    result = np.rint(scaled).astype(np.int64)
+    # The multiplication is off by at most half an ulp, values that close to a .5 boundary are rounded by Python
+    distance = np.abs(scaled - np.floor(scaled) - 0.5)
+    for index in np.flatnonzero(distance <= scaled * 2.0 ** -50 + 2.0 ** -60).tolist():
+        result[index] = int(("%.*f" % (decimals, values[index])).replace(".", ""))
+    return result
+
+
+def _digit_counts(values: np.ndarray, max_digits: int) -> np.ndarray:
+    counts = np.ones(len(values), dtype=np.int64)
+    power = 10
+    for _ in range(1, max_digits):
+        counts += values >= power
+        power *= 10
+    return counts
+
+
+class TextTable:
+    def __init__(self, rows: int):
+        self._rows = rows
+        self._chars: List[np.ndarray] = []
+        self._masks: List[np.ndarray] = []
+
+    def add_literal(self, text: str) -> None:
+        chars = np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+        self._add(np.broadcast_to(chars, (self._rows, len(chars))), None)
+
+    def add_strings(self, strings: np.ndarray) -> None:
+        # strings: fixed size bytes array (dtype "S<n>") holding one value per row, all of the same length
+        self._add(strings.view(np.uint8).reshape(self._rows, -1), None)
+
+    def add_integer(self, values: np.ndarray, width: int = 1, zero_pad: bool = False) -> None:
+        # Like "%<width>d" (or "%0<width>d") for non-negative values
+        values = np.asarray(values, dtype=np.int64)
+        largest = int(values.max()) if values.size else 0
+        digit_count = max(len(str(largest)), width)
+        chars = np.empty((self._rows, digit_count), dtype=np.uint8)
+        remaining = values.copy()
+        for position in range(digit_count - 1, -1, -1):
+            remaining, digit = np.divmod(remaining, 10)
+            chars[:, position] = _DIGITS[digit]
+        if zero_pad and digit_count == width:
+            self._add(chars, None)
+            return
+
+        significant = _digit_counts(values, digit_count)
+        used = np.maximum(significant, width)
+        positions = np.arange(digit_count)
+        keep = positions >= digit_count - used[:, np.newaxis]
+        if not zero_pad:
+            leading = positions < digit_count - significant[:, np.newaxis]
+            chars[leading] = _SPACE
+        self._add(chars, keep)
+
+    def add_fixed_point(self, scaled: np.ndarray, decimals: int, width: int = 0) -> None:
+        # Like "%<width>.<decimals>f" for the output of to_fixed_point
+        integer, fraction = np.divmod(scaled, 10 ** decimals)
+        self.add_integer(integer, max(1, width - decimals - 1))
+        self.add_literal(".")
+        self.add_integer(fraction, decimals, zero_pad=True)
+
+    def _add(self, chars: np.ndarray, mask: Optional[np.ndarray]) -> None:
+        self._chars.append(chars)
+        self._masks.append(np.ones(chars.shape, dtype=bool) if mask is None else mask)
+
+    def render(self) -> str:
+        if not self._rows:
+            return ""
+        chars = np.concatenate(self._chars, axis=1)
+        mask = np.concatenate(self._masks, axis=1)
+        return chars[mask].tobytes().decode("ascii")
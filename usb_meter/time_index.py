@@ -0,0 +1,173 @@
+from dataclasses import dataclass
+import gzip
+from pathlib import Path
+import struct
+from typing import BinaryIO, List, Optional, Tuple, Union
+
+import numpy as np
+
+# Sparse sidecar index of a log file (<log>.idx): every few seconds, the timestamp of a sample and the byte
+# offset its line or record starts at. A time range can then be read without scanning the file before it.
+# Compressed segments are made of independent gzip members / zstd frames that start at the indexed offsets,
+# block_offset is where the member holding an entry starts in the compressed file (equal to offset otherwise).
+MAGIC = b"UMIDX\0"
+VERSION = 1
+SUFFIX = ".idx"
+_HEADER = struct.Struct("<6sH8x")
+ENTRY_DTYPE = np.dtype([
+    ("timestamp", "<i8"),     # ns since epoch (UTC)
+    ("offset", "<i8"),        # in the uncompressed data
+    ("block_offset", "<i8"),  # in the file
+])
+
+
+@dataclass
+class IndexPolicy:
+    # Add an entry once this many seconds or records passed since the last one, None disables either
+    interval: Optional[float] = 10.0
+    records: Optional[int] = None
+
+
+def index_path(path: Union[str, Path]) -> Path:
+    return Path(str(path) + SUFFIX)
+
+
+def write_index(path: Union[str, Path], entries: np.ndarray) -> None:
+    with index_path(path).open("wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION))
+        f.write(entries.astype(ENTRY_DTYPE).tobytes())
+
+
+def read_index(path: Union[str, Path]) -> Optional[np.ndarray]:
+    # Entries of the index of a log file, None if there is none
+    sidecar = index_path(path)
+    if not sidecar.exists():
+        return None
+    data = sidecar.read_bytes()
+    if len(data) < _HEADER.size:
+        raise ValueError("%s: not an index" % sidecar)
+    magic, version = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s: not an index" % sidecar)
+    # A crash may leave a partial entry at the end
+    count = (len(data) - _HEADER.size) // ENTRY_DTYPE.itemsize
+    return np.frombuffer(data, dtype=ENTRY_DTYPE, count=count, offset=_HEADER.size)
+
+
+class IndexWriter:
+    def __init__(self, data_path: Union[str, Path], policy: IndexPolicy):
+        if policy.interval is None and policy.records is None:
+            raise ValueError("an index needs an interval or a record count")
+        self._policy = policy
+        self._file = index_path(data_path).open("wb")  # pylint: disable=consider-using-with
+        self._file.write(_HEADER.pack(MAGIC, VERSION))
+        self._last_timestamp: Optional[int] = None
+        self._records = 0
+
+    def boundaries(self, timestamps: np.ndarray) -> List[int]:
+        # Positions of the samples that get an entry when they are written next
+        positions = []
+        position = 0
+        while position < len(timestamps):
+            boundary = position
+            if self._last_timestamp is not None:
+                boundary = len(timestamps)
+                if self._policy.interval is not None:
+                    next_time = self._last_timestamp + int(self._policy.interval * 1e9)
+                    boundary = position + int(np.searchsorted(timestamps[position:], next_time))
+                if self._policy.records is not None:
+                    boundary = min(boundary, position + self._policy.records - self._records)
+            if boundary >= len(timestamps):
+                self._records += len(timestamps) - position
+                break
+            positions.append(boundary)
+            self._last_timestamp = int(timestamps[boundary])
+            self._records = 1
+            position = boundary + 1
+        return positions
+
+    def add(self, timestamp: int, offset: int) -> None:
+        self._file.write(np.array([(timestamp, offset, offset)], dtype=ENTRY_DTYPE).tobytes())
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class IndexedStream:
+    # Wraps the stream a logger writes, counting the bytes written so mark() can record where the next
+    # write starts. The loggers write ASCII only, so characters are bytes in text mode as well.
+    def __init__(self, stream, data_path: Union[str, Path], policy: IndexPolicy):
+        self._stream = stream
+        self._index = IndexWriter(data_path, policy)
+        self._size = 0
+
+    def boundaries(self, timestamps: np.ndarray) -> List[int]:
+        return self._index.boundaries(timestamps)
+
+    def mark(self, timestamp: int) -> None:
+        self._index.add(timestamp, self._size)
+
+    def write(self, data: Union[str, bytes]) -> int:
+        self._stream.write(data)
+        self._size += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        # Data first, so an entry never points behind the end of the file
+        self._stream.flush()
+        self._index.flush()
+
+    def close(self) -> None:
+        self._stream.close()
+        self._index.close()
+
+
+def _open_compressed(f: BinaryIO, suffix: str) -> BinaryIO:
+    # Reads from the current position of f to the end, across members / frames
+    if suffix == ".gz":
+        return gzip.GzipFile(fileobj=f, mode="rb")
+    if suffix == ".zst":
+        try:
+            import zstandard  # pylint: disable=import-outside-toplevel
+        except ImportError as e:
+            raise RuntimeError("reading zstd files needs the zstandard package") from e
+        return zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+    return f
+
+
+def read_range(path: Union[str, Path], start: Optional[int], end: Optional[int]) -> Tuple[bytes, bytes]:
+    # Uncompressed bytes of a log file holding at least the samples from start (inclusive) to end (exclusive),
+    # ns since epoch. Returns the header (the bytes before the first entry) and the range. Without an index,
+    # the header is empty and the whole file is returned as the range.
+    path = Path(path)
+    entries = read_index(path)
+    with path.open("rb") as f:
+        if entries is None or len(entries) == 0:
+            return b"", _open_compressed(f, path.suffix).read()
+        header = _open_compressed(f, path.suffix).read(int(entries["offset"][0]))
+        first = 0
+        if start is not None:
+            first = max(int(np.searchsorted(entries["timestamp"], start, side="right")) - 1, 0)
+        if end is not None and entries["timestamp"][first] >= end:
+            return header, b""
+        last = len(entries) if end is None else int(np.searchsorted(entries["timestamp"], end, side="left"))
+        f.seek(int(entries["block_offset"][first]))
+        reader = _open_compressed(f, path.suffix)
+        if last < len(entries):
+            data = reader.read(int(entries["offset"][last] - entries["offset"][first]))
+        else:
+            data = reader.read()
+        return header, data
+
+
+def compress_blocks(data: BinaryIO, target: BinaryIO, entries: np.ndarray, compress) -> np.ndarray:
+    # Compresses the header and every indexed block independently, returns the entries for the result
+    entries = entries.copy()
+    target.write(compress(data.read(int(entries["offset"][0]))))
+    for index, size in enumerate(np.diff(entries["offset"]).tolist() + [-1]):
+        entries["block_offset"][index] = target.tell()
+        target.write(compress(data.read(size)))
+    return entries
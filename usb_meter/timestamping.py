@@ -0,0 +1,263 @@
+from typing import List, Optional, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .batch_decoder import SAMPLES_PER_PACKET, SAMPLE_INTERVAL_NS
+
+# The meter has no timestamps of its own, only its sample clock: every data packet holds the next 4 samples.
+# The host sees when packets arrive, which is their send time plus a varying USB and scheduling latency, and
+# packets can get lost. SampleClock models the send time as intercept + period * packet index, fitted to the
+# lower envelope of the arrival times (the packets with the least latency), and derives evenly spaced sample
+# timestamps from it that never go backwards.
+
+
+class SampleClock:
+    # pylint: disable=too-many-instance-attributes
+    # A quartz drifts far less than this against the host clock, larger estimates come from bad input
+    MAX_DRIFT = 0.01
+    # How much faster or slower than the estimated clock the output may run to catch up with it
+    MAX_SLEW = 0.005
+    # Below this many packets a batch is handled packet by packet, which costs less than the array operations
+    SCALAR_PACKETS = 16
+
+    def __init__(self, sample_interval: int = SAMPLE_INTERVAL_NS, window: int = 1500, refit_interval: int = 100,
+                 gap_detection: int = 25):
+        # window: packets the period is estimated from, refit_interval: packets between two estimates,
+        # gap_detection: packets that have to arrive consistently late before they count as a gap
+        self._nominal_period = float(sample_interval * SAMPLES_PER_PACKET)
+        # Ring buffer of the last (index, arrival) pairs, the order does not matter for the fit
+        self._window_indices = np.zeros(window, dtype=np.float64)
+        self._window_arrivals = np.zeros(window, dtype=np.float64)
+        self._window_size = 0
+        self._window_position = 0
+        self._refit_interval = refit_interval
+        self._gap_detection = gap_detection
+        self._late: List[float] = []  # excess of the last packets, at most gap_detection - 1
+        self.period = self._nominal_period  # ns per packet
+        self.lost_packets = 0
+        self.gaps = 0
+        # Times are kept relative to the first arrival, as float64 epoch ns would only resolve 256 ns
+        self._origin: Optional[int] = None
+        self._intercept = 0.0
+        self._index = -1
+        self._time: Optional[float] = None  # output time of the last packet
+        self._until_refit = refit_interval
+
+    def reset(self) -> None:
+        self.period = self._nominal_period
+        self._origin = None
+        self._index = -1
+        self._time = None
+        self._until_refit = self._refit_interval
+        self._window_size = 0
+        self._window_position = 0
+        self._late = []
+
+    @property
+    def sample_interval(self) -> float:
+        return self.period / SAMPLES_PER_PACKET
+
+    @property
+    def drift(self) -> float:
+        # Relative deviation of the meter's sample clock from the host clock, positive if the meter is slow
+        return self.period / self._nominal_period - 1.0
+
+    def timestamps(self, arrivals: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # arrivals: host time (ns since epoch, taken from a monotonic clock) each data packet was received.
+        # Returns per sample: the timestamp (ns since epoch), the time in seconds it stands for (the first
+        # sample after a gap also covers the lost ones) and whether lost packets precede it.
+        times = np.empty(len(arrivals), dtype=np.float64)
+        intervals = np.empty(len(arrivals), dtype=np.float64)
+        skipped = np.zeros(len(arrivals), dtype=np.int64)
+        if len(arrivals) and self._origin is None:
+            self._origin = int(arrivals[0])
+        relative = (arrivals - (self._origin or 0)).astype(np.float64)
+        if len(arrivals) < self.SCALAR_PACKETS:
+            for position, arrival in enumerate(relative.tolist()):
+                times[position], intervals[position], skipped[position] = self._advance_packet(arrival)
+        else:
+            # The packets up to the next refit or gap are handled as a whole
+            position = 0
+            while position < len(arrivals):
+                position = self._advance(relative, position, times, intervals, skipped)
+
+        steps = np.arange(SAMPLES_PER_PACKET, 0, -1)
+        timestamps = times[:, np.newaxis] - intervals[:, np.newaxis] * steps
+        sample_intervals = np.repeat(intervals[:, np.newaxis], SAMPLES_PER_PACKET, axis=1)
+        sample_intervals[:, 0] += intervals * SAMPLES_PER_PACKET * skipped
+        gaps = np.zeros((len(arrivals), SAMPLES_PER_PACKET), dtype=bool)
+        gaps[:, 0] = skipped > 0
+        return (np.rint(timestamps).astype(np.int64).reshape(-1) + (self._origin or 0),
+                sample_intervals.reshape(-1) / 1e9, gaps.reshape(-1))
+
+    def _advance(self, arrivals: np.ndarray, start: int, times: np.ndarray, intervals: np.ndarray,
+                 skipped: np.ndarray) -> int:
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        # Places the arrivals from start up to the next refit or gap, returns where it stopped
+        targets, steps, packets = self._estimate(arrivals[start:start + self._until_refit])
+        end = start + len(targets)
+        if self._until_refit == 0:
+            # The packet completing the interval is already placed with the new estimate
+            self._until_refit = self._refit_interval
+            self._refit()
+            targets[-1] = self._intercept + self.period * self._index
+            steps[-1] = self.period * packets[-1]
+        skipped[end - 1] = packets[-1] - 1
+        # The very first packet stands for one period
+        previous = self._time if self._time is not None else float(targets[0]) - self.period
+        times[start:end] = self._output_times(targets, steps)
+        intervals[start] = times[start] - previous
+        np.subtract(times[start + 1:end], times[start:end - 1], out=intervals[start + 1:end])
+        intervals[start:end] /= SAMPLES_PER_PACKET * packets
+        return end
+
+    def packet_timestamps(self, arrival: int) -> Tuple[List[int], List[float], bool]:
+        # timestamps for a single packet, with plain Python numbers and the same results
+        if self._origin is None:
+            self._origin = arrival
+        time, interval, lost = self._advance_packet(float(arrival - self._origin))
+        timestamps = [round(time - interval * step) + self._origin for step in range(SAMPLES_PER_PACKET, 0, -1)]
+        intervals = [interval / 1e9] * SAMPLES_PER_PACKET
+        intervals[0] = (interval + interval * SAMPLES_PER_PACKET * lost) / 1e9
+        return timestamps, intervals, lost > 0
+
+    def _advance_packet(self, arrival: float) -> Tuple[float, float, int]:
+        # _advance for a single packet, with plain floats. Returns its time, the interval of its samples and the
+        # number of packets lost before it.
+        self._index += 1
+        if self._index == 0:
+            self._intercept = arrival
+        excess = arrival - (self._intercept + self.period * self._index)
+        if excess < 0:
+            self._intercept += excess
+            excess = 0.0
+        lost = self._detect_gap_packet(excess)
+        self._index += lost
+        self._window_indices[self._window_position] = self._index
+        self._window_arrivals[self._window_position] = arrival
+        self._window_position = (self._window_position + 1) % len(self._window_indices)
+        self._window_size = min(self._window_size + 1, len(self._window_indices))
+        self._until_refit -= 1
+        if self._until_refit == 0:
+            self._until_refit = self._refit_interval
+            self._refit()
+        target = self._intercept + self.period * self._index
+        previous = self._time if self._time is not None else target - self.period
+        step = self.period * (lost + 1)
+        if self._time is None:
+            self._time = target
+        else:
+            self._time += min(max(target - self._time, step * (1.0 - self.MAX_SLEW)), step * (1.0 + self.MAX_SLEW))
+        return self._time, (self._time - previous) / (SAMPLES_PER_PACKET * (lost + 1)), lost
+
+    def _estimate(self, arrivals: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Assigns packet indices to arrivals up to the first one after a gap, returns per packet: where the
+        # estimated clock puts it, the time since the packet before and the number of packets it stands for
+        indices = self._index + 1 + np.arange(len(arrivals), dtype=np.float64)
+        if self._index == -1:
+            self._intercept = float(arrivals[0])
+        # Less latency than any packet before makes a new lower envelope
+        offsets = arrivals - self.period * indices
+        intercepts = np.minimum.accumulate(np.minimum(offsets, self._intercept))
+        gap, lost = self._detect_gap(offsets - intercepts)
+        if gap is not None:
+            arrivals, indices, intercepts = arrivals[:gap + 1], indices[:gap + 1], intercepts[:gap + 1]
+            indices[gap] += lost
+        self._intercept = float(intercepts[-1])
+        self._index = int(indices[-1])
+        self._remember(indices, arrivals)
+
+        self._until_refit -= len(arrivals)
+        packets = np.ones(len(arrivals), dtype=np.int64)
+        packets[-1] += lost
+        return intercepts + self.period * indices, self.period * packets, packets
+
+    def _remember(self, indices: np.ndarray, arrivals: np.ndarray) -> None:
+        indices = indices[-len(self._window_indices):]
+        arrivals = arrivals[-len(self._window_indices):]
+        positions = (self._window_position + np.arange(len(indices))) % len(self._window_indices)
+        self._window_indices[positions] = indices
+        self._window_arrivals[positions] = arrivals
+        self._window_position = (self._window_position + len(indices)) % len(self._window_indices)
+        self._window_size = min(self._window_size + len(indices), len(self._window_indices))
+
+    def _detect_gap(self, excess: np.ndarray) -> Tuple[Optional[int], int]:
+        # A backlog after a stall arrives late, but in a burst that catches up with the envelope. Packets that
+        # keep arriving late by the same amount mean the meter sent packets that never arrived. Returns the
+        # position of the first packet that shows a gap and the number of packets lost before it.
+        size = self._gap_detection
+        history = len(self._late)
+        late = np.concatenate((np.array(self._late), excess))
+        found = np.empty(0, dtype=np.int64)
+        if len(late) >= size:
+            # The window ending with packet p starts at late[p + history + 1 - size]
+            windows = late[np.newaxis] if len(late) == size else sliding_window_view(late, size)
+            lowest = windows.min(axis=1)
+            found = np.flatnonzero((lowest >= self.period / 2) & (windows.max(axis=1) - lowest <= self.period / 2))
+        if len(found) == 0:
+            self._late = late[-(size - 1):].tolist()
+            return None, 0
+        self._late = []
+        lost = round(float(lowest[found[0]]) / self.period)
+        self.lost_packets += lost
+        self.gaps += 1
+        return int(found[0]) + size - 1 - history, lost
+
+    def _detect_gap_packet(self, excess: float) -> int:
+        # _detect_gap for a single packet
+        self._late.append(excess)
+        if len(self._late) < self._gap_detection:
+            return 0
+        lowest = min(self._late)
+        if lowest < self.period / 2 or max(self._late) - lowest > self.period / 2:
+            del self._late[0]
+            return 0
+        self._late = []
+        lost = round(lowest / self.period)
+        self.lost_packets += lost
+        self.gaps += 1
+        return lost
+
+    def _refit(self) -> None:
+        if self._window_size < 2 * self._refit_interval:
+            return
+        indices = self._window_indices[:self._window_size]
+        arrivals = self._window_arrivals[:self._window_size]
+        near = arrivals - (self._intercept + self.period * indices) < self.period / 2
+        if np.count_nonzero(near) < self._refit_interval:
+            return
+        # Least squares slope of arrival over index
+        near_indices = indices[near] - indices[near].mean()
+        variance = float(np.dot(near_indices, near_indices))
+        if variance == 0:
+            return
+        period = float(np.dot(near_indices, arrivals[near])) / variance
+        if abs(period / self._nominal_period - 1.0) > self.MAX_DRIFT:
+            return
+        self.period = period
+        self._intercept = float(np.min(arrivals - period * indices))
+
+    def _output_times(self, targets: np.ndarray, steps: np.ndarray) -> np.ndarray:
+        # Follows the estimated clock, but only ever MAX_SLEW faster or slower than it runs. Following it
+        # exactly is the usual case and handled as a whole, only while catching up each packet is looked at.
+        if self._time is None:
+            self._time = float(targets[0])
+            output = self._output_times(targets[1:], steps[1:])
+            return np.append(targets[0], output)
+        if len(targets) == 0:
+            return targets
+        differences = np.empty_like(targets)
+        differences[0] = targets[0] - self._time
+        differences[1:] = targets[1:] - targets[:-1]
+        slewing = (differences < steps * (1.0 - self.MAX_SLEW)) | (differences > steps * (1.0 + self.MAX_SLEW))
+        first = int(np.argmax(slewing)) if slewing.any() else len(targets)
+        output = targets.copy()
+        time = self._time if first == 0 else float(targets[first - 1])
+        for position in range(first, len(targets)):
+            step = float(steps[position])
+            time += min(max(float(targets[position]) - time, step * (1.0 - self.MAX_SLEW)),
+                        step * (1.0 + self.MAX_SLEW))
+            output[position] = time
+        self._time = float(output[-1])
+        return output
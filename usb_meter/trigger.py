@@ -0,0 +1,110 @@
+import datetime
+import logging
+from typing import List, Optional
+
+import numpy as np
+
+from .measurement import MeasurementBatch, timestamp_to_datetime
+from .stop_provider import StopProvider
+
+
+def _ns(duration: datetime.timedelta) -> int:
+    return duration // datetime.timedelta(microseconds=1) * 1000
+
+
+class Trigger(StopProvider):
+    # Decides which samples are output. process() is called for every decoded batch and returns the batches
+    # to log, should_stop() can end the run like any other stop provider.
+    def process(self, data: MeasurementBatch) -> List[MeasurementBatch]:
+        return [data]
+
+    def should_stop(self) -> bool:
+        return False
+
+
+class CurrentTrigger(Trigger):
+    # pylint: disable=too-many-instance-attributes
+    # Output starts once the current rises above start_current and stops after it stayed below stop_current
+    # for hold_time. Between both thresholds the state does not change (hysteresis). Samples of the last
+    # pre_trigger period before a start are output as well.
+    def __init__(self, start_current: float, stop_current: float, hold_time: datetime.timedelta,
+                 pre_trigger: datetime.timedelta = datetime.timedelta(), once: bool = False):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        if stop_current > start_current:
+            raise ValueError("stop current must not be above start current")
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._start_raw = start_current * MeasurementBatch.CURRENT_SCALE
+        self._stop_raw = stop_current * MeasurementBatch.CURRENT_SCALE
+        self._hold_time = _ns(hold_time)
+        self._pre_trigger = _ns(pre_trigger)
+        self._once = once
+        self._active = False
+        self._finished = False
+        self._low_since: Optional[int] = None
+        self._history: List[MeasurementBatch] = []
+
+    @property
+    def active(self) -> bool:
+        return self._active
+
+    def should_stop(self) -> bool:
+        return self._finished
+
+    def process(self, data: MeasurementBatch) -> List[MeasurementBatch]:
+        output = []
+        while len(data) and not self._finished:
+            if self._active:
+                end = self._find_stop(data)
+                output.append(data[:end])
+                data = data[end:]
+            else:
+                start = self._find_start(data)
+                if self._active:
+                    output.extend(self._history)
+                    self._history.clear()
+                data = data[start:]
+        return [batch for batch in output if len(batch)]
+
+    def _find_start(self, data: MeasurementBatch) -> int:
+        above = np.flatnonzero(data.raw_current > self._start_raw)
+        if len(above) == 0:
+            self._remember(data, int(data.timestamp[-1]))
+            return len(data)
+        start = int(above[0])
+        self._remember(data[:start], int(data.timestamp[start]))
+        self._active = True
+        self._low_since = None
+        self._logger.info("Trigger started at %s", timestamp_to_datetime(data.timestamp[start]))
+        return start
+
+    def _find_stop(self, data: MeasurementBatch) -> int:
+        low = data.raw_current < self._stop_raw
+        # Start of the low current period every sample belongs to: the sample after the last one that was not low
+        last_high = np.maximum.accumulate(np.where(low, -1, np.arange(len(data))))
+        low_since = data.timestamp[np.minimum(last_high + 1, len(data) - 1)]
+        if self._low_since is not None:
+            low_since = np.where(last_high < 0, self._low_since, low_since)
+        stopped = np.flatnonzero(low & (data.timestamp - low_since >= self._hold_time))
+        if len(stopped) == 0:
+            self._low_since = int(low_since[-1]) if low[-1] else None
+            return len(data)
+
+        end = int(stopped[0]) + 1
+        self._active = False
+        self._low_since = None
+        self._finished = self._once
+        self._logger.info("Trigger stopped at %s", timestamp_to_datetime(data.timestamp[end - 1]))
+        return end
+
+    def _remember(self, data: MeasurementBatch, now: int) -> None:
+        # Keeps the samples of the last pre_trigger period before now
+        if not self._pre_trigger:
+            return
+        if len(data):
+            self._history.append(data)
+        oldest = now - self._pre_trigger
+        while self._history and self._history[0].timestamp[-1] < oldest:
+            self._history.pop(0)
+        if self._history and self._history[0].timestamp[0] < oldest:
+            first = self._history[0]
+            self._history[0] = first[int(np.searchsorted(first.timestamp, oldest)):]
@@ -1,43 +1,142 @@
+import asyncio
+import contextlib
+from dataclasses import dataclass
 import logging
+import struct
+import threading
 import time
-from typing import Optional, Callable, List
+from typing import AsyncIterator, Iterable, Optional, Callable, List
 import datetime
 
-import crc
+import numpy as np
 import usb.core
 import usb.util
 
-from .device import Device, DeviceModel
-from .measurement import ElectricalMeasurement
+from . import batch_decoder, crc8
+from .device import Device, DeviceModel, devices_by_serial_number
+from .measurement import ElectricalMeasurement, MeasurementBatch
+from .metrics import REGISTRY, MetricsRegistry
+from .pacing import EXPECTED_RATE, PacingPolicy, RequestPacer
+from .ring_buffer import OverflowPolicy, PacketRingBuffer
 from .stop_provider import StopProvider
+from .timestamping import SampleClock
+from .trigger import Trigger
+
+# voltage, current, D+, D- and temperature of the 4 samples in a report, see batch_decoder.PACKET_DTYPE
+_PACKET_SAMPLES = struct.Struct("<2x" + "IIHHxH" * batch_decoder.SAMPLES_PER_PACKET + "2x")
+assert _PACKET_SAMPLES.size == batch_decoder.PACKET_SIZE
+
+@dataclass
+class ReconnectPolicy:
+    # A meter that sent nothing for stall_timeout or failed with a USB error is looked up again by its serial
+    # number every retry_interval, for at most timeout (None: forever), and logging resumes.
+    stall_timeout: datetime.timedelta = datetime.timedelta(seconds=1)
+    retry_interval: datetime.timedelta = datetime.timedelta(milliseconds=200)
+    timeout: Optional[datetime.timedelta] = None
+    find_devices: Callable[[str], Iterable[Device]] = devices_by_serial_number
+
+
+class MeterMetrics:
+    # pylint: disable=too-many-instance-attributes
+    # Per meter instrumentation, labeled with the serial number. The hot path only increments counters and
+    # feeds histograms with whole batches, totals the meter keeps anyway are read when rendering.
+    def __init__(self, meter: "USBMeter", registry: MetricsRegistry = REGISTRY):
+        device = meter.device.serial_number
+        self.packets_read = registry.counter("usb_meter_packets_read_total", "Reports read from the meter",
+                                             device=device)
+        self.usb_timeouts = registry.counter("usb_meter_usb_timeouts_total", "USB reads that timed out",
+                                             device=device)
+        self.non_data_packets = registry.counter("usb_meter_non_data_packets_total",
+                                                 "Reports skipped because they hold no samples", device=device)
+        self.samples = registry.counter("usb_meter_samples_total", "Samples decoded", device=device)
+        self.read_to_write = registry.histogram("usb_meter_read_to_write_seconds",
+                                                "Time from receiving a report until its samples were logged",
+                                                device=device)
+        self.log_time = registry.histogram("usb_meter_data_logger_log_seconds",
+                                           "Time spent in DataLogger.log", device=device)
+        registry.counter_function("usb_meter_crc_errors_total", "Data packets dropped because of a wrong checksum",
+                                  lambda: meter.crc_errors, device=device)
+        registry.counter_function("usb_meter_lost_packets_total", "Packets the meter sent that never arrived",
+                                  lambda: meter.clock.lost_packets, device=device)
+        registry.counter_function("usb_meter_buffer_dropped_total", "Packets dropped by a full packet buffer",
+                                  lambda: meter.dropped_packets, device=device)
+        registry.gauge_function("usb_meter_buffer_packets", "Packets waiting in the packet buffer",
+                                lambda: meter.buffered_packets, device=device)
+        self.reconnects = registry.counter("usb_meter_reconnects_total", "Reconnects after a USB error or stall",
+                                           device=device)
+        self.reconnect_time = registry.histogram("usb_meter_reconnect_seconds",
+                                                 "Time from losing the meter until it was set up again",
+                                                 device=device)
+        registry.counter_function("usb_meter_requests_total", "Requests for more reports sent to the meter",
+                                  lambda: meter.pacer.requests, device=device)
+        registry.gauge_function("usb_meter_request_interval_seconds", "Current time between two requests",
+                                lambda: meter.pacer.interval / 1e9, device=device)
+        registry.gauge_function("usb_meter_sample_rate", "Samples per second received while streaming",
+                                lambda: meter.pacer.achieved_rate, device=device)
 
 
 class USBMeter:
     # pylint: disable=too-many-instance-attributes
-    def __init__(self, device: Device, stop_provider: StopProvider, use_crc: bool = False, alpha: float = 0.9):
+    READ_TIMEOUT = datetime.timedelta(seconds=5)
+    POLL_TIMEOUT_MS = 100
+
+    def __init__(self, device: Device, stop_provider: StopProvider, use_crc: bool = False, alpha: float = 0.9,
+                 buffer_size: int = 4096, overflow_policy: OverflowPolicy = OverflowPolicy.BLOCK,
+                 trigger: Optional[Trigger] = None, reconnect: Optional[ReconnectPolicy] = None,
+                 pacing: Optional[PacingPolicy] = None, latest_only: bool = False):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        # latest_only: keep only the last sample of every report
         self._logger = logging.getLogger(self.__class__.__name__)
         self.alpha = alpha
         self.energy = 0.0
         self.capacity = 0.0
         self.temp_ema = None
-        self.crc_calculator: Optional[Callable] = self._setup_crc() if use_crc else None
+        self.use_crc = use_crc
+        self._crc_errors = 0
+        self._clock = SampleClock()
+        self._dropped_interval = 0.0
+        self._pending_gap = False
         self._device = device
         self._stop_provider = stop_provider
+        self._trigger = trigger
+        self._latest_only = latest_only
+        self._reconnect = reconnect
+        self._read_timeout = reconnect.stall_timeout if reconnect else self.READ_TIMEOUT
+        self._pacer = RequestPacer(device.device_info.refresh_rate, pacing)
         self.ep_in = None
         self.ep_out = None
-
-    def _setup_crc(self) -> Callable:
-        width = 8
-        poly = 0x39
-        init_value = 0x42
-        final_xor_value = 0x00
-        config = crc.Configuration(
-            width, poly, init_value, final_xor_value,
-            reverse_input=False, reverse_output=False
-        )
-        if hasattr(crc, "CrcCalculator"):
-            return crc.CrcCalculator(config, use_table=True).calculate_checksum
-        return crc.Calculator(config, optimized=True).checksum
+        self._buffer = PacketRingBuffer(buffer_size, overflow_policy)
+        self._reader_stop = threading.Event()
+        self._stop_requested = threading.Event()
+        self._reader_error: Optional[BaseException] = None
+        # Epoch minus monotonic ns of the reader timestamps, None unless reading from USB (e.g. replay)
+        self._clock_offset: Optional[int] = None
+        self.metrics = MeterMetrics(self)
+
+    @property
+    def device(self) -> Device:
+        return self._device
+
+    @property
+    def dropped_packets(self) -> int:
+        return self._buffer.dropped
+
+    @property
+    def buffered_packets(self) -> int:
+        return len(self._buffer)
+
+    @property
+    def pacer(self) -> RequestPacer:
+        return self._pacer
+
+    @property
+    def clock(self) -> SampleClock:
+        return self._clock
+
+    @property
+    def crc_errors(self) -> int:
+        # Data packets dropped because of a wrong checksum
+        return self._crc_errors
 
     def setup_device(self) -> None:
         self._device.usb_device.reset()
@@ -118,9 +217,10 @@ class USBMeter:
         #   1 byte (last) is a 8-bit CRC checksum
 
         if data[1] != 0x04:  # Not a data packet
+            self.metrics.non_data_packets.inc()
             return []
 
-        if self.crc_calculator:
+        if self.use_crc:
             if not self._verify_crc(data):
                 return []
 
@@ -136,6 +236,103 @@ class USBMeter:
 
         return measurements
 
+    def decode_packets(self, data, timestamps) -> MeasurementBatch:
+        # Batch variant of decode_packet: data holds N consecutive 64 byte reports, timestamps the N receive
+        # times in ns since epoch. Sample timestamps come from the SampleClock instead of the receive times.
+        packets = batch_decoder.as_packets(data)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if timestamps.shape != packets.shape:
+            raise ValueError("expected %d timestamps, got %d" % (packets.size, timestamps.size))
+        if packets.size == 1:
+            return self._decode_single_packet(packets.tobytes(), int(timestamps[0]))
+
+        data_packets = packets["type"] == batch_decoder.DATA_PACKET_TYPE
+        packets = packets[data_packets]
+        if len(packets) != len(data_packets):
+            self.metrics.non_data_packets.inc(len(data_packets) - len(packets))
+        sample_times, intervals, gaps = self._clock.timestamps(timestamps[data_packets])
+        if self._dropped_interval and len(packets):
+            # Corrupt packets at the end of the previous batch
+            intervals[0] += self._dropped_interval
+            gaps[0] = True
+            self._dropped_interval = 0.0
+        if self._pending_gap and len(packets):
+            # First packet after a reconnect
+            gaps[0] = True
+            self._pending_gap = False
+        if self.use_crc:
+            checksums = crc8.packet_checksums(packets.view(np.uint8).reshape(-1, batch_decoder.PACKET_SIZE))
+            corrupt = np.flatnonzero(checksums != packets["crc"])
+            if len(corrupt):
+                for index in corrupt:
+                    self._crc_mismatch(checksums[index], packets["crc"][index])
+                keep = np.ones(len(packets), dtype=bool)
+                keep[corrupt] = False
+                packets = packets[keep]
+                sample_times, intervals, gaps = self._drop_samples(np.repeat(keep, batch_decoder.SAMPLES_PER_PACKET),
+                                                                   sample_times, intervals, gaps)
+
+        columns, self.energy, self.capacity, self.temp_ema = batch_decoder.decode_samples(
+            packets, sample_times, intervals, self.energy, self.capacity, self.temp_ema, self.alpha)
+        self.metrics.samples.inc(len(sample_times))
+        return MeasurementBatch(self._device, gap=gaps, **columns)
+
+    def _decode_single_packet(self, packet: bytes, arrival: int) -> MeasurementBatch:
+        # decode_packets for one report, the usual case when the meter is read as it sends. Plain Python numbers
+        # cost less than the array operations for 4 samples and give the same results.
+        if packet[1] != batch_decoder.DATA_PACKET_TYPE:
+            self.metrics.non_data_packets.inc()
+            return MeasurementBatch.empty(self._device)
+        timestamps, intervals, gap = self._clock.packet_timestamps(arrival)
+        if self._dropped_interval:
+            intervals[0] += self._dropped_interval
+            gap = True
+            self._dropped_interval = 0.0
+        if self._pending_gap:
+            gap = True
+            self._pending_gap = False
+        if self.use_crc and not self._verify_crc(packet):
+            self._dropped_interval = float(np.sum(intervals))
+            return MeasurementBatch.empty(self._device)
+
+        raw = _PACKET_SAMPLES.unpack(packet)
+        self.metrics.samples.inc(batch_decoder.SAMPLES_PER_PACKET)
+        return MeasurementBatch(
+            self._device,
+            timestamp=np.array(timestamps, dtype=np.int64),
+            raw_voltage=np.array(raw[0::5], dtype=np.uint32),
+            raw_current=np.array(raw[1::5], dtype=np.uint32),
+            raw_dp=np.array(raw[2::5], dtype=np.uint16),
+            raw_dn=np.array(raw[3::5], dtype=np.uint16),
+            gap=np.array([gap] + [False] * (batch_decoder.SAMPLES_PER_PACKET - 1)),
+            **self._accumulate(raw, intervals),
+        )
+
+    def _accumulate(self, raw: tuple, intervals: List[float]) -> dict:
+        # Running totals and temperature EMA of the samples unpacked by _decode_single_packet, evaluated in the
+        # same order as batch_decoder.decode_samples
+        energy, capacity, temp_ema = self.energy, self.capacity, self.temp_ema
+        columns = {"temperature": [], "energy": [], "capacity": []}
+        for raw_voltage, raw_current, raw_temperature, interval in zip(raw[0::5], raw[1::5], raw[4::5], intervals):
+            current = raw_current / 100000
+            energy += raw_voltage / 100000 * current * interval
+            capacity += current * interval
+            temperature = raw_temperature / 10.0
+            temp_ema = temperature if temp_ema is None else temperature * (1.0 - self.alpha) + temp_ema * self.alpha
+            columns["temperature"].append(temp_ema)
+            columns["energy"].append(energy)
+            columns["capacity"].append(capacity)
+        self.energy, self.capacity, self.temp_ema = energy, capacity, temp_ema
+        return {name: np.array(values) for name, values in columns.items()}
+
+    def _drop_samples(self, keep: np.ndarray, sample_times: np.ndarray, intervals: np.ndarray, gaps: np.ndarray):
+        # The next sample that is kept stands for the time of the dropped ones and is marked as gap
+        covered = np.cumsum(intervals)[keep]
+        kept_intervals = np.diff(covered, prepend=0.0)
+        gaps = gaps[keep] | ~np.concatenate(([True], keep[:-1]))[keep]
+        self._dropped_interval += float(np.sum(intervals)) - (float(covered[-1]) if len(covered) else 0.0)
+        return sample_times[keep], kept_intervals, gaps
+
     def _decode_measurement(self, data: bytes, timestamp: datetime.datetime) -> ElectricalMeasurement:
         voltage = int.from_bytes(data[0:4], 'little') / 100000
         current = int.from_bytes(data[4:8], 'little') / 100000
@@ -168,32 +365,223 @@ class USBMeter:
 
     def _verify_crc(self, data: bytes) -> bool:
         actual = data[-1]
-        expected = self.crc_calculator(bytearray(data[1:-1]))  # pylint: disable=not-callable
+        expected = crc8.packet_checksum(data)
         if actual != expected:
-            self._logger.warning("CRC mismatch: expected %02x, got %02x", expected, actual)
+            self._crc_mismatch(expected, actual)
             return False
         return True
 
-    def _do_log(self, data_logger):
-        self._initialize_communication()
-        next_refresh = datetime.datetime.now() + self._device.device_info.refresh_rate
+    def _crc_mismatch(self, expected: int, actual: int) -> None:
+        self._crc_errors += 1
+        self._logger.warning("CRC mismatch: expected %02x, got %02x", expected, actual)
+
+    def _read_loop(self) -> None:
+        # Runs on its own thread, so a slow data logger never delays reading the meter. Packets are stamped
+        # with the monotonic clock (converted to ns since epoch once), so host clock changes do not affect them.
+        # Requests for more reports are sent when the pacer asks for them, the read timeout wakes the loop up
+        # in time if no report arrives before.
+        clock_offset = self._clock_offset
+        pacer = self._pacer
+        read_timeout = self._read_timeout // datetime.timedelta(microseconds=1) * 1000
+        pacer.start(time.monotonic_ns())
+        try:
+            while not self._reader_stop.is_set():
+                try:
+                    data = self.ep_in.read(64, timeout=pacer.read_timeout(time.monotonic_ns(),
+                                                                          self.POLL_TIMEOUT_MS))
+                    now = time.monotonic_ns()
+                    self._buffer.put(data, now + clock_offset)
+                    pacer.packet_received(now)
+                    self.metrics.packets_read.inc()
+                except usb.core.USBTimeoutError:
+                    self.metrics.usb_timeouts.inc()
+                    now = time.monotonic_ns()
+                    if now - pacer.last_packet >= read_timeout:
+                        raise
+
+                if pacer.request_due(now):
+                    self._request_next_measurement()
+                    pacer.requested(now)
+        except BaseException as e:  # pylint: disable=broad-exception-caught
+            self._reader_error = e
+        finally:
+            self._buffer.close()
+
+    def process_packets(self, data: np.ndarray, timestamps: np.ndarray) -> List[MeasurementBatch]:
+        # Decodes the packets and applies the trigger, returns the non-empty batches to output
+        measurements = self.decode_packets(data, timestamps)
+        if self._latest_only:
+            # Only here every batch starts at a report, the trigger cuts them anywhere
+            measurements = measurements[batch_decoder.SAMPLES_PER_PACKET - 1::batch_decoder.SAMPLES_PER_PACKET]
+        batches = self._trigger.process(measurements) if self._trigger else [measurements]
+        return [batch for batch in batches if len(batch)]
+
+    def log_packets(self, data_logger, data: np.ndarray, timestamps: np.ndarray) -> None:
+        for batch in self.process_packets(data, timestamps):
+            start = time.perf_counter_ns()
+            data_logger.log(batch)
+            self.metrics.log_time.observe((time.perf_counter_ns() - start) / 1e9)
+        if self._clock_offset is not None:
+            self.metrics.read_to_write.observe_many((time.monotonic_ns() + self._clock_offset - timestamps) / 1e9)
+
+    def _should_stop(self) -> bool:
+        if self._stop_requested.is_set():
+            return True
+        if self._trigger and self._trigger.should_stop():
+            return True
+        return bool(self._stop_provider and self._stop_provider.should_stop())
+
+    def _start_reader(self, initialize: bool = True) -> threading.Thread:
+        if initialize:
+            self._initialize_communication()
+        self._reader_stop.clear()
+        self._reader_error = None
+        self._buffer.reset()
+        self._clock.reset()
+        self._clock_offset = time.time_ns() - time.monotonic_ns()
+        reader = threading.Thread(target=self._read_loop, name="USBMeter reader", daemon=True)
+        reader.start()
+        return reader
+
+    def _stop_reader(self, reader: threading.Thread) -> None:
+        self._reader_stop.set()
+        self._buffer.close()
+        reader.join()
+
+    def _report(self) -> None:
+        if self._pacer.packets:
+            log = self._logger.info if self._pacer.achieved_rate >= 0.99 * EXPECTED_RATE else self._logger.warning
+            log("Received %.1f of %.0f samples/s, %d requests, %d stalls, last request interval %.3f s",
+                self._pacer.achieved_rate, EXPECTED_RATE, self._pacer.requests, self._pacer.stalls,
+                self._pacer.interval / 1e9)
+        if self._crc_errors:
+            self._logger.warning("%d packets dropped because of CRC mismatches", self._crc_errors)
+        if self._clock.lost_packets:
+            self._logger.warning("%d packets lost in %d gaps", self._clock.lost_packets, self._clock.gaps)
+        if self._buffer.dropped:
+            self._logger.warning("Packet buffer overflow: dropped %d oldest, %d newest packets",
+                                 self._buffer.dropped_oldest, self._buffer.dropped_newest)
+        if self._reader_error:
+            raise self._reader_error
+
+    def _do_log(self, handle_packets: Callable[[np.ndarray, np.ndarray], None]):
+        initialize = True
         while True:
-            data = self.ep_in.read(64, timeout=5000)
-            now = datetime.datetime.now(datetime.timezone.utc)
-            measurements = self.decode_packet(data, now)
-            if measurements:
-                data_logger.log(measurements)
+            reader = self._start_reader(initialize)
+            try:
+                while not self._should_stop():
+                    packets = self._buffer.get(timeout=self.POLL_TIMEOUT_MS / 1000)
+                    if packets is None:
+                        break
+                    if len(packets[1]):
+                        handle_packets(*packets)
+            finally:
+                self._stop_reader(reader)
+
+            # Handle whatever the reader already received
+            while (packets := self._buffer.get(timeout=0)) is not None:
+                if len(packets[1]):
+                    handle_packets(*packets)
+            if not self._reconnect_after_error():
+                break
+            initialize = False
+        self._report()
 
-            if datetime.datetime.now() >= next_refresh:
-                next_refresh = datetime.datetime.now() + self._device.device_info.refresh_rate
-                self._request_next_measurement()
+    def _reconnect_after_error(self) -> bool:
+        # Finds the meter again after the reader failed with a USB error, True once it is set up again
+        if not (self._reconnect and isinstance(self._reader_error, usb.core.USBError)) or self._should_stop():
+            return False
+        serial_number = self._device.serial_number
+        self._logger.warning("Meter %s lost (%s), reconnecting...", serial_number, self._reader_error)
+        # Release the claimed interface of the handle that is gone, before it is replaced
+        with contextlib.suppress(usb.core.USBError):
+            usb.util.dispose_resources(self._device.usb_device)
+        start = time.monotonic()
+        retry_interval = self._reconnect.retry_interval.total_seconds()
+        while not self._stop_requested.wait(retry_interval) and not self._should_stop():
+            try:
+                device = next(iter(self._reconnect.find_devices(serial_number)), None)
+                if device is not None:
+                    self._device.reattach(device.usb_device)
+                    self.setup_device()
+                    self._initialize_communication()
+                    elapsed = time.monotonic() - start
+                    self._logger.warning("Meter %s reconnected after %.3f s", serial_number, elapsed)
+                    self.metrics.reconnects.inc()
+                    self.metrics.reconnect_time.observe(elapsed)
+                    self._reader_error = None
+                    self._pending_gap = True
+                    return True
+            except (usb.core.USBError, RuntimeError, ValueError) as e:
+                # A meter that is still enumerating can fail in any step: reading its serial number, finding
+                # its HID interface or detaching the kernel driver
+                self._logger.debug("Reconnect attempt failed: %s", e)
+            timeout = self._reconnect.timeout
+            if timeout is not None and time.monotonic() - start >= timeout.total_seconds():
+                self._logger.error("Meter %s did not come back within %s", serial_number, timeout)
+                return False
+        # Stopped while waiting for the meter
+        self._reader_error = None
+        return False
 
-            if self._stop_provider.should_stop():
-                break
+    async def stream(self) -> AsyncIterator[MeasurementBatch]:
+        # Async variant of run(): "async for batch in meter.stream()". USB is read on the reader thread as
+        # usual, the event loop is only woken up when packets arrive, so one loop can serve many meters.
+        # Batches are only decoded when the consumer asks for the next one, a slow consumer fills the packet
+        # buffer, which then applies its overflow policy. The stream ends like run() does (stop providers,
+        # trigger, stop()), or by cancelling the consuming task. When leaving the loop early, close the
+        # stream with contextlib.aclosing() so the reader is stopped and the meter drained right away.
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        self._buffer.set_listener(lambda: loop.call_soon_threadsafe(ready.set))
+        # Starting the reader writes to the meter and waits for it, not something to do on the event loop
+        starting = asyncio.ensure_future(asyncio.to_thread(self._start_reader))
+        try:
+            reader = await asyncio.shield(starting)
+        except asyncio.CancelledError:
+            # The thread starts the reader anyway, stop it again
+            await asyncio.to_thread(self._stop_reader, await starting)
+            self._buffer.set_listener(None)
+            raise
+        try:
+            while not self._should_stop():
+                ready.clear()
+                packets = self._buffer.get(timeout=0)
+                if packets is None:
+                    break
+                if len(packets[1]) == 0:
+                    # Also wake up regularly to check the stop providers
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(ready.wait(), self.POLL_TIMEOUT_MS / 1000)
+                    continue
+                for batch in self.process_packets(*packets):
+                    yield batch
+
+            await asyncio.to_thread(self._stop_reader, reader)
+            while (packets := self._buffer.get(timeout=0)) is not None:
+                for batch in self.process_packets(*packets):
+                    yield batch
+            self._report()
+        finally:
+            if reader.is_alive():
+                await asyncio.to_thread(self._stop_reader, reader)
+            self._buffer.set_listener(None)
+            await asyncio.to_thread(self._drain_buffer)
+
+    def stop(self) -> None:
+        # Thread safe, makes a running run() finish like a stop provider would
+        self._stop_requested.set()
 
     def run(self, data_logger) -> None:
+        self._run(lambda data, timestamps: self.log_packets(data_logger, data, timestamps))
+
+    def capture(self, capture_writer) -> None:
+        # Store the raw reports without decoding them, see capture.CaptureWriter
+        self._run(capture_writer.write)
+
+    def _run(self, handle_packets: Callable[[np.ndarray, np.ndarray], None]) -> None:
         try:
-            self._do_log(data_logger)
+            self._do_log(handle_packets)
         except KeyboardInterrupt:
             self._logger.info("Keyboard interrupt received -> stopping...")
 
@@ -208,3 +596,6 @@ class USBMeter:
                 #    self._logger.debug("Drained %d bytes", len(data))
         except usb.core.USBTimeoutError:
             self._logger.debug("Buffer drain complete")
+        except usb.core.USBError as e:
+            # The meter is gone
+            self._logger.debug("Buffer drain failed: %s", e)